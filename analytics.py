@@ -0,0 +1,341 @@
+import logging
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import case, cast, func, or_, select, Integer
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, DailyRollup, Payment, Subscription
+
+
+logger = logging.getLogger(__name__)
+
+# Subscriptions in these statuses are still billed, so they count toward MRR
+MRR_STATUSES = ('active', 'past_due')
+# 'canceled' is Stripe's spelling, stored as-is by customer.subscription.updated
+CHURNED_STATUSES = ('cancelled', 'canceled')
+
+COUNTERS = ('revenue', 'payments', 'new_subscriptions', 'cancellations', 'mrr_delta', 'active_delta', 'past_due_delta')
+
+
+# -------------------------------------------------------------------
+# INCREMENTAL UPDATES (called by the webhook handlers)
+# -------------------------------------------------------------------
+
+def add_to_rollup(day, payment_type, plan_tier, **deltas):
+    """
+    Add deltas to one daily bucket
+
+    A single INSERT ... ON CONFLICT DO UPDATE on SQLite/PostgreSQL, so workers
+    updating the same bucket at once never lose an increment. Runs in the
+    caller's transaction: the bucket changes if and only if the handler commits.
+    """
+    deltas = {name: value for name, value in deltas.items() if value}
+    if not deltas:
+        return
+    key = {'day': day, 'payment_type': payment_type, 'plan_tier': plan_tier or ''}
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        stmt = insert(DailyRollup).values(**key, **deltas)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['day', 'payment_type', 'plan_tier'],
+            set_={name: getattr(DailyRollup, name) + stmt.excluded[name] for name in deltas}
+        )
+        db.session.execute(stmt)
+        return
+    # Other databases: update, or insert the bucket if it doesn't exist yet
+    updated = DailyRollup.query.filter_by(**key).update(
+        {name: getattr(DailyRollup, name) + value for name, value in deltas.items()},
+        synchronize_session=False
+    )
+    if not updated:
+        db.session.add(DailyRollup(**key, **deltas))
+        db.session.flush()
+
+
+def _day(occurred_at):
+    return (occurred_at or datetime.utcnow()).date()
+
+
+def record_payment(payment_type, amount, occurred_at=None, count=1, plan_tier=''):
+    """Count a completed payment (or, with count=0, a correction of its amount); subscription invoices per plan tier"""
+    add_to_rollup(_day(occurred_at), payment_type, plan_tier, revenue=Decimal(str(amount)), payments=count)
+
+
+def subscription_state(subscription):
+    """What the rollups count of a subscription: (status, plan_tier, amount)"""
+    return subscription.status, subscription.plan_tier or '', Decimal(str(subscription.amount or 0))
+
+
+def record_subscription_change(before, after, occurred_at=None):
+    """
+    Roll a subscription change into today's buckets
+
+    `before` and `after` are subscription_state() tuples, None for a
+    subscription that didn't exist yet. Moving to another plan tier takes its
+    MRR out of the old tier's bucket and adds it to the new one.
+    """
+    if before == after:
+        return
+    deltas = defaultdict(lambda: defaultdict(int))
+    for state, sign in ((before, -1), (after, 1)):
+        if state is None:
+            continue
+        status, plan_tier, amount = state
+        if status in MRR_STATUSES:
+            deltas[plan_tier]['mrr_delta'] += sign * amount
+            deltas[plan_tier]['active_delta' if status == 'active' else 'past_due_delta'] += sign
+    if after is not None:
+        if before is None:
+            deltas[after[1]]['new_subscriptions'] += 1
+        # Created already cancelled (deleted before created): counted as a same-day signup and churn,
+        # like rebuild_rollups() does
+        if after[0] in CHURNED_STATUSES and (before is None or before[0] in MRR_STATUSES):
+            deltas[after[1]]['cancellations'] += 1
+    day = _day(occurred_at)
+    for plan_tier, values in deltas.items():
+        add_to_rollup(day, 'subscription', plan_tier, **values)
+
+
+# -------------------------------------------------------------------
+# QUERIES (rollups only)
+# -------------------------------------------------------------------
+
+def _subscriptions_as_of(day):
+    """MRR, active and past_due subscriptions per plan tier at the end of `day`"""
+    rows = db.session.query(
+        DailyRollup.plan_tier,
+        func.sum(DailyRollup.mrr_delta), func.sum(DailyRollup.active_delta), func.sum(DailyRollup.past_due_delta)
+    ).filter(
+        DailyRollup.payment_type == 'subscription',
+        DailyRollup.day <= day
+    ).group_by(DailyRollup.plan_tier).all()
+    return {
+        plan_tier: {'mrr': Decimal(mrr or 0), 'active': int(active or 0), 'past_due': int(past_due or 0)}
+        for plan_tier, mrr, active, past_due in rows
+    }
+
+
+def analytics_summary(start, end):
+    """
+    Revenue per day, MRR and past_due per plan tier (at the end of `end`) and
+    churn between `start` and `end` (dates, inclusive), as a JSON-ready dict
+    """
+    revenue_rows = db.session.query(
+        DailyRollup.day, DailyRollup.payment_type, func.sum(DailyRollup.revenue), func.sum(DailyRollup.payments)
+    ).filter(
+        DailyRollup.day >= start, DailyRollup.day <= end,
+        or_(DailyRollup.payments != 0, DailyRollup.revenue != 0)
+    ).group_by(DailyRollup.day, DailyRollup.payment_type).order_by(DailyRollup.day, DailyRollup.payment_type).all()
+
+    flows = db.session.query(
+        DailyRollup.plan_tier, func.sum(DailyRollup.new_subscriptions), func.sum(DailyRollup.cancellations),
+        func.sum(DailyRollup.revenue)
+    ).filter(
+        DailyRollup.payment_type == 'subscription',
+        DailyRollup.day >= start, DailyRollup.day <= end
+    ).group_by(DailyRollup.plan_tier).all()
+    flows = {plan_tier: (int(new or 0), int(cancelled or 0), Decimal(revenue or 0))
+             for plan_tier, new, cancelled, revenue in flows}
+
+    at_start = _subscriptions_as_of(start - timedelta(days=1))
+    at_end = _subscriptions_as_of(end)
+    subscribers_at_start = sum(tier['active'] + tier['past_due'] for tier in at_start.values())
+    cancellations = sum(cancelled for _, cancelled, _ in flows.values())
+
+    by_plan_tier = {}
+    for plan_tier in sorted(set(at_end) | set(flows)):
+        now = at_end.get(plan_tier, {'mrr': Decimal(0), 'active': 0, 'past_due': 0})
+        new, cancelled, revenue = flows.get(plan_tier, (0, 0, Decimal(0)))
+        by_plan_tier[plan_tier or 'none'] = {
+            'mrr': str(now['mrr']), 'active': now['active'], 'past_due': now['past_due'],
+            'new_subscriptions': new, 'cancellations': cancelled, 'revenue': str(revenue),
+        }
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'revenue': {
+            'total': str(sum((Decimal(row[2] or 0) for row in revenue_rows), Decimal(0))),
+            'payments': sum(int(row[3] or 0) for row in revenue_rows),
+            'by_day': [
+                {'day': _as_date(day).isoformat(), 'payment_type': payment_type,
+                 'revenue': str(Decimal(revenue or 0)), 'payments': int(payments or 0)}
+                for day, payment_type, revenue, payments in revenue_rows
+            ],
+        },
+        'mrr': str(sum((tier['mrr'] for tier in at_end.values()), Decimal(0))),
+        'past_due': sum(tier['past_due'] for tier in at_end.values()),
+        'churn': {
+            'cancellations': cancellations,
+            'subscribers_at_start': subscribers_at_start,
+            'rate': round(cancellations / subscribers_at_start, 4) if subscribers_at_start else None,
+        },
+        'by_plan_tier': by_plan_tier,
+    }
+
+
+def _as_date(value):
+    """func.date() comes back as an ISO string from SQLite and as a date from PostgreSQL"""
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+# -------------------------------------------------------------------
+# REBUILD (from the payments and subscriptions tables)
+# -------------------------------------------------------------------
+
+def _payment_plan_tier():
+    """Plan tier of a payment's subscription ('' for one-time payments), for queries joined with _with_plan_tier"""
+    return func.coalesce(Subscription.plan_tier, '')
+
+
+def _with_plan_tier(query):
+    return query.outerjoin(Subscription, Payment.subscription_id == Subscription.id)
+
+
+def _payment_buckets_sql():
+    """{(day, payment_type, plan_tier): [revenue, payments]}, aggregated by the database"""
+    day = func.date(Payment.created_at)
+    plan_tier = _payment_plan_tier()
+    rows = _with_plan_tier(db.session.query(
+        day, Payment.payment_type, plan_tier, func.sum(Payment.amount), func.count(Payment.id)
+    )).filter(Payment.status == 'completed').group_by(day, Payment.payment_type, plan_tier)
+    return {(_as_date(row[0]), row[1], row[2]): [Decimal(row[3] or 0), row[4]] for row in rows}
+
+
+def _payment_buckets_numpy(chunk_size):
+    """
+    {(day, payment_type, plan_tier): [revenue, payments]}, aggregated in NumPy
+
+    Payments are streamed as four columns (day, type, plan tier, amount in cents) in
+    chunks of `chunk_size`; each chunk is grouped with np.unique and
+    np.bincount instead of a Python loop per row. The database only scans, so
+    the grouping work moves off a busy database server onto this process.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        raise RuntimeError('The numpy rebuild needs numpy: pip install -r requirements-analytics.txt')
+
+    totals = {}
+    query = _with_plan_tier(select(
+        func.date(Payment.created_at), Payment.payment_type, _payment_plan_tier(),
+        cast(func.round(Payment.amount * 100), Integer)
+    ).select_from(Payment)).where(Payment.status == 'completed')
+    # Plain DB-API cursor: SQLAlchemy's per-row result objects would cost more than the aggregation
+    connection = db.session.connection()
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(str(query.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            days, payment_types, plan_tiers, cents = zip(*rows)
+            days = np.array(days, dtype='datetime64[D]').astype(np.int64)
+            type_names, type_codes = np.unique(np.array(payment_types, dtype=str), return_inverse=True)
+            tier_names, tier_codes = np.unique(np.array(plan_tiers, dtype=str), return_inverse=True)
+            labels = len(type_names) * len(tier_names)
+            keys, groups = np.unique(days * labels + type_codes * len(tier_names) + tier_codes, return_inverse=True)
+            sums = np.bincount(groups, weights=np.array(cents, dtype=np.float64))  # exact below 2**53 cents
+            counts = np.bincount(groups)
+            for key, cents_total, count in zip(keys.tolist(), sums.tolist(), counts.tolist()):
+                day, label = divmod(key, labels)
+                type_code, tier_code = divmod(label, len(tier_names))
+                bucket = totals.setdefault(
+                    (date(1970, 1, 1) + timedelta(days=day), str(type_names[type_code]), str(tier_names[tier_code])),
+                    [0, 0]
+                )
+                bucket[0] += round(cents_total)
+                bucket[1] += count
+    finally:
+        cursor.close()
+    return {key: [Decimal(cents) / 100, count] for key, (cents, count) in totals.items()}
+
+
+def _subscription_buckets():
+    """
+    {(day, plan_tier): {counter: delta}}, aggregated by the database
+
+    Only the current row of each subscription is known, so its history is
+    rebuilt as: counted from created_at with its current amount and tier,
+    moved to past_due at its last update if it is past_due now, and removed
+    at cancelled_at if it is cancelled now.
+    """
+    buckets = defaultdict(lambda: defaultdict(int))
+    counted = Subscription.status.in_(MRR_STATUSES + CHURNED_STATUSES)
+
+    created_day = func.date(Subscription.created_at)
+    for day, plan_tier, new, counted_new, mrr in db.session.query(
+        created_day, Subscription.plan_tier, func.count(Subscription.id),
+        func.sum(case((counted, 1), else_=0)), func.sum(case((counted, Subscription.amount), else_=0))
+    ).group_by(created_day, Subscription.plan_tier):
+        bucket = buckets[(_as_date(day), plan_tier or '')]
+        bucket['new_subscriptions'] += new
+        bucket['active_delta'] += int(counted_new or 0)
+        bucket['mrr_delta'] += Decimal(mrr or 0)
+
+    churned_day = func.date(func.coalesce(Subscription.cancelled_at, Subscription.updated_at, Subscription.created_at))
+    for day, plan_tier, cancelled, mrr in db.session.query(
+        churned_day, Subscription.plan_tier, func.count(Subscription.id), func.sum(Subscription.amount)
+    ).filter(Subscription.status.in_(CHURNED_STATUSES)).group_by(churned_day, Subscription.plan_tier):
+        bucket = buckets[(_as_date(day), plan_tier or '')]
+        bucket['cancellations'] += cancelled
+        bucket['active_delta'] -= cancelled
+        bucket['mrr_delta'] -= Decimal(mrr or 0)
+
+    past_due_day = func.date(func.coalesce(Subscription.updated_at, Subscription.created_at))
+    for day, plan_tier, past_due in db.session.query(
+        past_due_day, Subscription.plan_tier, func.count(Subscription.id)
+    ).filter(Subscription.status == 'past_due').group_by(past_due_day, Subscription.plan_tier):
+        bucket = buckets[(_as_date(day), plan_tier or '')]
+        bucket['active_delta'] -= past_due
+        bucket['past_due_delta'] += past_due
+    return buckets
+
+
+def rebuild_rollups(engine='sql', chunk_size=500000):
+    """
+    Recompute all rollups from the payments and subscriptions tables and
+    replace the table's contents in one transaction
+
+    `engine` picks how payments are aggregated: 'sql' (GROUP BY in the
+    database) or 'numpy' (streamed columns, vectorized grouping). Events
+    applied while a rebuild runs may be missed, so pause webhook processing
+    for it. Returns a summary dict.
+    """
+    started = time.perf_counter()
+    if engine == 'numpy':
+        payment_buckets = _payment_buckets_numpy(chunk_size)
+    elif engine == 'sql':
+        payment_buckets = _payment_buckets_sql()
+    else:
+        raise ValueError(f'Unknown rebuild engine: {engine}')
+    subscription_buckets = _subscription_buckets()
+
+    # Every counter of a bucket is set (one executemany needs uniform rows)
+    buckets = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+    for (day, payment_type, plan_tier), (revenue, count) in payment_buckets.items():
+        bucket = buckets[(day, payment_type, plan_tier)]
+        bucket['revenue'] += revenue
+        bucket['payments'] += count
+    for (day, plan_tier), counters in subscription_buckets.items():
+        bucket = buckets[(day, 'subscription', plan_tier)]
+        for name, value in counters.items():
+            bucket[name] += value
+    rows = [
+        {'day': day, 'payment_type': payment_type, 'plan_tier': plan_tier, **counters}
+        for (day, payment_type, plan_tier), counters in buckets.items()
+    ]
+
+    DailyRollup.query.delete()
+    if rows:
+        db.session.execute(DailyRollup.__table__.insert(), rows)
+    db.session.commit()
+    seconds = time.perf_counter() - started
+    payments = sum(count for _, count in payment_buckets.values())
+    logger.info('Rebuilt %s rollup rows from %s payments in %.1fs (%s)', len(rows), payments, seconds, engine)
+    return {'rows': len(rows), 'payments': payments, 'seconds': seconds,
+            'payments_per_second': payments / seconds if seconds else 0.0}
@@ -0,0 +1,212 @@
+import hashlib
+import hmac
+from datetime import date, datetime, timedelta, timezone
+
+from flask import Blueprint, current_app, jsonify, request
+from sqlalchemy import func
+
+from analytics import analytics_summary
+from models import db, User, Payment, Subscription
+from queries import PAGE_SIZE, before_cursor, encode_cursor
+from read_replicas import read_from_replica
+
+
+api_bp = Blueprint('api', __name__, url_prefix='/api')
+
+MAX_PAGE_SIZE = 100
+ANALYTICS_DEFAULT_DAYS = 30
+
+
+# -------------------------------------------------------------------
+# HELPERS
+# -------------------------------------------------------------------
+
+def _page_size():
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        limit = PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _isoformat(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+def _not_modified(etag, last_modified):
+    """True if the client's cached copy (If-None-Match / If-Modified-Since) is still current"""
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if request.if_modified_since and last_modified:
+        # HTTP dates have one-second precision
+        newest = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+        return newest <= request.if_modified_since
+    return False
+
+
+def _conditional_json(validator, last_modified, build_body):
+    """
+    Answer with 304 when the newest row hasn't changed, otherwise with the JSON body
+
+    `validator` describes the newest row plus the request parameters, so it is
+    cheap to compute (one indexed query) and the page itself is only loaded
+    when the client really needs it.
+    """
+    etag = hashlib.sha1(repr((validator, sorted(request.args.items()))).encode()).hexdigest()
+    if _not_modified(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build_body())
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # always revalidate with the ETag
+    return response
+
+
+def _date_arg(name, default):
+    """A YYYY-MM-DD query parameter; raises ValueError if malformed"""
+    value = request.args.get(name)
+    return date.fromisoformat(value) if value else default
+
+
+def _user_or_404(user_id):
+    if not db.session.query(User.id).filter_by(id=user_id).first():
+        return jsonify({'error': 'User not found'}), 404
+    return None
+
+
+# -------------------------------------------------------------------
+# ENDPOINTS
+# -------------------------------------------------------------------
+
+@api_bp.before_request
+def _require_api_key():
+    # Every endpoint exposes users' payment data, so callers (e.g. the backend
+    # of a signed-in user) send one of API_KEYS: `Authorization: Bearer <key>`
+    auth = request.authorization
+    token = auth.token if auth and auth.type == 'bearer' and auth.token else ''
+    if not any(hmac.compare_digest(token.encode(), key.encode()) for key in current_app.config.get('API_KEYS', ())):
+        return jsonify({'error': 'Authentication required'}), 401, {'WWW-Authenticate': 'Bearer'}
+    return None
+
+
+@api_bp.before_request
+def _read_from_replica():
+    # The API only reads; a client that just checked out still reads the primary
+    read_from_replica()
+
+
+@api_bp.route('/users/<int:user_id>/payments')
+def user_payments(user_id):
+    """A user's payments, newest first (?payment_type=one_time&cursor=...&limit=25)"""
+    not_found = _user_or_404(user_id)
+    if not_found:
+        return not_found
+
+    payment_type = request.args.get('payment_type')
+    limit = _page_size()
+
+    filters = [Payment.user_id == user_id]
+    if payment_type:
+        filters.append(Payment.payment_type == payment_type)
+
+    # Payments also change in place (`flask reconcile --repair` fixes amount and
+    # status), so like subscriptions the validator uses the latest update too
+    newest = db.session.query(
+        func.max(Payment.id),
+        func.max(func.coalesce(Payment.updated_at, Payment.created_at)),
+        func.count(Payment.id)
+    ).filter(*filters).one()
+    last_modified = newest[1]
+
+    def build_body():
+        # Column-only query: rows are plain tuples, no ORM objects are built
+        query = db.session.query(
+            Payment.id, Payment.amount, Payment.payment_type, Payment.status,
+            Payment.transaction_id, Payment.created_at
+        ).filter(*filters)
+        query = before_cursor(query, Payment.created_at, Payment.id, request.args.get('cursor'))
+        rows = query.order_by(Payment.created_at.desc(), Payment.id.desc()).limit(limit + 1).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+        return {
+            'data': [{
+                'id': row.id,
+                'amount': str(row.amount),
+                'payment_type': row.payment_type,
+                'status': row.status,
+                'transaction_id': row.transaction_id,
+                'created_at': _isoformat(row.created_at),
+            } for row in rows],
+            'next_cursor': next_cursor,
+        }
+
+    return _conditional_json(tuple(newest), last_modified, build_body)
+
+
+@api_bp.route('/users/<int:user_id>/subscriptions')
+def user_subscriptions(user_id):
+    """A user's subscriptions, newest first (?cursor=...&limit=25)"""
+    not_found = _user_or_404(user_id)
+    if not_found:
+        return not_found
+
+    limit = _page_size()
+
+    # Subscriptions change in place, so the validator uses the latest update too
+    newest = db.session.query(
+        func.max(Subscription.id),
+        func.max(func.coalesce(Subscription.updated_at, Subscription.created_at)),
+        func.count(Subscription.id)
+    ).filter(Subscription.user_id == user_id).one()
+    last_modified = newest[1]
+
+    def build_body():
+        query = db.session.query(
+            Subscription.id, Subscription.amount, Subscription.status, Subscription.plan_tier,
+            Subscription.stripe_subscription_id, Subscription.stripe_price_id,
+            Subscription.start_date, Subscription.next_billing_date, Subscription.cancelled_at,
+            Subscription.created_at
+        ).filter(Subscription.user_id == user_id)
+        query = before_cursor(query, Subscription.created_at, Subscription.id, request.args.get('cursor'))
+        rows = query.order_by(Subscription.created_at.desc(), Subscription.id.desc()).limit(limit + 1).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+        return {
+            'data': [{
+                'id': row.id,
+                'amount': str(row.amount),
+                'status': row.status,
+                'plan_tier': row.plan_tier,
+                'stripe_subscription_id': row.stripe_subscription_id,
+                'stripe_price_id': row.stripe_price_id,
+                'start_date': _isoformat(row.start_date),
+                'next_billing_date': _isoformat(row.next_billing_date),
+                'cancelled_at': _isoformat(row.cancelled_at),
+                'created_at': _isoformat(row.created_at),
+            } for row in rows],
+            'next_cursor': next_cursor,
+        }
+
+    return _conditional_json(tuple(newest), last_modified, build_body)
+
+
+@api_bp.route('/analytics')
+def analytics():
+    """Revenue, MRR, churn and past_due from the daily rollups (?start=YYYY-MM-DD&end=YYYY-MM-DD, UTC)"""
+    try:
+        end = _date_arg('end', datetime.utcnow().date())
+        start = _date_arg('start', end - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1))
+    except ValueError:
+        return jsonify({'error': 'start and end must be dates (YYYY-MM-DD)'}), 400
+    if start > end:
+        return jsonify({'error': 'start must not be after end'}), 400
+    return jsonify(analytics_summary(start, end))
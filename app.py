@@ -1,126 +1,367 @@
-from flask import current_app, Flask, jsonify, json, render_template, request, redirect, session, url_for, flash
-from datetime import datetime, timedelta
-from dotenv import load_dotenv
+from flask import current_app, Blueprint, Flask, jsonify, json, render_template, request, redirect, session, url_for, flash, Response, stream_template
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import click
+import hashlib
+import logging
 import os
+import time
 
-# -------Stripe incorporation-------
-import stripe
-# -------END OF Stripe incorporation-------
+from sqlalchemy import or_
+from werkzeug.local import LocalProxy
 
-# Load environment variables from .env file
-load_dotenv()
+# Settings are parsed and validated once, in create_app() (see settings.py)
+from settings import load_settings
 
-# Import db from models.py
-from models import db, User, Payment, Subscription
+# Structured logging through a background writer thread (LOG_FORMAT=text for plain lines)
+from structured_logging import configure_logging, log_context
+logger = logging.getLogger(__name__)
 
+# Import db from models.py
+from models import db, commit, User, Payment, Subscription
 # -------Stripe incorporation-------
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-stripe.api_version = '2025-10-29.clover'
+# The Stripe SDK itself is only imported on first use (see stripe_client.py)
+from stripe_client import STRIPE_API_VERSION, StripeGateway, stripe
 # -------END OF Stripe incorporation-------
+from price_catalog import PriceCatalog, PlanTierIndex, RenderedPageCache
+from event_queue import WebhookWorkerPool, enqueue_event, queue_depth_by_status, requeue_dead_events
+from event_batching import invoice_subscription_id, ordering_key_for
+from event_ledger import claim_event, record_event_processed, release_event
+from user_lookup import CustomerDirectory, UserDirectory
+from webhook_dispatch import HandlerRegistry, WebhookVerifier
+from worker_sharding import ShardMembership, WorkerSupervisor, default_worker_id
+from migrations import upgrade_schema
+from queries import PaymentPage, payment_totals
+from read_replicas import read_from_replica, replica_binds, replica_reads, stick_to_primary, sync_sqlite_replicas
+from api import api_bp
+from backfill import iter_jsonl_events, iter_stripe_events, load_checkpoint, parse_timestamp, resume_from, run_backfill
+from renewal_scheduler import RenewalScheduler
+from analytics import (
+    analytics_summary, rebuild_rollups, record_payment, record_subscription_change, subscription_state
+)
+from export import EXPORT_TABLES, FORMATS, export_tables
+from reconciliation import CheckoutSessionSource, Reconciler, SubscriptionSource, load_checkpoint as load_reconciliation_checkpoint
+from metrics import (
+    registry, instrument_flask, instrument_sqlalchemy, timed, Gauge,
+    ERRORS, PAGE_CACHE_REQUESTS, SUBSCRIPTION_RECONCILIATIONS, WEBHOOK_EVENTS, WEBHOOK_EVENT_SECONDS, WEBHOOK_HANDLER_SECONDS
+)
+
+# Pages, the webhook endpoint and the `flask ...` commands (cli_group=None keeps
+# the commands at the top level). Registered on the app in create_app().
+main_bp = Blueprint('main', __name__, cli_group=None)
+
+# The parsed settings and the services create_app() builds from them, kept
+# per app in app.extensions['payments'], so two apps (e.g. in tests) don't share them
+Services = namedtuple('Services', [
+    'settings', 'stripe_api', 'price_catalog', 'pricing_pages', 'plan_tiers', 'user_directory',
+    'customer_directory', 'webhook_verifier', 'webhook_workers', 'renewal_scheduler'
+])
+
+def services(app=None):
+    """The Services of `app` (default: current_app)"""
+    return (app or current_app).extensions['payments']
+
+# The current app's services, for the routes, handlers and commands below
+settings = LocalProxy(lambda: services().settings)
+stripe_api = LocalProxy(lambda: services().stripe_api)
+price_catalog = LocalProxy(lambda: services().price_catalog)
+pricing_pages = LocalProxy(lambda: services().pricing_pages)
+plan_tiers = LocalProxy(lambda: services().plan_tiers)
+user_directory = LocalProxy(lambda: services().user_directory)
+customer_directory = LocalProxy(lambda: services().customer_directory)
+webhook_verifier = LocalProxy(lambda: services().webhook_verifier)
+webhook_workers = LocalProxy(lambda: services().webhook_workers)
+renewal_scheduler = LocalProxy(lambda: services().renewal_scheduler)
+
+# Event type -> handle_* function, filled by the @webhook_handlers.on(...) decorators in SECTION 4
+webhook_handlers = HandlerRegistry()
+
+def create_app(app_settings=None):
+    """
+    Build the Flask app and its services from `app_settings` (default: load_settings())
+
+    Each call returns a new app with its own services (see services()).
+    Nothing here calls Stripe or imports the Stripe SDK; the price catalog is
+    warmed in a background thread, so the app can serve requests right away.
+    """
+    settings = app_settings or load_settings()
+    configure_logging(settings.log_level, settings.log_format)
+    for warning in settings.warnings():
+        logger.warning('Configuration: %s', warning)
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///payment_prototype.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = settings.secret_key
+    app.config['SQLALCHEMY_DATABASE_URI'] = settings.database_url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Read replicas (DATABASE_REPLICA_URLS) for the dashboard, the JSON API and reporting
+    app.config['SQLALCHEMY_BINDS'] = replica_binds(settings.database_replica_urls)
+    app.config['REPLICA_STICKY_SECONDS'] = settings.replica_sticky_seconds
+    app.config['API_KEYS'] = settings.api_keys
 
-# Initialize db with app
-db.init_app(app)
+    # Initialize db with app
+    db.init_app(app)
+
+    app.register_blueprint(main_bp)
+    # JSON API (/api/users/<id>/payments, /api/users/<id>/subscriptions)
+    app.register_blueprint(api_bp)
+
+    # Latency histograms for every route and SQL statement, exported on /metrics
+    instrument_flask(app)
+    instrument_sqlalchemy()
+
+    # -------Stripe incorporation-------
+    # Every Stripe API call goes through this client: pooled connections,
+    # timeouts, retries with jitter and per-endpoint latency counters.
+    # STRIPE_API_BASE points it at a local fake Stripe server for testing.
+    stripe_api = StripeGateway(
+        settings.stripe_secret_key,
+        api_version=STRIPE_API_VERSION,
+        api_base=settings.stripe_api_base,
+        timeout=settings.stripe_timeout_seconds,
+        max_retries=settings.stripe_max_retries,
+        pool_size=settings.stripe_pool_size
+    )
+
+    # Prices change rarely, so keep them in memory instead of calling
+    # the Stripe API on every page view and webhook
+    price_catalog = PriceCatalog(
+        stripe_api.retrieve_price,
+        ttl=settings.price_catalog_ttl,
+        max_size=settings.price_catalog_max_size
+    )
+
+    # The pricing pages, rendered once per price catalog version (see pricing_page())
+    pricing_pages = RenderedPageCache(f'public, max-age={settings.pricing_page_max_age}')
+
+    # Plan tier <-> price ID, so neither checkout nor the subscription webhooks
+    # need a Stripe call to work out which tier a price belongs to
+    plan_tiers = PlanTierIndex(price_catalog, settings.plan_tier_prices)
+
+    # Email / user ID -> user for checkout, success pages and the dashboard,
+    # so one purchase doesn't look up the same user in every request
+    user_directory = UserDirectory(ttl=settings.user_cache_ttl, max_size=settings.user_cache_size)
+
+    # Stripe customer ID -> local user, resolved without calling Stripe once the
+    # customer ID is stored on the user (see handle_checkout_completed)
+    customer_directory = CustomerDirectory(
+        stripe_api.retrieve_customer,
+        max_size=settings.customer_cache_size,
+        users=user_directory
+    )
 
-@app.route('/')
+    # Warm the catalog in the background so neither startup nor the first
+    # page view waits on Stripe (this thread also pays for importing the SDK)
+    if settings.stripe_secret_key:
+        price_catalog.warm_in_background(settings.price_ids)
+    # -------END OF Stripe incorporation-------
+
+    # Signing secret(s) of the webhook endpoint. While rolling the secret in the
+    # Stripe Dashboard, list the new and the old one: STRIPE_WEBHOOK_SECRET=whsec_new,whsec_old
+    webhook_verifier = WebhookVerifier(settings.stripe_webhook_secret)
+
+    # Webhook processing mode:
+    # WEBHOOK_ASYNC=true stores verified events in the webhook_events table and returns 200 immediately.
+    # Events are then processed by these background workers, in this process unless
+    # WEBHOOK_WORKERS_IN_PROCESS=false (run `flask webhook-worker` separately instead)
+    webhook_workers = WebhookWorkerPool(
+        app,
+        process_event,
+        concurrency=settings.webhook_workers,
+        max_attempts=settings.webhook_max_attempts,
+        retry_base_seconds=settings.webhook_retry_base_seconds,
+        # WEBHOOK_BATCH_SIZE > 1: apply up to that many queued events per transaction,
+        # waiting WEBHOOK_BATCH_WINDOW_MS for events that arrive back-to-back
+        batch_size=settings.webhook_batch_size,
+        batch_window_ms=settings.webhook_batch_window_ms
+    )
+
+    # Safety net for missed webhooks: once a subscription's billing date has passed
+    # (plus a grace period for Stripe's own renewal webhooks), check it against
+    # Stripe and flag any difference in Subscription.discrepancy.
+    # RENEWAL_SCHEDULER=true runs it in this process (or run `flask renewal-scheduler`)
+    renewal_scheduler = RenewalScheduler(
+        app,
+        stripe_api.retrieve_subscription,
+        subscription_snapshot,
+        grace_seconds=settings.renewal_grace_seconds,
+        recheck_seconds=settings.renewal_recheck_seconds,
+        batch_size=settings.renewal_batch_size,
+        calls_per_second=settings.renewal_stripe_calls_per_second
+    )
+
+    app.extensions['payments'] = Services(
+        settings, stripe_api, price_catalog, pricing_pages, plan_tiers, user_directory,
+        customer_directory, webhook_verifier, webhook_workers, renewal_scheduler
+    )
+    return app
+
+def configured_price_ids():
+    """Price IDs referenced by the checkout pages (set in .env)"""
+    return settings.price_ids
+
+@main_bp.cli.command('db-upgrade')
+@click.option('--dry-run', is_flag=True, help='Only print the statements that would run')
+def db_upgrade_command(dry_run):
+    """Create missing tables, columns and indexes"""
+    changes = upgrade_schema(dry_run=dry_run)
+    for change in changes:
+        click.echo(change)
+    click.echo(f'{len(changes)} schema change(s) {"pending" if dry_run else "applied"}')
+
+@main_bp.cli.command('replica-sync')
+@click.option('--every', default=0.0, help='Repeat every this many seconds until interrupted (simulated replication lag)')
+def replica_sync_command(every):
+    """Copy a SQLite primary into the SQLite read replicas (local testing)"""
+    while True:
+        paths = sync_sqlite_replicas(db)
+        for path in paths:
+            click.echo(f'Synced {path}')
+        if not paths:
+            click.echo('No SQLite replicas configured (DATABASE_REPLICA_URLS)')
+            return
+        if not every:
+            return
+        try:
+            time.sleep(every)
+        except KeyboardInterrupt:
+            return
+
+@main_bp.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/payment/one-time', methods=['GET'])
+def _has_flashed_messages():
+    # Without a session cookie there can't be any; checking the session anyway
+    # would add `Vary: Cookie` and keep shared caches from storing the page
+    if current_app.config['SESSION_COOKIE_NAME'] not in request.cookies:
+        return False
+    return '_flashes' in session
+
+def pricing_page(template, version, **context):
+    """
+    Serve a pricing page from the rendered-page cache (rendering it once per catalog version)
+
+    The pages only show settings and catalog prices, so browsers and CDNs may
+    keep them for PRICING_PAGE_MAX_AGE seconds and revalidate with the ETag.
+    A page with a flashed message (e.g. after a form error) is rendered as usual.
+    """
+    if _has_flashed_messages():
+        PAGE_CACHE_REQUESTS.inc(page=template, outcome='bypass')
+        return render_template(template, **context)
+    page = pricing_pages.get(template, version, lambda: render_template(template, **context))
+    # Prebuilt headers: setting them through response.cache_control / make_conditional()
+    # would take as long as rendering the page
+    if request.if_none_match and page.etag in request.if_none_match:
+        return Response(status=304, headers=page.headers)
+    return Response(page.body, headers=page.headers)
+
+@main_bp.route('/payment/one-time', methods=['GET'])
 def one_time_payment():
     """Show the one-time payment form with embedded Stripe Checkout"""
     # -------Stripe incorporation-------
-    # Get publishable key from environment for frontend
-    stripe_publishable_key = os.environ.get('STRIPE_PUBLISHABLE_KEY', '')
+    # Read before the prices, see RenderedPageCache.get()
+    version = price_catalog.version
+
+    # Get publishable key from settings for frontend
+    stripe_publishable_key = settings.stripe_publishable_key
     
-    # Fetch price info from Stripe (optional - for display purposes)
-    price_id = os.environ.get('STRIPE_PRICE_ID_ONE_TIME')
-    price_info = None
-    if price_id:
-        try:
-            price = stripe.Price.retrieve(price_id)
-            # Convert amount from cents to dollars
-            price_info = {
-                'amount': price.unit_amount / 100,
-                'currency': price.currency.upper()
-            }
-        except:
-            pass  # If price fetch fails, just don't show price
+    # Price info comes from the in-process catalog (no Stripe call once warmed).
+    # Looked up even when the page is cached, so expired prices still get refreshed
+    price_id = settings.price_id_one_time
+    price_info = price_catalog.get(price_id) if price_id else None
     # -------END OF Stripe incorporation-------
-    return render_template('one_time_payment.html', 
-                         stripe_publishable_key=stripe_publishable_key,
-                         price_info=price_info)
+    return pricing_page('one_time_payment.html', version,
+                        stripe_publishable_key=stripe_publishable_key,
+                        price_info=price_info)
 
-@app.route('/payment/subscribe', methods=['GET'])
+@main_bp.route('/payment/subscribe', methods=['GET'])
 def subscribe():
     """Show the subscription form with multiple tier options"""
     # -------Stripe incorporation-------
-    # Get publishable key from environment for frontend
-    stripe_publishable_key = os.environ.get('STRIPE_PUBLISHABLE_KEY', '')
-    
-    # Fetch price info for both tiers from Stripe
-    one_price_id = os.environ.get('STRIPE_PRICE_ID_SUBS_ONE')
-    two_price_id = os.environ.get('STRIPE_PRICE_ID_SUBS_TWO')
-    
-    one_price_info = None
-    two_price_info = None
+    # Read before the prices, see RenderedPageCache.get()
+    version = price_catalog.version
+
+    # Get publishable key from settings for frontend
+    stripe_publishable_key = settings.stripe_publishable_key
     
-    if one_price_id:
-        try:
-            price = stripe.Price.retrieve(one_price_id)
-            one_price_info = {
-                'amount': price.unit_amount / 100,
-                'currency': price.currency.upper(),
-                'price_id': one_price_id
-            }
-        except:
-            pass
+    # Price info for both tiers comes from the in-process catalog
+    one_price_id = settings.price_id_subs_one
+    two_price_id = settings.price_id_subs_two
     
-    if two_price_id:
-        try:
-            price = stripe.Price.retrieve(two_price_id)
-            two_price_info = {
-                'amount': price.unit_amount / 100,
-                'currency': price.currency.upper(),
-                'price_id': two_price_id
-            }
-        except:
-            pass
+    one_price_info = price_catalog.get(one_price_id) if one_price_id else None
+    two_price_info = price_catalog.get(two_price_id) if two_price_id else None
     # -------END OF Stripe incorporation-------
     
-    return render_template('subscribe.html', 
-                         stripe_publishable_key=stripe_publishable_key,
-                         one_price_info=one_price_info,
-                         two_price_info=two_price_info)
+    return pricing_page('subscribe.html', version,
+                        stripe_publishable_key=stripe_publishable_key,
+                        one_price_info=one_price_info,
+                        two_price_info=two_price_info)
 
-@app.route('/dashboard')
+@main_bp.route('/dashboard')
+@replica_reads
 def dashboard():
     email = request.args.get('email')
     if not email:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
-    user = User.query.filter_by(email=email).first()
+    user = user_directory.by_email(email)
     if not user:
         flash('User not found', 'error')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
-    payments = Payment.query.filter_by(user_id=user.id).all()
-    subscriptions = Subscription.query.filter_by(user_id=user.id).all()
+    # Only one page of payments is read (keyset pagination, filtered in SQL),
+    # and totals are computed by the database instead of from loaded rows
+    cursor = request.args.get('before')
+    payments = PaymentPage(user.id, payment_type='one_time', cursor=cursor)
+    totals = payment_totals(user.id, payment_type='one_time')
+    subscriptions = Subscription.query.filter_by(user_id=user.id).order_by(
+        Subscription.created_at.desc()
+    ).all()
     
-    return render_template('dashboard.html', user=user, payments=payments, subscriptions=subscriptions)
+    # Stream the page so rows are rendered as they are read from the database
+    return Response(stream_template(
+        'dashboard.html', user=user, payments=payments, totals=totals,
+        subscriptions=subscriptions, cursor=cursor
+    ))
 
 # ===================================================================
 # Stripe Incorporaiton
 # ===================================================================
 
+def checkout_customer_params(user):
+    """
+    Reuse the user's Stripe customer when we already know it
+
+    Passing customer_email makes Checkout create a new Customer every time, so
+    only new users get one; the resulting customer ID is stored by the webhook.
+    """
+    if user.stripe_customer_id:
+        return {'customer': user.stripe_customer_id}
+    return {'customer_email': user.email}
+
+def checkout_idempotency_key(params, nonce):
+    """
+    Idempotency key of a checkout: the same session parameters and form submission get the same session
+
+    The payment forms send a random `checkout_nonce`, made once per page load
+    in the browser (the pages themselves are cached and shared), so a double
+    click or a resubmitted form returns the Checkout Session already created.
+    The key also covers a hash of the parameters (user, price, `customer` or
+    `customer_email`, ...): Stripe rejects a key reused with other parameters,
+    e.g. when the webhook linked the user's customer between two submits.
+    Without a usable nonce returns None: the gateway then uses a key per
+    call, which only covers its own retries.
+    """
+    if not nonce or len(nonce) > 64 or not (nonce.isascii() and nonce.isalnum()):
+        return None
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:32]
+    return f'checkout-{digest}-{nonce}'
+
 # -------------------------------------------------------------------
 # SECTION 1: CHECKOUT SESSION - ONE-TIME PAYMENT
 # -------------------------------------------------------------------
-@app.route('/create-checkout-session', methods=['POST'])
+@main_bp.route('/create-checkout-session', methods=['POST'])
 def create_checkout_session():
     """Create a Stripe Checkout Session for one-time payment"""
     try:
@@ -129,33 +370,31 @@ def create_checkout_session():
         
         if not email or not name:
             flash('Please fill in all fields', 'error')
-            return redirect(url_for('one_time_payment'))
+            return redirect(url_for('main.one_time_payment'))
         
         # Check if user exists, create if not
-        user = User.query.filter_by(email=email).first()
-        if not user:
-            user = User(email=email, name=name)
-            db.session.add(user)
-            db.session.commit()
+        user = user_directory.get_or_create(email, name)
+        # The payment shows up on the primary first; keep this client's dashboard there
+        stick_to_primary()
                 
         # Get the base URL for return URL
         # request.host_url gives us the full URL (e.g., "http://localhost:5000/")
         # rstrip('/') removes trailing slash to avoid double slashes
         base_url = request.host_url.rstrip('/')
         
-        # Get Price ID from environment variable (set in .env file)
-        price_id = os.environ.get('STRIPE_PRICE_ID_ONE_TIME')
+        # Get Price ID from settings (STRIPE_PRICE_ID_ONE_TIME in .env file)
+        price_id = settings.price_id_one_time
         
         if not price_id:
             flash('Price ID not configured. Please set STRIPE_PRICE_ID_ONE_TIME in .env', 'error')
-            return redirect(url_for('one_time_payment'))
+            return redirect(url_for('main.one_time_payment'))
         
         # Create Stripe Checkout Session in EMBEDDED mode
         # ui_mode='embedded' keeps user on your site
         # Returns clientSecret for frontend to embed checkout
-        checkout_session = stripe.checkout.Session.create(
+        params = dict(
             ui_mode='embedded',  
-            customer_email=email,
+            **checkout_customer_params(user),
             line_items=[{
                 'price': price_id,  
                 'quantity': 1,
@@ -169,6 +408,9 @@ def create_checkout_session():
                 'payment_type': 'one_time' # Store payment type for verification
             }
         )
+        checkout_session = stripe_api.create_checkout_session(
+            params, idempotency_key=checkout_idempotency_key(params, request.form.get('checkout_nonce'))
+        )
         
         # Return clientSecret for frontend to embed checkout
         # User stays on your site - checkout appears in an embedded container!
@@ -184,28 +426,25 @@ def create_checkout_session():
 # -------------------------------------------------------------------
 # SECTION 2: CHECKOUT SESSION - SUBSCRIPTION
 # -------------------------------------------------------------------
-@app.route('/create-subscription-checkout-session', methods=['POST'])
+@main_bp.route('/create-subscription-checkout-session', methods=['POST'])
 def create_subscription_checkout_session():
     """Create a Stripe Checkout Session for subscription"""
     try:
         email = request.form.get('email')
         name = request.form.get('name')
         plan_tier = request.form.get('plan_tier')  # 'one' or 'two'
-        price_id_env_key = f'STRIPE_PRICE_ID_SUBS_{plan_tier.upper()}'
-        price_id = os.environ.get(price_id_env_key)
         
         if not email or not name or not plan_tier:
             return jsonify({'error': 'Please fill in all fields and select a plan'}), 400
         
+        price_id = plan_tiers.price_for_tier(plan_tier)
         if not price_id:
+            price_id_env_key = f'STRIPE_PRICE_ID_SUBS_{plan_tier.upper()}'
             return jsonify({'error': f'Price ID not configured for {plan_tier} plan. Please set {price_id_env_key} in .env'}), 400
         
         # Check if user exists, create if not
-        user = User.query.filter_by(email=email).first()
-        if not user:
-            user = User(email=email, name=name)
-            db.session.add(user)
-            db.session.commit()
+        user = user_directory.get_or_create(email, name)
+        stick_to_primary()
         
         # Check if user already has an active subscription
         active_subscription = Subscription.query.filter_by(
@@ -220,9 +459,9 @@ def create_subscription_checkout_session():
         base_url = request.host_url.rstrip('/')
         
         # Create Stripe Checkout Session in EMBEDDED mode for subscription
-        checkout_session = stripe.checkout.Session.create(
+        params = dict(
             ui_mode='embedded',
-            customer_email=email,
+            **checkout_customer_params(user),
             line_items=[{
                 'price': price_id,
                 'quantity': 1,
@@ -233,8 +472,18 @@ def create_subscription_checkout_session():
                 'user_id': user.id,
                 'payment_type': 'subscription',
                 'plan_tier': plan_tier
+            },
+            # Copied onto the Subscription, so customer.subscription.* events carry the tier
+            subscription_data={
+                'metadata': {
+                    'user_id': user.id,
+                    'plan_tier': plan_tier
+                }
             }
         )
+        checkout_session = stripe_api.create_checkout_session(
+            params, idempotency_key=checkout_idempotency_key(params, request.form.get('checkout_nonce'))
+        )
         
         # Return clientSecret for frontend to embed checkout
         return jsonify({'clientSecret': checkout_session.client_secret})
@@ -247,7 +496,7 @@ def create_subscription_checkout_session():
 # -------------------------------------------------------------------
 # SECTION 3: WEBHOOK HANDLER
 # -------------------------------------------------------------------
-@app.route('/webhook', methods=['POST'])
+@main_bp.route('/webhook', methods=['POST'])
 def webhook():
     """Handle Stripe webhook events"""
     
@@ -257,75 +506,184 @@ def webhook():
     # Obtains the Stripe signature HTTP header → sig_header
     # Obtains your secret key for verifying the webhook → webhook_secret
 
-    payload = request.get_data(as_text=True)
+    payload = request.get_data()
     sig_header = request.headers.get('Stripe-Signature')
-    webhook_secret = os.environ.get('STRIPE_WEBHOOK_SECRET')
     
-    if not webhook_secret:
-        print('ERROR: STRIPE_WEBHOOK_SECRET not configured in environment')
+    if not webhook_verifier:
+        logger.error('STRIPE_WEBHOOK_SECRET not configured in environment')
         return jsonify({'error': 'Webhook secret not configured'}), 500
     
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, webhook_secret
-        )
+        # Signature checked on the raw bytes; the event stays a plain dict
+        event = webhook_verifier.construct_event(payload, sig_header)
     except Exception as e:
-        print(f'Webhook error: {str(e)}')
+        logger.warning('Webhook verification failed: %s', e)
+        WEBHOOK_EVENTS.inc(event_type='unknown', outcome='rejected')
         return jsonify({'error': 'Webhook verification failed'}), 400
     
-    # Handle the event
     event_type = event['type']
-    event_data = event.get('data', {}).get('object', {})
     event_id = event.get('id', 'unknown')
-        
+    
+    # Types without a handler are acknowledged before the ledger or the queue is touched
+    if not webhook_handlers.handles(event_type):
+        WEBHOOK_EVENTS.inc(event_type=event_type, outcome='ignored')
+        return jsonify({'status': 'ignored'}), 200
+    
+    # Idempotency: a single insert-or-skip on the unique event ID, so redelivered
+    # or replayed events return before any handler or Stripe call runs
     try:
-        if event_type == 'checkout.session.completed':
-            # Handle successful checkout (both one-time and subscription)
-            handle_checkout_completed(event_data)
-        
-        elif event_type == 'customer.subscription.created':
-            # Subscription successfully created for the first time
-            handle_subscription_created(event_data)
-        
-        elif event_type == 'customer.subscription.updated':
-            # Subscription changed (upgrade/downgrade)
-            handle_subscription_updated(event_data)
-        
-        elif event_type == 'customer.subscription.deleted':
-            # Subscription cancelled
-            handle_subscription_deleted(event_data)
-        
-        elif event_type == 'invoice.payment_succeeded':
-            # Subscription renewed successfully
-            handle_invoice_payment_succeeded(event_data)
-        
-        elif event_type == 'invoice.payment_failed':
-            # Subscription payment failed (optional - you mentioned you don't need this)
-            # But I'll add it anyway in case you change your mind
-            handle_invoice_payment_failed(event_data)
+        is_new_event = claim_event(event_id, event_type)
+        if not is_new_event:
+            db.session.rollback()
+            logger.info('Duplicate event skipped', extra={'event_id': event_id, 'event_type': event_type})
+            WEBHOOK_EVENTS.inc(event_type=event_type, outcome='duplicate')
+            return jsonify({'status': 'duplicate'}), 200
         
-        elif event_type == 'customer.updated':
-            # Customer information changed (name, email, address, default payment method, etc.)
-            handle_customer_updated(event_data)
-        
-        elif event_type == 'payment_method.attached':
-            # New payment method attached to customer
-            handle_payment_method_attached(event_data)
+        # "Ack fast, process later": store the verified event and return right away,
+        # the webhook workers run the handler in the background
+        if settings.webhook_async:
+            enqueue_event(event_id, event_type, payload.decode('utf-8'), ordering_key_for(event))  # commits the claim too
+        else:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        logger.exception('Could not record event', extra={'event_id': event_id, 'event_type': event_type})
+        ERRORS.inc(component='webhook')
+        return jsonify({'error': 'Could not record event'}), 500
+    
+    if settings.webhook_async:
+        start_webhook_workers()
+        webhook_workers.notify()
+        WEBHOOK_EVENTS.inc(event_type=event_type, outcome='queued')
+        return jsonify({'status': 'queued'}), 200
         
-
+    try:
+        process_event(event)
         return jsonify({'status': 'success'}), 200
     
     except Exception as e:
-        print(f'[WEBHOOK] ERROR handling event {event_type}: {str(e)}')
-        import traceback
-        traceback.print_exc()
-        print('=' * 50)
+        # process_event() logged and counted the failure
+        # Let Stripe's retry run the handler again
+        db.session.rollback()
+        release_event(event_id)
         return jsonify({'error': str(e)}), 500
 
+def process_event(event):
+    """Run the handler for a verified Stripe event (inline or from a webhook worker)"""
+    event_type = event['type']
+    # Every log line written while handling the event carries its ID and type
+    with log_context(event_id=event.get('id'), event_type=event_type):
+        started = time.perf_counter()
+        try:
+            webhook_handlers.dispatch(event_type, event.get('data', {}).get('object', {}), event.get('created'))
+        except Exception:
+            logger.exception('Error handling event')
+            WEBHOOK_EVENTS.inc(event_type=event_type, outcome='failed')
+            ERRORS.inc(component='webhook')
+            raise
+        finally:
+            WEBHOOK_EVENT_SECONDS.observe(time.perf_counter() - started, event_type=event_type)
+        if event.get('id'):
+            # Processing latency per event, kept in the processed_events ledger
+            record_event_processed(event['id'], (time.perf_counter() - started) * 1000)
+        WEBHOOK_EVENTS.inc(event_type=event_type, outcome='processed')
+
+# Queue depth per status, read from the database when /metrics is scraped
+registry.register(Gauge(
+    'webhook_queue_depth', 'Webhook events in the queue by status', ('status',),
+    callback=queue_depth_by_status
+))
+
+# Hit ratio of the user caches (UserDirectory and CustomerDirectory), per lookup kind
+registry.register(Gauge(
+    'user_cache_hit_ratio', 'Share of user lookups answered from the cache since startup', ('lookup',),
+    callback=lambda: user_directory.hit_ratios()
+))
+
+@main_bp.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint (latency histograms, counters, queue depth)"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+def start_webhook_workers(app=None):
+    """Start the in-process webhook workers of `app` (default: current_app) once (no-op if already running)"""
+    app_services = services(app)
+    if app_services.settings.webhook_workers_in_process and not app_services.webhook_workers.running:
+        app_services.webhook_workers.start()
+
+@main_bp.cli.command('webhook-worker')
+@click.option('--processes', type=int, default=None,
+              help='Fork this many worker processes, each owning a share of the customers '
+                   '(0: threads in this process; default: WEBHOOK_PROCESSES)')
+@click.option('--threads', default=2, show_default=True, help='Worker threads per process with --processes')
+def webhook_worker_command(processes, threads):
+    """Run webhook workers in this process (or in --processes worker processes) until interrupted"""
+    if processes is None:
+        processes = settings.webhook_processes
+    if processes:
+        # Each process claims only the subscriptions/customers it owns on the
+        # hash ring, so per-customer order holds while all cores apply events.
+        # Processes on other hosts join the same ring through the database.
+        heartbeat_seconds = settings.webhook_heartbeat_seconds
+        WorkerSupervisor(lambda slot: webhook_workers.sharded(
+            ShardMembership(default_worker_id(slot), heartbeat_seconds), threads
+        ), processes).run()
+        return
+    webhook_workers.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        webhook_workers.stop()
+
+@main_bp.cli.command('webhook-requeue-dead')
+def webhook_requeue_dead_command():
+    """Move dead-lettered webhook events back to the queue"""
+    count = requeue_dead_events()
+    click.echo(f'Re-queued {count} dead webhook event(s)')
+
+@main_bp.cli.command('backfill-events')
+@click.option('--from-jsonl', 'jsonl_path', default=None, help='Replay a local JSONL export instead of calling Stripe')
+@click.option('--since', default=None, help='Unix timestamp or ISO date (default: 30 days ago, Stripe keeps events for 30 days)')
+@click.option('--until', default=None, help='Unix timestamp or ISO date (default: now)')
+@click.option('--batch-size', default=100, show_default=True, help='Events applied per database transaction')
+@click.option('--fetch-workers', default=4, show_default=True, help='Parallel Stripe event list fetchers')
+@click.option('--checkpoint', 'checkpoint_path', default='backfill_checkpoint.json', show_default=True,
+              help='File used to resume an interrupted run')
+@click.option('--reset', is_flag=True, help='Ignore an existing checkpoint and start over')
+def backfill_events_command(jsonl_path, since, until, batch_size, fetch_workers, checkpoint_path, reset):
+    """Rebuild payments and subscriptions by replaying Stripe events through the webhook handlers"""
+    if reset and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    
+    if jsonl_path:
+        events = iter_jsonl_events(jsonl_path)
+    else:
+        now = int(time.time())
+        start = parse_timestamp(since) or now - 30 * 86400
+        # Resume: no need to fetch windows the checkpoint already covers (failed events excepted)
+        start = max(start, resume_from(load_checkpoint(checkpoint_path)))
+        events = iter_stripe_events(
+            stripe_api.list_events, start, parse_timestamp(until) or now,
+            event_types=webhook_handlers.event_types, fetch_workers=fetch_workers
+        )
+    
+    stats = run_backfill(
+        events, process_event, webhook_handlers.event_types,
+        batch_size=batch_size, checkpoint_path=checkpoint_path
+    )
+    click.echo(f'Backfill finished: {stats["seen"]} events in {stats["seconds"]:.1f}s '
+          f'({stats["events_per_second"]:.1f} events/sec) - {stats["applied"]} applied, '
+          f'{stats["duplicates"]} duplicates, {stats["skipped"]} skipped, {stats["failed"]} failed')
+    if stats['failed_ids']:
+        click.echo(f'Failed events (retried by the next run with this checkpoint): {", ".join(stats["failed_ids"])}')
+
 # -------------------------------------------------------------------
 # SECTION 4: WEBHOOK HANDLER FUNCTIONS
 # -------------------------------------------------------------------
 
+@webhook_handlers.on('checkout.session.completed')
+@timed(WEBHOOK_HANDLER_SECONDS, 'handler')
 def handle_checkout_completed(session):
     """
     Handle checkout.session.completed event
@@ -338,9 +696,14 @@ def handle_checkout_completed(session):
     payment_type = metadata.get('payment_type')
     user_id = metadata.get('user_id')
     
+    # Remember the Stripe customer created by this checkout, so later
+    # subscription and payment method events resolve the user locally
+    user = user_directory.by_id(int(user_id)) if user_id else None
+    if user and session.get('customer'):
+        customer_directory.link(user, session.get('customer'))
+    
     if payment_type == 'one_time' and user_id:
         # Handle one-time payment success via webhook 
-        user = User.query.get(int(user_id))
         if user:
             session_id = session.get('id')
             existing_payment = Payment.query.filter_by(
@@ -359,10 +722,138 @@ def handle_checkout_completed(session):
                     transaction_id=session_id
                 )
                 db.session.add(payment)
-                db.session.commit()
-                print(f'One-time payment recorded: ${amount} for user {user_id}')
+                record_payment('one_time', amount)
+                commit()
+                logger.info('One-time payment recorded: $%s for user %s', amount, user_id)
+
+def price_info_for_item(item):
+    """
+    Price info for a subscription item
+
+    The item already embeds the full Price object, so it is used to refresh the
+    catalog directly; the catalog is only consulted when the embedded price is incomplete.
+    """
+    price = item.get('price', {})
+    if price.get('unit_amount') is not None and price.get('currency'):
+        price_catalog.put(price)
+    return price_catalog.get(price.get('id'))
+
+def subscription_period(subscription):
+    """
+    (current_period_start, current_period_end) of a subscription
+
+    Since API version 2025-03-31 the period is on the subscription items, not the subscription.
+    """
+    start = subscription.get('current_period_start')
+    end = subscription.get('current_period_end')
+    items = subscription.get('items', {}).get('data', [])
+    if items:
+        start = start or items[0].get('current_period_start')
+        end = end or items[0].get('current_period_end')
+    return start, end
+
+def subscription_snapshot(subscription):
+    """The fields of a Stripe subscription that the handlers store, for the renewal scheduler"""
+    _, current_period_end = subscription_period(subscription)
+    items = subscription.get('items', {}).get('data', [])
+    return {
+        'status': subscription.get('status'),
+        'next_billing_date': datetime.utcfromtimestamp(current_period_end) if current_period_end else None,
+        'stripe_price_id': items[0].get('price', {}).get('id') if items else None,
+    }
+
+def invoice_period_end(invoice):
+    """End of the billing period an invoice pays for (from its line items), or None"""
+    ends = [
+        line.get('period', {}).get('end')
+        for line in invoice.get('lines', {}).get('data', [])
+    ]
+    ends = [end for end in ends if end]
+    return max(ends) if ends else None
+
+def record_invoice_payment(existing_sub, invoice):
+    """
+    Store a paid subscription invoice as a Payment and add it to its plan tier's revenue
+
+    The Payment row (linked to the subscription) is what `flask analytics-rebuild`
+    reads the revenue back from. Runs in the handler's transaction; an invoice
+    already stored is skipped.
+    """
+    amount = Decimal(invoice.get('amount_paid') or 0) / 100
+    if not invoice.get('id') or not amount:
+        return
+    if Payment.query.filter_by(transaction_id=invoice['id']).first():
+        return
+    payment = Payment(
+        user_id=existing_sub.user_id,
+        subscription_id=existing_sub.id,
+        amount=amount,
+        payment_type='subscription',
+        status='completed',
+        transaction_id=invoice['id'],
+        created_at=datetime.utcnow()
+    )
+    db.session.add(payment)
+    record_payment('subscription', amount, payment.created_at, plan_tier=existing_sub.plan_tier or '')
+
+def advance_subscription_watermark(existing_sub, event_created):
+    """
+    Record that an event created at event_created is applied to existing_sub
+
+    Returns False if a newer event was already applied, so the caller must not
+    overwrite status or billing dates with this older state (Stripe doesn't
+    guarantee delivery order). The check is one conditional UPDATE, so two
+    workers can't both pass it with events in the wrong order. In batch mode
+    coalesce() keeps the newest snapshot by `created`, so the event that
+    reaches this check is never older than one it superseded.
+    """
+    if not event_created:
+        return True  # no event timestamp (e.g. a bare object), apply as before
+    occurred_at = datetime.utcfromtimestamp(event_created)
+    advanced = Subscription.query.filter(
+        Subscription.id == existing_sub.id,
+        or_(Subscription.last_event_at.is_(None), Subscription.last_event_at <= occurred_at)
+    ).update({'last_event_at': occurred_at}, synchronize_session='evaluate')
+    return advanced == 1
+
+def end_replaced_subscriptions(subscription_row):
+    """
+    Make room for subscription_row as the user's one active subscription
+
+    Stripe sends a replacement's customer.subscription.created before the old
+    subscription's customer.subscription.deleted, which would break
+    uq_subscriptions_one_active_per_user. The user's other active rows that
+    started no later are marked 'expired' (the late deleted event then marks
+    them cancelled). Returns False if an active subscription that started
+    later exists; the caller must not make subscription_row active then.
+    """
+    others = Subscription.query.filter(
+        Subscription.user_id == subscription_row.user_id,
+        Subscription.status == 'active',
+        Subscription.id != subscription_row.id
+    ).all()
+    if any(other.start_date > subscription_row.start_date for other in others):
+        return False
+    for other in others:
+        before = subscription_state(other)
+        other.status = 'expired'
+        record_subscription_change(before, subscription_state(other))
+        logger.info('Subscription %s replaced by %s', other.stripe_subscription_id,
+                    subscription_row.stripe_subscription_id)
+    return True
 
-def handle_subscription_created(subscription):
+def active_unless_replaced(subscription_row, status):
+    """`status` for subscription_row, 'expired' instead of 'active' if a newer subscription is active"""
+    already_active = subscription_row.id is not None and subscription_row.status == 'active'
+    if status != 'active' or already_active or end_replaced_subscriptions(subscription_row):
+        return status
+    logger.warning('Subscription %s is active in Stripe, but a newer subscription of the user is; storing it as expired',
+                   subscription_row.stripe_subscription_id)
+    return 'expired'
+
+@webhook_handlers.on('customer.subscription.created', pass_created=True)
+@timed(WEBHOOK_HANDLER_SECONDS, 'handler')
+def handle_subscription_created(subscription, event_created=None):
     """
     Handle customer.subscription.created event
     This event fires when a subscription is successfully created for the first time
@@ -370,26 +861,16 @@ def handle_subscription_created(subscription):
     stripe_subscription_id = subscription.get('id')
     customer_id = subscription.get('customer')
     
-    print(f'Processing subscription.created for {stripe_subscription_id}')
+    logger.info('Processing subscription.created for %s', stripe_subscription_id)
     
-    # Get customer email from Stripe
     try:
-        customer = stripe.Customer.retrieve(customer_id)
-        email = customer.get('email')
-        
-        if not email:
-            print(f'ERROR: No email found for customer {customer_id}')
-            return
-        
-        print(f'Found customer email: {email}')
-        
-        # Find user by email
-        user = User.query.filter_by(email=email).first()
+        # Find user by Stripe customer ID (local lookup, Stripe API only on a miss)
+        user = customer_directory.user_for_customer(customer_id)
         if not user:
-            print(f'ERROR: User not found for email {email}')
+            logger.error('User not found for customer %s', customer_id)
             return
         
-        print(f'Found user: {user.id} ({user.email})')
+        logger.debug('Found user: %s (%s)', user.id, user.email)
         
         # Check if subscription already exists
         existing_sub = Subscription.query.filter_by(
@@ -397,87 +878,63 @@ def handle_subscription_created(subscription):
         ).first()
         
         if existing_sub:
-            print(f'Subscription {stripe_subscription_id} already exists in database')
+            logger.info('Subscription %s already exists in database', stripe_subscription_id)
             return
         
         # Get subscription details
         items = subscription.get('items', {}).get('data', [])
         if not items:
-            print(f'ERROR: No items found in subscription {stripe_subscription_id}')
+            logger.error('No items found in subscription %s', stripe_subscription_id)
             return
         
         price_id = items[0].get('price', {}).get('id')
-        price_obj = stripe.Price.retrieve(price_id)
-        amount = price_obj.get('unit_amount', 0) / 100
+        price_info = price_info_for_item(items[0])
+        if not price_info:
+            logger.error('Price %s not found for subscription %s', price_id, stripe_subscription_id)
+            return
+        amount = price_info['amount']
         
-        # Determine plan tier from metadata or price ID
+        # Determine plan tier from the price ID index, or metadata (stamped at checkout);
+        # the price wins because this may be an upgraded subscription (see handle_subscription_updated)
         metadata = subscription.get('metadata', {})
-        plan_tier = metadata.get('plan_tier')
-        
-        # If not in subscription metadata, try to get from checkout session
-        if not plan_tier:
-            # Try to find checkout session that created this subscription
-            # Look for recent checkout sessions for this customer
-            try:
-                checkout_sessions = stripe.checkout.Session.list(
-                    customer=customer_id,
-                    limit=10
-                )
-                for session in checkout_sessions.data:
-                    if session.mode == 'subscription' and session.subscription == stripe_subscription_id:
-                        session_metadata = session.get('metadata', {})
-                        plan_tier = session_metadata.get('plan_tier')
-                        if plan_tier:
-                            print(f'Found plan_tier from checkout session: {plan_tier}')
-                            break
-            except Exception as e:
-                print(f'Could not retrieve checkout session: {str(e)}')
-        
-        # If still no plan_tier, try to infer from price ID or environment variables
+        plan_tier = plan_tiers.tier_for_price(price_id) or metadata.get('plan_tier')
         if not plan_tier:
-            # Check environment variables
-            if os.environ.get('STRIPE_PRICE_ID_SUBS_ONE') == price_id:
-                plan_tier = 'basic'  
-            elif os.environ.get('STRIPE_PRICE_ID_SUBS_TWO') == price_id:
-                plan_tier = 'fancy'  
-            else:
-                plan_tier = 'unknown'
-                print(f'Warning: Could not determine plan_tier for price_id {price_id}')
+            plan_tier = 'unknown'
+            logger.warning('Could not determine plan_tier for price_id %s', price_id)
         
-        # Get dates - Stripe timestamps are in seconds (Unix timestamp)
-        current_period_start = subscription.get('current_period_start')
-        current_period_end = subscription.get('current_period_end')
+        # Get dates - Stripe timestamps are in seconds (Unix timestamp), stored as naive UTC like every other column
+        current_period_start, current_period_end = subscription_period(subscription)
         
         if current_period_start:
             try:
                 # Stripe timestamps are in seconds, but check if it's milliseconds (> year 2100)
                 if current_period_start > 4102444800:  # Jan 1, 2100 in seconds
                     # Likely milliseconds, convert to seconds
-                    start_date = datetime.fromtimestamp(current_period_start / 1000)
+                    start_date = datetime.utcfromtimestamp(current_period_start / 1000)
                 else:
-                    start_date = datetime.fromtimestamp(current_period_start)
+                    start_date = datetime.utcfromtimestamp(current_period_start)
             except (ValueError, OSError, TypeError) as e:
-                print(f'ERROR: Invalid timestamp for current_period_start: {current_period_start} - {str(e)}')
+                logger.error('Invalid timestamp for current_period_start: %s - %s', current_period_start, e)
                 start_date = datetime.utcnow()
         else:
             start_date = datetime.utcnow()
-            print(f'Warning: No current_period_start found, using current time')
+            logger.warning('No current_period_start found, using current time')
         
         if current_period_end:
             try:
                 # Stripe timestamps are in seconds, but check if it's milliseconds (> year 2100)
                 if current_period_end > 4102444800:  # Jan 1, 2100 in seconds
                     # Likely milliseconds, convert to seconds
-                    next_billing = datetime.fromtimestamp(current_period_end / 1000)
+                    next_billing = datetime.utcfromtimestamp(current_period_end / 1000)
                 else:
-                    next_billing = datetime.fromtimestamp(current_period_end)
+                    next_billing = datetime.utcfromtimestamp(current_period_end)
             except (ValueError, OSError, TypeError) as e:
-                print(f'ERROR: Invalid timestamp for current_period_end: {current_period_end} - {str(e)}')
+                logger.error('Invalid timestamp for current_period_end: %s - %s', current_period_end, e)
                 next_billing = start_date + timedelta(days=30)
         else:
             # Default to 1 month from start if not provided
             next_billing = start_date + timedelta(days=30)
-            print(f'Warning: No current_period_end found, using start_date + 30 days')
+            logger.warning('No current_period_end found, using start_date + 30 days')
         
         # Create subscription record
         new_subscription = Subscription(
@@ -488,17 +945,25 @@ def handle_subscription_created(subscription):
             stripe_subscription_id=stripe_subscription_id,
             stripe_price_id=price_id,
             start_date=start_date,
-            next_billing_date=next_billing
+            next_billing_date=next_billing,
+            last_event_at=datetime.utcfromtimestamp(event_created) if event_created else None
         )
+        # A replacement subscription can arrive before the old one is deleted
+        new_subscription.status = active_unless_replaced(new_subscription, new_subscription.status)
         db.session.add(new_subscription)
-        db.session.commit()
-        print(f'SUCCESS: Subscription created - {plan_tier} tier, ${amount}/month for user {user.id} (email: {user.email})')
+        record_subscription_change(None, subscription_state(new_subscription))
+        commit()
+        logger.info('Subscription created - %s tier, $%s/month for user %s', plan_tier, amount, user.id,
+                    extra={'subscription_id': stripe_subscription_id})
     except Exception as e:
-        print(f'ERROR creating subscription: {str(e)}')
-        import traceback
-        traceback.print_exc()
+        logger.error('Error creating subscription %s: %s', stripe_subscription_id, e)
+        # Let the caller roll back and retry; swallowing the error would leave
+        # a failed transaction behind (and commit the rest of a batch without it)
+        raise
 
-def handle_subscription_updated(subscription):
+@webhook_handlers.on('customer.subscription.updated', pass_created=True)
+@timed(WEBHOOK_HANDLER_SECONDS, 'handler')
+def handle_subscription_updated(subscription, event_created=None):
     """
     Handle customer.subscription.updated
     This event fires when a subscription is changed (upgrade/downgrade)
@@ -511,37 +976,55 @@ def handle_subscription_updated(subscription):
     ).first()
     
     if not existing_sub:
-        print(f'Subscription {stripe_subscription_id} not found in database')
+        # Delivered before customer.subscription.created; the event carries
+        # the full subscription, so create the record from it
+        logger.info('Subscription %s not found in database, creating it from the update', stripe_subscription_id)
+        handle_subscription_created(subscription, event_created)
         return
     
+    # Ignore an update that is older than the state we already have
+    if not advance_subscription_watermark(existing_sub, event_created):
+        logger.info('Skipping out-of-date update for subscription %s', stripe_subscription_id)
+        return
+    before = subscription_state(existing_sub)
+    
     # Update subscription details
     items = subscription.get('items', {}).get('data', [])
     if items:
         price_id = items[0].get('price', {}).get('id')
-        price_obj = stripe.Price.retrieve(price_id)
-        amount = price_obj.get('unit_amount', 0) / 100
+        price_info = price_info_for_item(items[0])
+        if not price_info:
+            raise ValueError(f'Price {price_id} not found')
+        amount = price_info['amount']
         
         existing_sub.amount = amount
         existing_sub.stripe_price_id = price_id
         
-        # Update plan tier if changed
+        # Update plan tier if changed (the price is authoritative after an
+        # upgrade/downgrade, metadata still holds the tier chosen at checkout)
         metadata = subscription.get('metadata', {})
-        plan_tier = metadata.get('plan_tier')
+        plan_tier = plan_tiers.tier_for_price(price_id) or metadata.get('plan_tier')
         if plan_tier:
             existing_sub.plan_tier = plan_tier
     
     # Update status
-    existing_sub.status = subscription.get('status', 'active')
+    existing_sub.status = active_unless_replaced(existing_sub, subscription.get('status', 'active'))
     
     # Update billing dates
-    existing_sub.next_billing_date = datetime.fromtimestamp(
-        subscription.get('current_period_end', 0)
-    )
+    _, current_period_end = subscription_period(subscription)
+    if current_period_end:
+        existing_sub.next_billing_date = datetime.utcfromtimestamp(current_period_end)
     
-    db.session.commit()
-    print(f'Subscription updated: {stripe_subscription_id}')
+    # The row now matches Stripe again, drop what the renewal scheduler flagged
+    existing_sub.discrepancy = None
+    
+    record_subscription_change(before, subscription_state(existing_sub))
+    commit()
+    logger.info('Subscription updated: %s', stripe_subscription_id)
 
-def handle_subscription_deleted(subscription):
+@webhook_handlers.on('customer.subscription.deleted', pass_created=True)
+@timed(WEBHOOK_HANDLER_SECONDS, 'handler')
+def handle_subscription_deleted(subscription, event_created=None):
     """
     Handle customer.subscription.deleted
     This event fires when a subscription is cancelled
@@ -554,22 +1037,38 @@ def handle_subscription_deleted(subscription):
     ).first()
     
     if not existing_sub:
-        print(f'Subscription {stripe_subscription_id} not found in database')
-        return
+        # Delivered before customer.subscription.created: record it, then cancel it,
+        # so the late created event can't bring it back as active
+        handle_subscription_created(subscription, event_created)
+        existing_sub = Subscription.query.filter_by(
+            stripe_subscription_id=stripe_subscription_id
+        ).first()
+        if not existing_sub:
+            logger.warning('Subscription %s not found in database', stripe_subscription_id)
+            return
+    else:
+        # Cancellation is final, so it is applied even if a newer event was seen;
+        # the watermark still moves forward so older updates are skipped afterwards
+        advance_subscription_watermark(existing_sub, event_created)
+    before = subscription_state(existing_sub)
     
     # Mark as cancelled
     existing_sub.status = 'cancelled'
     existing_sub.cancelled_at = datetime.utcnow()
+    existing_sub.discrepancy = None
     
-    db.session.commit()
-    print(f'Subscription cancelled: {stripe_subscription_id}')
+    record_subscription_change(before, subscription_state(existing_sub))
+    commit()
+    logger.info('Subscription cancelled: %s', stripe_subscription_id)
 
-def handle_invoice_payment_succeeded(invoice):
+@webhook_handlers.on('invoice.payment_succeeded', pass_created=True)
+@timed(WEBHOOK_HANDLER_SECONDS, 'handler')
+def handle_invoice_payment_succeeded(invoice, event_created=None):
     """
     Handle invoice.payment_succeeded
     This event fires when a subscription is renewed successfully
     """
-    subscription_id = invoice.get('subscription')
+    subscription_id = invoice_subscription_id(invoice)
     
     if not subscription_id:
         # This might be a one-time payment invoice, skip it
@@ -581,27 +1080,37 @@ def handle_invoice_payment_succeeded(invoice):
     ).first()
     
     if not existing_sub:
-        print(f'Subscription {subscription_id} not found for invoice payment')
+        logger.warning('Subscription %s not found for invoice payment', subscription_id)
         return
     
-    # Update next billing date from the subscription
-    try:
-        subscription = stripe.Subscription.retrieve(subscription_id)
-        existing_sub.next_billing_date = datetime.fromtimestamp(
-            subscription.get('current_period_end', 0)
-        )
-        existing_sub.status = 'active'  # Ensure it's active after successful payment
-        db.session.commit()
-        print(f'Subscription renewed: {subscription_id}')
-    except Exception as e:
-        print(f'Error updating subscription renewal: {e}')
+    # The money came in even if a newer event already set the subscription's state
+    record_invoice_payment(existing_sub, invoice)
+    
+    # A newer event (e.g. a later cancellation) already set the state
+    if not advance_subscription_watermark(existing_sub, event_created):
+        logger.info('Skipping out-of-date invoice payment for subscription %s', subscription_id)
+        commit()
+        return
+    
+    # Next billing date is the end of the period this invoice paid for
+    # (from the invoice lines, no need to retrieve the subscription from Stripe)
+    period_end = invoice_period_end(invoice)
+    if period_end:
+        existing_sub.next_billing_date = datetime.utcfromtimestamp(period_end)
+    before = subscription_state(existing_sub)
+    existing_sub.status = active_unless_replaced(existing_sub, 'active')  # Ensure it's active after successful payment
+    record_subscription_change(before, subscription_state(existing_sub))
+    commit()
+    logger.info('Subscription renewed: %s', subscription_id)
 
-def handle_invoice_payment_failed(invoice):
+@webhook_handlers.on('invoice.payment_failed', pass_created=True)
+@timed(WEBHOOK_HANDLER_SECONDS, 'handler')
+def handle_invoice_payment_failed(invoice, event_created=None):
     """
     Handle invoice.payment_failed
     This event fires when a subscription payment fails
     """
-    subscription_id = invoice.get('subscription')
+    subscription_id = invoice_subscription_id(invoice)
     
     if not subscription_id:
         return
@@ -614,11 +1123,20 @@ def handle_invoice_payment_failed(invoice):
     if not existing_sub:
         return
     
+    # A failure older than the last applied event (e.g. a later successful payment) changes nothing
+    if not advance_subscription_watermark(existing_sub, event_created):
+        logger.info('Skipping out-of-date payment failure for subscription %s', subscription_id)
+        return
+    
     # Update status to past_due or unpaid
+    before = subscription_state(existing_sub)
     existing_sub.status = 'past_due'
-    db.session.commit()
-    print(f'Subscription payment failed: {subscription_id}')
+    record_subscription_change(before, subscription_state(existing_sub))
+    commit()
+    logger.info('Subscription payment failed: %s', subscription_id)
 
+@webhook_handlers.on('customer.updated')
+@timed(WEBHOOK_HANDLER_SECONDS, 'handler')
 def handle_customer_updated(customer):
     """
     Handle customer.updated
@@ -627,118 +1145,286 @@ def handle_customer_updated(customer):
     customer_id = customer.get('id')
     email = customer.get('email')
     
-    if not email:
-        print(f'No email found for customer {customer_id}')
-        return
-    
-    # Find user by email
-    user = User.query.filter_by(email=email).first()
+    # Find user by Stripe customer ID, then by email
+    user = customer_directory.find_local(customer_id)
     if not user:
-        print(f'User not found for email {email}')
-        return
+        if not email:
+            logger.warning('No email found for customer %s', customer_id)
+            return
+        record = user_directory.by_email(email)
+        if not record:
+            logger.warning('User not found for email %s', email)
+            return
+        customer_directory.link(record, customer_id)
+        user = db.session.get(User, record.id)
+    
+    # Default payment method changes arrive here (not in payment_method.attached)
+    default_payment_method = (customer.get('invoice_settings') or {}).get('default_payment_method')
+    if default_payment_method:
+        logger.info('Default payment method for customer %s: %s', customer_id, default_payment_method)
     
     # Update user information
     name = customer.get('name')
     if name and name != user.name:
+        old_name = user.name
         user.name = name
-        print(f'Updated name for user {user.id}: {user.name} -> {name}')
+        user_directory.update(user.id, name=name)
+        logger.info('Updated name for user %s: %s -> %s', user.id, old_name, name)
     
     # Note: Address, phone, and other fields would be stored here when added to User model
     # For now, we only update the name
     
-    db.session.commit()
-    print(f'Customer updated: {customer_id}')
+    commit()
+    logger.info('Customer updated: %s', customer_id)
 
+@webhook_handlers.on('payment_method.attached')
+@timed(WEBHOOK_HANDLER_SECONDS, 'handler')
 def handle_payment_method_attached(payment_method):
     """Handle payment_method.attached - new payment method attached to customer"""
     payment_method_id = payment_method.get('id')
     customer_id = payment_method.get('customer')
     
     if not customer_id:
-        print(f'No customer ID found for payment method {payment_method_id}')
+        logger.warning('No customer ID found for payment method %s', payment_method_id)
         return
     
-    # Get customer from Stripe to find user
+    # Find user by Stripe customer ID (local lookup, Stripe API only on a miss)
     try:
-        customer = stripe.Customer.retrieve(customer_id)
-        email = customer.get('email')
-        
-        if not email:
-            print(f'No email found for customer {customer_id}')
-            return
-        
-        # Find user by email
-        user = User.query.filter_by(email=email).first()
+        user = customer_directory.user_for_customer(customer_id)
         if not user:
-            print(f'User not found for email {email}')
             return
         
-        # Check if this is the default payment method
-        default_payment_method = customer.get('invoice_settings', {}).get('default_payment_method')
-        is_default = (default_payment_method == payment_method_id)
-        
         # Note: Payment method details would be stored here when PaymentMethod model is added
-        # For now, we just log the event
-        print(f'Payment method {payment_method_id} attached to customer {customer_id} (user {user.id})')
-        if is_default:
-            print(f'Payment method {payment_method_id} is now the default payment method')
+        # For now, we just log the event. Changes of the default payment method
+        # are reported by customer.updated (invoice_settings.default_payment_method)
+        logger.info('Payment method %s attached to customer %s (user %s)', payment_method_id, customer_id, user.id)
         
     except Exception as e:
-        print(f'Error handling payment method attachment: {str(e)}')
+        logger.exception('Error handling payment method attachment: %s', e)
+        ERRORS.inc(component='webhook')
+
+@webhook_handlers.on('price.updated')
+@timed(WEBHOOK_HANDLER_SECONDS, 'handler')
+def handle_price_updated(price):
+    """
+    Handle price.updated
+    This event fires when a price changes (amount, currency, metadata, active flag)
+    """
+    price_catalog.put(price)
+    logger.info('Price catalog updated: %s', price.get('id'))
+
+@webhook_handlers.on('product.updated')
+@timed(WEBHOOK_HANDLER_SECONDS, 'handler')
+def handle_product_updated(product):
+    """
+    Handle product.updated
+    This event fires when a product changes; its cached prices are refreshed
+    """
+    product_id = product.get('id')
+    refreshed = price_catalog.invalidate_product(product_id)
+    logger.info('Price catalog refreshing %s price(s) for product %s', len(refreshed), product_id)
+
+@main_bp.cli.command('renewal-scheduler')
+@click.option('--once', is_flag=True, help='Check the subscriptions due now, then exit')
+def renewal_scheduler_command(once):
+    """Check due subscriptions against Stripe until interrupted"""
+    if once:
+        renewal_scheduler.run_due()
+        counts = {outcome: int(SUBSCRIPTION_RECONCILIATIONS.value(outcome=outcome))
+                  for outcome in ('in_sync', 'discrepancy', 'missing', 'error')}
+        click.echo(f'Checked {sum(counts.values())} subscription(s): ' +
+                   ', '.join(f'{count} {outcome}' for outcome, count in counts.items()))
+        return
+    renewal_scheduler.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        renewal_scheduler.stop()
+
+@main_bp.cli.command('subscription-discrepancies')
+def subscription_discrepancies_command():
+    """List subscriptions the renewal scheduler flagged as different from Stripe"""
+    flagged = Subscription.query.filter(Subscription.discrepancy.isnot(None)).order_by(
+        Subscription.reconciled_at.desc()
+    ).all()
+    for sub in flagged:
+        click.echo(f'{sub.stripe_subscription_id} (user {sub.user_id}, checked {sub.reconciled_at:%Y-%m-%d %H:%M}): '
+                   f'{sub.discrepancy}')
+    click.echo(f'{len(flagged)} flagged subscription(s)')
+
+def repair_from_stripe(source, stripe_object):
+    """Rebuild a local row from its Stripe object through the webhook handlers (`flask reconcile --repair`)"""
+    if source == 'subscriptions':
+        if stripe_object.get('status') == 'canceled':
+            handle_subscription_deleted(stripe_object)
+        else:
+            # Creates the row if it's missing; no event time, so the watermark doesn't hold it back
+            handle_subscription_updated(stripe_object)
+    elif source == 'checkout_sessions':
+        payment = Payment.query.filter_by(transaction_id=stripe_object.get('id')).first()
+        if not payment:
+            handle_checkout_completed(stripe_object)
+        elif stripe_object.get('payment_status') == 'paid':
+            amount = (stripe_object.get('amount_total') or 0) / 100
+            if payment.status == 'completed':
+                record_payment(payment.payment_type, Decimal(str(amount)) - payment.amount, payment.created_at, count=0)
+            else:
+                record_payment(payment.payment_type, amount, payment.created_at)
+            payment.amount = amount
+            payment.status = 'completed'
+            commit()
+
+@main_bp.cli.command('reconcile')
+@click.option('--source', 'source_names', multiple=True, type=click.Choice(['subscriptions', 'checkout_sessions']),
+              help='Only reconcile these (repeatable; default: both)')
+@click.option('--since', default=None, help='Unix timestamp or ISO date (default: where the last run ended, '
+                                            'or the beginning on the first run)')
+@click.option('--until', default=None, help='Unix timestamp or ISO date (default: now)')
+@click.option('--repair', is_flag=True, help='Rebuild missing and mismatching rows from Stripe')
+@click.option('--page-size', default=100, show_default=True, help='Stripe objects compared per database query')
+@click.option('--report', 'report_path', default='reconciliation_report.jsonl', show_default=True,
+              help='Differences found, one JSON object per line')
+@click.option('--checkpoint', 'checkpoint_path', default='reconciliation_checkpoint.json', show_default=True,
+              help='File used to resume an interrupted run and to start the next run where this one ended')
+@click.option('--reset', is_flag=True, help='Ignore an existing checkpoint and reconcile everything')
+def reconcile_command(source_names, since, until, repair, page_size, report_path, checkpoint_path, reset):
+    """Compare subscriptions and one-time payments with Stripe and report the differences"""
+    if reset and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    sources = [
+        SubscriptionSource(stripe_api.list_subscriptions, stripe_api.retrieve_subscription, subscription_snapshot),
+        CheckoutSessionSource(stripe_api.list_checkout_sessions, stripe_api.retrieve_checkout_session),
+    ]
+    sources = [source for source in sources if not source_names or source.name in source_names]
+    
+    # An interrupted run adds to its report, a new run starts a new one
+    resuming = any(state.get('phase') for state in load_reconciliation_checkpoint(checkpoint_path).values())
+    with open(report_path, 'a' if resuming else 'w') as report:
+        reconciler = Reconciler(
+            sources, report, repair=repair_from_stripe if repair else None,
+            page_size=page_size, checkpoint_path=checkpoint_path
+        )
+        results = reconciler.run(parse_timestamp(since), parse_timestamp(until))
+    for name, stats in results.items():
+        click.echo(f'{name}: {stats["seen"]} checked in {stats["seconds"]:.1f}s '
+                   f'({stats["records_per_second"]:.1f} records/sec) - {stats["in_sync"]} in sync, '
+                   f'{stats["mismatch"]} mismatched, {stats["missing_locally"]} missing locally, '
+                   f'{stats["missing_in_stripe"]} missing in Stripe, {stats["repaired"]} repaired')
+    click.echo(f'Differences written to {report_path}')
+
+@main_bp.cli.command('analytics')
+@click.option('--start', default=None, help='First day, YYYY-MM-DD (default: 30 days before --end)')
+@click.option('--end', default=None, help='Last day, YYYY-MM-DD (default: today, UTC)')
+@click.option('--json', 'as_json', is_flag=True, help='Print the same JSON as /api/analytics')
+def analytics_command(start, end, as_json):
+    """Revenue, MRR, churn and past_due subscriptions from the daily rollups"""
+    read_from_replica()
+    end = date.fromisoformat(end) if end else datetime.utcnow().date()
+    start = date.fromisoformat(start) if start else end - timedelta(days=29)
+    summary = analytics_summary(start, end)
+    if as_json:
+        click.echo(json.dumps(summary, indent=2))
+        return
+    revenue = summary['revenue']
+    click.echo(f'{summary["start"]} - {summary["end"]}: revenue ${revenue["total"]} from {revenue["payments"]} payment(s)')
+    click.echo(f'MRR ${summary["mrr"]}, {summary["past_due"]} past_due, '
+               f'{summary["churn"]["cancellations"]} cancellation(s) (churn rate {summary["churn"]["rate"]})')
+    for plan_tier, row in summary['by_plan_tier'].items():
+        click.echo(f'  {plan_tier:<10} MRR ${row["mrr"]:>12}  {row["active"]:>7} active  {row["past_due"]:>6} past_due  '
+                   f'+{row["new_subscriptions"]} / -{row["cancellations"]}  revenue ${row["revenue"]}')
+
+@main_bp.cli.command('analytics-rebuild')
+@click.option('--engine', type=click.Choice(['sql', 'numpy']), default='sql', show_default=True,
+              help='Aggregate payments in the database, or stream them into NumPy')
+@click.option('--chunk-size', default=500000, show_default=True, help='Payments per NumPy chunk')
+def analytics_rebuild_command(engine, chunk_size):
+    """Recompute the daily rollups from the payments and subscriptions tables"""
+    stats = rebuild_rollups(engine, chunk_size)
+    click.echo(f'Rebuilt {stats["rows"]} rollup rows from {stats["payments"]} payments in {stats["seconds"]:.1f}s '
+               f'({stats["payments_per_second"]:.0f} payments/sec)')
+
+@main_bp.cli.command('export')
+@click.option('--table', 'table_names', multiple=True, type=click.Choice(list(EXPORT_TABLES)),
+              help='Only export these (repeatable; default: all)')
+@click.option('--format', 'formats', multiple=True, type=click.Choice(FORMATS),
+              help='Repeatable (default: csv and columnar, i.e. Parquet if pyarrow is installed, else gzipped NDJSON)')
+@click.option('--out', 'out_dir', default='exports', show_default=True, help='Directory the files are written to')
+@click.option('--chunk-size', default=50000, show_default=True, help='Rows fetched and written at a time')
+@click.option('--watermark', 'watermark_path', default='export_watermark.json', show_default=True,
+              help='Last row exported per table; the next run starts after it')
+@click.option('--full', is_flag=True, help='Export every row regardless of the watermark')
+def export_command(table_names, formats, out_dir, chunk_size, watermark_path, full):
+    """Stream payments and subscriptions created since the last export to files for the data warehouse"""
+    read_from_replica()
+    results = export_tables(
+        table_names or list(EXPORT_TABLES), out_dir, formats or ('csv', 'columnar'),
+        chunk_size=chunk_size, watermark_path=watermark_path, full=full
+    )
+    for name, stats in results.items():
+        click.echo(f'{name}: {stats["rows"]} rows in {stats["seconds"]:.1f}s ({stats["rows_per_second"]:.0f} rows/sec)')
+        for path in stats['files']:
+            click.echo(f'  {path}')
 
 # -------------------------------------------------------------------
 # SECTION 5: FALLBACK ROUTES
 # -------------------------------------------------------------------
 
-@app.route('/payment/success')
+@main_bp.route('/payment/success')
 def payment_success():
     """Success page after one-time payment completion"""
+    # The dashboard we redirect to must show the payment the webhook just wrote
+    stick_to_primary()
     session_id = request.args.get('session_id')
     if not session_id:
         flash('Payment completed successfully!', 'success')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     try:
         # Retrieve checkout session to get user email
-        checkout_session = stripe.checkout.Session.retrieve(session_id)
+        checkout_session = stripe_api.retrieve_checkout_session(session_id)
         user_id = checkout_session.metadata.get('user_id')
         
         if user_id:
-            user = User.query.get(int(user_id))
+            user = user_directory.by_id(int(user_id))
             if user:
                 flash('Payment successful! Thank you for your payment.', 'success')
-                return redirect(url_for('dashboard', email=user.email))
+                return redirect(url_for('main.dashboard', email=user.email))
         
         flash('Payment successful!', 'success')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     except Exception as e:
+        # The payment itself went through; only the redirect to the dashboard is lost
+        logger.warning('Could not retrieve checkout session %s: %s', session_id, e)
         flash('Payment completed successfully!', 'success')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
-@app.route('/subscription/success')
+@main_bp.route('/subscription/success')
 def subscription_success():
     """Success page after subscription checkout completion"""
+    stick_to_primary()
     session_id = request.args.get('session_id')
     if not session_id:
         flash('Subscription completed successfully!', 'success')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     try:
         # Retrieve checkout session to get user email
-        checkout_session = stripe.checkout.Session.retrieve(session_id)
+        checkout_session = stripe_api.retrieve_checkout_session(session_id)
         user_id = checkout_session.metadata.get('user_id')
         
         if user_id:
-            user = User.query.get(int(user_id))
+            user = user_directory.by_id(int(user_id))
             if user:
                 flash('Subscription successful! Your subscription is being activated.', 'success')
-                return redirect(url_for('dashboard', email=user.email))
+                return redirect(url_for('main.dashboard', email=user.email))
         
         flash('Subscription successful!', 'success')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     except Exception as e:
+        logger.warning('Could not retrieve checkout session %s: %s', session_id, e)
         flash('Subscription completed successfully!', 'success')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
 # ===================================================================
 # END OF STRIPE INCORPORATION
@@ -746,8 +1432,16 @@ def subscription_success():
 
 
 
+# `flask run` and `flask <command>` find create_app() themselves; WSGI servers use wsgi.py
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
-        db.create_all()
+        upgrade_schema()
+        # With debug=True the reloader runs the app in a child process; start workers only there
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            if settings.webhook_async:
+                start_webhook_workers()
+            if settings.renewal_scheduler:
+                renewal_scheduler.start()
     app.run(debug=True)
 
@@ -0,0 +1,383 @@
+"""
+ASGI entry point: the same app, with the checkout and webhook endpoints served
+without blocking a thread on Stripe or database I/O
+
+    pip install -r requirements-async.txt
+    uvicorn asgi:app --port 5000
+
+POST /create-checkout-session and POST /create-subscription-checkout-session
+await Stripe over a pooled aiohttp client and use an async SQLAlchemy engine, so
+one process can hold hundreds of checkouts waiting on Stripe at once. With
+WEBHOOK_ASYNC=true, POST /webhook is served the same way (verify, claim and
+enqueue; the webhook workers run the handlers). Every other request, and any
+case these endpoints don't handle themselves (e.g. a form error that redirects
+with a flash message), goes to the Flask app unchanged.
+
+The async engine uses the same database as the Flask app (DATABASE_URL with its
+asyncio driver: sqlite+aiosqlite, postgresql+asyncpg or mysql+aiomysql), or
+ASYNC_DATABASE_URL when set.
+"""
+import importlib.util
+import json
+import logging
+import os
+import time
+from urllib.parse import parse_qs
+
+from flask import session as flask_session
+from sqlalchemy import insert, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import checkout_customer_params, checkout_idempotency_key, create_app, services, start_webhook_workers, webhook_handlers
+from event_batching import ordering_key_for
+from event_ledger import claim_event
+from event_queue import enqueue_event
+from metrics import ERRORS, HTTP_REQUEST_SECONDS, WEBHOOK_EVENTS
+from models import db, User, Subscription
+from read_replicas import stick_to_primary
+from stripe_client import STRIPE_API_VERSION, AsyncStripeGateway, stripe
+from user_lookup import insert_user_statement
+
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# OPTIONAL DEPENDENCIES
+# -------------------------------------------------------------------
+
+ASYNC_DRIVERS = {
+    'sqlite': ('sqlite+aiosqlite', 'aiosqlite'),
+    'postgresql': ('postgresql+asyncpg', 'asyncpg'),
+    'mysql': ('mysql+aiomysql', 'aiomysql'),
+}
+
+
+def async_database_url(url):
+    """The Flask app's database URL with the matching asyncio driver"""
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f'No asyncio driver known for {backend}, set ASYNC_DATABASE_URL')
+    return url.set(drivername=ASYNC_DRIVERS[backend][0])
+
+
+def check_dependencies(url):
+    """Fail at startup, with the install command, if an async dependency is missing"""
+    modules = ['asgiref', 'aiohttp', 'greenlet']
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver and url.drivername == driver[0]:
+        modules.append(driver[1])
+    missing = [name for name in modules if importlib.util.find_spec(name) is None]
+    if missing:
+        raise RuntimeError(
+            f'ASGI mode needs {", ".join(missing)}: pip install -r requirements-async.txt'
+        )
+
+
+flask_app = create_app()
+_services = services(flask_app)
+settings = _services.settings
+plan_tiers = _services.plan_tiers
+user_directory = _services.user_directory
+webhook_verifier = _services.webhook_verifier
+webhook_workers = _services.webhook_workers
+renewal_scheduler = _services.renewal_scheduler
+
+with flask_app.app_context():
+    # db.engine.url has Flask-SQLAlchemy's resolved SQLite path (instance/ folder)
+    _sync_url = db.engine.url
+_async_url = make_url(settings.async_database_url or async_database_url(_sync_url))
+check_dependencies(_async_url)
+
+from asgiref.wsgi import WsgiToAsgi  # noqa: E402  (optional dependency, checked above)
+
+# -------------------------------------------------------------------
+# ASYNC STRIPE CLIENT AND DATABASE
+# -------------------------------------------------------------------
+
+stripe_async = AsyncStripeGateway(
+    settings.stripe_secret_key,
+    api_version=STRIPE_API_VERSION,
+    api_base=settings.stripe_api_base,
+    timeout=settings.stripe_timeout_seconds,
+    max_retries=settings.stripe_max_retries,
+    # One connection per in-flight Stripe call
+    pool_size=settings.stripe_async_pool_size
+)
+
+# A checkout only holds a connection for its user lookup, never while it waits on Stripe
+async_engine = create_async_engine(
+    _async_url,
+    pool_size=settings.async_db_pool_size,
+    max_overflow=settings.async_db_max_overflow
+)
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+flask_asgi = WsgiToAsgi(flask_app)
+
+# -------------------------------------------------------------------
+# REQUEST HELPERS
+# -------------------------------------------------------------------
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def replay_body(body):
+    """receive() that hands an already read body to the Flask app"""
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {'type': 'http.disconnect'}
+        sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    return receive
+
+
+def form_fields(body):
+    return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+
+
+def host_url(scope):
+    """Same as Flask's request.host_url, without the trailing slash"""
+    headers = dict(scope['headers'])
+    host = headers.get(b'host', b'').decode('latin-1')
+    if not host and scope.get('server'):
+        host = f'{scope["server"][0]}:{scope["server"][1]}'
+    return f'{scope.get("scheme", "http")}://{host}'
+
+
+async def send_json(send, status, data, headers=()):
+    body = json.dumps(data).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                    *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def get_or_create_user(session, email, name):
+    """UserRecord for email from the shared user cache, creating the user if needed (see UserDirectory.get_or_create)"""
+    record = user_directory.cached(email)
+    if record and record.stripe_customer_id:
+        return record
+    user = (await session.execute(select(User).filter_by(email=email))).scalar_one_or_none()
+    if user is None:
+        stmt = insert_user_statement(session.bind.dialect.name, email, name)
+        try:
+            await session.execute(stmt if stmt is not None else insert(User).values(email=email, name=name))
+            await session.commit()
+        except IntegrityError:
+            # Created by a concurrent request for the same email
+            await session.rollback()
+        user = (await session.execute(select(User).filter_by(email=email))).scalar_one()
+    return user_directory.remember(user)
+
+
+def primary_session_cookie(scope):
+    """
+    Set-Cookie headers that keep this client's reads on the primary (see read_replicas.stick_to_primary)
+
+    The same Flask session cookie the WSGI checkout routes set, so the success
+    page and dashboard after an async checkout don't read a lagging replica.
+    Empty without replicas.
+    """
+    cookie = dict(scope['headers']).get(b'cookie', b'').decode('latin-1')
+    with flask_app.test_request_context(scope['path'], base_url=host_url(scope), headers={'Cookie': cookie}):
+        stick_to_primary()
+        response = flask_app.response_class()
+        flask_app.session_interface.save_session(flask_app, flask_session._get_current_object(), response)
+    return [(b'set-cookie', value.encode('latin-1')) for value in response.headers.getlist('Set-Cookie')]
+
+# -------------------------------------------------------------------
+# CHECKOUT SESSIONS
+# -------------------------------------------------------------------
+# Each returns (status, JSON body[, extra headers]), or None to let the Flask view answer.
+
+async def create_checkout_session(scope, body):
+    """Async POST /create-checkout-session (see app.create_checkout_session)"""
+    form = form_fields(body)
+    email, name = form.get('email'), form.get('name')
+    price_id = settings.price_id_one_time
+    if not email or not name or not price_id:
+        return None  # the Flask view flashes the error and redirects
+
+    async with AsyncSession() as session:
+        user = await get_or_create_user(session, email, name)
+
+    params = dict(
+        ui_mode='embedded',
+        **checkout_customer_params(user),
+        line_items=[{'price': price_id, 'quantity': 1}],
+        mode='payment',
+        return_url=host_url(scope) + '/payment/success?session_id={CHECKOUT_SESSION_ID}',
+        metadata={'user_id': user.id, 'payment_type': 'one_time'}
+    )
+    checkout_session = await stripe_async.create_checkout_session(
+        params, idempotency_key=checkout_idempotency_key(params, form.get('checkout_nonce'))
+    )
+    # The payment shows up on the primary first; keep this client's dashboard there
+    return 200, {'clientSecret': checkout_session.client_secret}, primary_session_cookie(scope)
+
+
+async def create_subscription_checkout_session(scope, body):
+    """Async POST /create-subscription-checkout-session (see app.create_subscription_checkout_session)"""
+    form = form_fields(body)
+    email, name, plan_tier = form.get('email'), form.get('name'), form.get('plan_tier')
+    if not email or not name or not plan_tier:
+        return 400, {'error': 'Please fill in all fields and select a plan'}
+
+    price_id = plan_tiers.price_for_tier(plan_tier)
+    if not price_id:
+        price_id_env_key = f'STRIPE_PRICE_ID_SUBS_{plan_tier.upper()}'
+        return 400, {'error': f'Price ID not configured for {plan_tier} plan. Please set {price_id_env_key} in .env'}
+
+    async with AsyncSession() as session:
+        user = await get_or_create_user(session, email, name)
+        active_subscription = (await session.execute(
+            select(Subscription.id).filter_by(user_id=user.id, status='active').limit(1)
+        )).first()
+    if active_subscription:
+        return 400, {'error': 'You already have an active subscription'}
+
+    params = dict(
+        ui_mode='embedded',
+        **checkout_customer_params(user),
+        line_items=[{'price': price_id, 'quantity': 1}],
+        mode='subscription',
+        return_url=host_url(scope) + '/subscription/success?session_id={CHECKOUT_SESSION_ID}',
+        metadata={'user_id': user.id, 'payment_type': 'subscription', 'plan_tier': plan_tier},
+        subscription_data={'metadata': {'user_id': user.id, 'plan_tier': plan_tier}}
+    )
+    checkout_session = await stripe_async.create_checkout_session(
+        params, idempotency_key=checkout_idempotency_key(params, form.get('checkout_nonce'))
+    )
+    # The payment shows up on the primary first; keep this client's dashboard there
+    return 200, {'clientSecret': checkout_session.client_secret}, primary_session_cookie(scope)
+
+# -------------------------------------------------------------------
+# WEBHOOK (WEBHOOK_ASYNC=true)
+# -------------------------------------------------------------------
+
+def _claim_and_enqueue(session, event_id, event_type, payload, ordering_key):
+    """Runs on the async session's sync facade, so the ledger and queue code is shared"""
+    if not claim_event(event_id, event_type, session=session):
+        session.rollback()
+        return False
+    enqueue_event(event_id, event_type, payload, ordering_key, session=session)  # commits the claim too
+    return True
+
+
+async def webhook(scope, body):
+    """Async POST /webhook: verify, record and queue the event (see app.webhook)"""
+    if not webhook_verifier:
+        return None  # the Flask view logs and reports the misconfiguration
+
+    sig_header = dict(scope['headers']).get(b'stripe-signature', b'').decode('latin-1')
+    try:
+        event = webhook_verifier.construct_event(body, sig_header)
+    except Exception as e:
+        logger.warning('Webhook verification failed: %s', e)
+        WEBHOOK_EVENTS.inc(event_type='unknown', outcome='rejected')
+        return 400, {'error': 'Webhook verification failed'}
+
+    event_type = event['type']
+    event_id = event.get('id', 'unknown')
+    if not webhook_handlers.handles(event_type):
+        WEBHOOK_EVENTS.inc(event_type=event_type, outcome='ignored')
+        return 200, {'status': 'ignored'}
+    try:
+        async with AsyncSession() as session:
+            queued = await session.run_sync(
+                _claim_and_enqueue, event_id, event_type, body.decode('utf-8'), ordering_key_for(event)
+            )
+    except Exception:
+        logger.exception('Could not record event', extra={'event_id': event_id, 'event_type': event_type})
+        ERRORS.inc(component='webhook')
+        return 500, {'error': 'Could not record event'}
+
+    if not queued:
+        logger.info('Duplicate event skipped', extra={'event_id': event_id, 'event_type': event_type})
+        WEBHOOK_EVENTS.inc(event_type=event_type, outcome='duplicate')
+        return 200, {'status': 'duplicate'}
+    webhook_workers.notify()
+    WEBHOOK_EVENTS.inc(event_type=event_type, outcome='queued')
+    return 200, {'status': 'queued'}
+
+# -------------------------------------------------------------------
+# ASGI APPLICATION
+# -------------------------------------------------------------------
+
+ROUTES = {
+    ('POST', '/create-checkout-session'): create_checkout_session,
+    ('POST', '/create-subscription-checkout-session'): create_subscription_checkout_session,
+}
+if settings.webhook_async:
+    ROUTES[('POST', '/webhook')] = webhook
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if settings.webhook_async:
+                start_webhook_workers(flask_app)
+            if settings.renewal_scheduler:
+                renewal_scheduler.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if webhook_workers.running:
+                webhook_workers.stop()
+            if renewal_scheduler.running:
+                renewal_scheduler.stop()
+            await stripe_async.close()
+            await async_engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    route = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if route is None:
+        return await flask_asgi(scope, receive, send)
+
+    started = time.perf_counter()
+    body = await read_body(receive)
+    try:
+        result = await route(scope, body)
+    except stripe.StripeError as e:
+        result = 400, {'error': f'Stripe error: {str(e)}'}
+    except Exception as e:
+        logger.exception('Error in %s', scope['path'])
+        result = 500, {'error': f'An error occurred: {str(e)}'}
+    if result is None:
+        return await flask_asgi(scope, replay_body(body), send)
+
+    status = result[0]
+    await send_json(send, *result)
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=scope['method'],
+                                 route=scope['path'], status=str(status))
+    if status >= 500:
+        ERRORS.inc(component='http')
+
+
+if __name__ == '__main__':
+    import uvicorn
+    from migrations import upgrade_schema
+
+    with flask_app.app_context():
+        upgrade_schema()
+    uvicorn.run(app, host='127.0.0.1', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from models import db, batched_commits
+from event_ledger import claim_event
+
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------------------------------------------------------
+# EVENT SOURCES
+# -------------------------------------------------------------------
+
+def iter_jsonl_events(path):
+    """Events from a local JSONL export (one Stripe event object per line, oldest first)"""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _fetch_window(list_events, start, end, event_types):
+    """All events created in [start, end), oldest first"""
+    params = {'created': {'gte': start, 'lt': end}, 'limit': 100}
+    if event_types:
+        params['types'] = list(event_types)
+    events = list(list_events(params).auto_paging_iter())
+    events.sort(key=lambda e: (e.get('created', 0), e.get('id')))
+    return events
+
+
+def iter_stripe_events(list_events, since, until, event_types=None, fetch_workers=4, window_seconds=86400):
+    """
+    Events from the Stripe API (list_events(params) -> ListObject), oldest first
+
+    The time range is split into windows that are fetched in parallel by
+    `fetch_workers` threads; windows are still yielded in chronological order
+    and at most `fetch_workers` of them are held in memory.
+    """
+    windows = []
+    start = since
+    while start < until:
+        windows.append((start, min(start + window_seconds, until)))
+        start += window_seconds
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        pending = []
+        for window in windows:
+            pending.append(executor.submit(_fetch_window, list_events, window[0], window[1], event_types))
+            if len(pending) >= fetch_workers:
+                yield from pending.pop(0).result()
+        for future in pending:
+            yield from future.result()
+
+
+# -------------------------------------------------------------------
+# CHECKPOINTS
+# -------------------------------------------------------------------
+
+# last_created/last_ids mark how far the replay got; events that failed are
+# kept in `failed` (event ID -> created) instead, so the next run retries them.
+
+def load_checkpoint(path):
+    checkpoint = {'last_created': 0, 'last_ids': [], 'processed': 0, 'failed': {}}
+    if path and os.path.exists(path):
+        with open(path) as f:
+            checkpoint.update(json.load(f))
+    return checkpoint
+
+
+def resume_from(checkpoint):
+    """Earliest `created` a resumed run must fetch: the checkpoint, or an older failed event"""
+    return min([checkpoint['last_created'], *checkpoint['failed'].values()])
+
+
+def save_checkpoint(path, checkpoint):
+    if not path:
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)  # atomic, so a crash never leaves a half-written checkpoint
+
+
+def _already_done(event, checkpoint):
+    if event.get('id') in checkpoint['failed']:
+        return False
+    created = event.get('created', 0)
+    if created < checkpoint['last_created']:
+        return True
+    return created == checkpoint['last_created'] and event.get('id') in checkpoint['last_ids']
+
+
+def _advance(checkpoint, event):
+    checkpoint['failed'].pop(event.get('id'), None)
+    created = event.get('created', 0)
+    if created < checkpoint['last_created']:
+        # A retried failure from before the checkpoint
+        checkpoint['processed'] += 1
+        return
+    if created != checkpoint['last_created']:
+        checkpoint['last_created'] = created
+        checkpoint['last_ids'] = []
+    checkpoint['last_ids'].append(event.get('id'))
+    checkpoint['processed'] += 1
+
+
+# -------------------------------------------------------------------
+# REPLAY
+# -------------------------------------------------------------------
+
+def _apply(event, process_event, handled_types):
+    """Run one event through the ledger and its handler"""
+    if event.get('type') not in handled_types:
+        return 'skipped'
+    if not claim_event(event.get('id'), event.get('type')):
+        return 'duplicates'
+    process_event(event)
+    return 'applied'
+
+
+def _apply_batch(batch, process_event, handled_types, stats):
+    """
+    Apply a batch in one transaction; fall back to one transaction per event on error
+
+    Returns the events that could not be applied.
+    """
+    try:
+        with batched_commits():
+            outcomes = [_apply(event, process_event, handled_types) for event in batch]
+        db.session.commit()
+        for outcome in outcomes:
+            stats[outcome] += 1
+        return []
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('Backfill batch failed (%s), retrying its events one by one', e)
+
+    failed = []
+    for event in batch:
+        try:
+            outcome = _apply(event, process_event, handled_types)
+            db.session.commit()
+            stats[outcome] += 1
+        except Exception as e:
+            db.session.rollback()
+            stats['failed'] += 1
+            failed.append(event)
+            logger.error('Backfill could not apply event: %s', e,
+                         extra={'event_id': event.get('id'), 'event_type': event.get('type')})
+    return failed
+
+
+def run_backfill(events, process_event, handled_types, batch_size=100, checkpoint_path=None):
+    """
+    Feed events through the webhook handlers in batches of `batch_size`
+
+    Each batch is committed once and progress is checkpointed after it, so an
+    interrupted run resumes where it stopped. Events that failed stay in the
+    checkpoint and are retried by the next run with it. Returns a summary dict
+    (`failed_ids`: the events that failed in this run).
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    stats = {'seen': 0, 'applied': 0, 'duplicates': 0, 'skipped': 0, 'failed': 0, 'failed_ids': []}
+    started = time.perf_counter()
+    batch = []
+
+    def flush():
+        failed = _apply_batch(batch, process_event, handled_types, stats)
+        failed_ids = [event.get('id') for event in failed]
+        for event in batch:
+            if event.get('id') in failed_ids:
+                checkpoint['failed'][event.get('id')] = event.get('created', 0)
+            else:
+                _advance(checkpoint, event)
+        stats['failed_ids'].extend(failed_ids)
+        save_checkpoint(checkpoint_path, checkpoint)
+        elapsed = time.perf_counter() - started
+        logger.info('Backfill progress: %s events, %s applied, %.1f events/sec',
+                    stats['seen'], stats['applied'], stats['seen'] / elapsed)
+        batch.clear()
+
+    for event in events:
+        if _already_done(event, checkpoint):
+            continue
+        stats['seen'] += 1
+        batch.append(event)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    stats['seconds'] = time.perf_counter() - started
+    stats['events_per_second'] = stats['seen'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+
+def parse_timestamp(value):
+    """Accept a Unix timestamp or an ISO date (YYYY-MM-DD[THH:MM:SS], UTC)"""
+    if value is None:
+        return None
+    if str(value).isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
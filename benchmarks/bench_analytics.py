@@ -0,0 +1,165 @@
+"""
+Analytics from the daily rollups vs. ad-hoc scans of payments and subscriptions
+
+    python benchmarks/bench_analytics.py                          # SQLite, 10,000,000 payments
+    python benchmarks/bench_analytics.py --payments 1000000 --subscriptions 50000
+    python benchmarks/bench_analytics.py --url postgresql://localhost/bench
+
+Fills payments over `--days` days and subscriptions in every status, then
+reports for a 30-day window: the ad-hoc queries finance runs today (daily
+revenue, MRR per plan tier, past_due count, churn), the same answers from the
+rollups (analytics_summary), and how long a full rollup rebuild takes with
+each engine. The answers of both paths are checked against each other.
+
+The target database is dropped and recreated, so never point --url at real data.
+"""
+import argparse
+import importlib.util
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import func
+
+from analytics import CHURNED_STATUSES, MRR_STATUSES, analytics_summary, rebuild_rollups
+from models import db, Payment, Subscription
+
+
+PLAN_TIERS = (('one', 10), ('two', 20))
+STATUSES = ('active',) * 14 + ('past_due',) * 2 + ('cancelled',) * 4
+
+
+def populate(payments, subscriptions, days, chunk=100000):
+    db.drop_all()
+    db.create_all()
+    now = datetime.utcnow()
+    rng = random.Random(42)
+    users = max(subscriptions, 1000)
+    db.session.execute(db.metadata.tables['users'].insert(), [
+        {'id': i, 'email': f'user{i}@example.com', 'name': f'User {i}', 'created_at': now}
+        for i in range(1, users + 1)
+    ])
+    rows = []
+    for i in range(1, subscriptions + 1):
+        plan_tier, amount = rng.choice(PLAN_TIERS)
+        status = rng.choice(STATUSES)
+        created_at = now - timedelta(seconds=rng.randint(0, days * 86400))
+        updated_at = created_at + (now - created_at) * rng.random()
+        rows.append({
+            'user_id': i, 'amount': amount, 'status': status, 'plan_tier': plan_tier,
+            'stripe_subscription_id': f'sub_{i}', 'stripe_price_id': f'price_{plan_tier}',
+            'start_date': created_at, 'next_billing_date': now + timedelta(days=rng.randint(0, 30)),
+            'cancelled_at': updated_at if status == 'cancelled' else None,
+            'created_at': created_at, 'updated_at': updated_at,
+        })
+    db.session.execute(db.metadata.tables['subscriptions'].insert(), rows)
+    db.session.commit()
+
+    table = db.metadata.tables['payments']
+    for start in range(0, payments, chunk):
+        db.session.execute(table.insert(), [
+            {
+                'user_id': rng.randint(1, users), 'amount': rng.choice((10, 20, 25, 49.99)),
+                'payment_type': 'one_time' if n % 4 else 'subscription',
+                # Invoice payments belong to a subscription (revenue per plan tier)
+                'subscription_id': None if n % 4 or not subscriptions else rng.randint(1, subscriptions),
+                'status': 'completed' if n % 50 else 'failed',
+                'transaction_id': f'cs_{n}', 'created_at': now - timedelta(seconds=rng.randint(0, days * 86400)),
+            }
+            for n in range(start, min(start + chunk, payments))
+        ])
+        db.session.commit()
+
+
+def adhoc_summary(start, end):
+    """The same numbers as analytics_summary, straight from the raw tables"""
+    window_start = datetime.combine(start, datetime.min.time())
+    window_end = datetime.combine(end + timedelta(days=1), datetime.min.time())
+    day = func.date(Payment.created_at)
+    revenue = db.session.query(day, Payment.payment_type, func.sum(Payment.amount), func.count(Payment.id)).filter(
+        Payment.status == 'completed', Payment.created_at >= window_start, Payment.created_at < window_end
+    ).group_by(day, Payment.payment_type).all()
+    mrr = db.session.query(Subscription.plan_tier, func.sum(Subscription.amount)).filter(
+        Subscription.status.in_(MRR_STATUSES)
+    ).group_by(Subscription.plan_tier).all()
+    past_due = db.session.query(func.count(Subscription.id)).filter(Subscription.status == 'past_due').scalar()
+    churned = db.session.query(func.count(Subscription.id)).filter(
+        Subscription.status.in_(CHURNED_STATUSES),
+        Subscription.cancelled_at >= window_start, Subscription.cancelled_at < window_end
+    ).scalar()
+    return {
+        'revenue': sum((Decimal(row[2]) for row in revenue), Decimal(0)).quantize(Decimal('0.01')),
+        'mrr': sum((Decimal(row[1]) for row in mrr), Decimal(0)).quantize(Decimal('0.01')),
+        'past_due': past_due,
+        'cancellations': churned,
+    }
+
+
+def timed(fn, samples):
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='sqlite:///bench_analytics.db')
+    parser.add_argument('--payments', type=int, default=10_000_000)
+    parser.add_argument('--subscriptions', type=int, default=200_000)
+    parser.add_argument('--days', type=int, default=730, help='history the rows are spread over')
+    parser.add_argument('--samples', type=int, default=5, help='runs per query measurement (median)')
+    parser.add_argument('--skip-populate', action='store_true', help='reuse the rows of a previous run')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.url
+    db.init_app(app)
+    with app.app_context():
+        if not args.skip_populate:
+            started = time.perf_counter()
+            populate(args.payments, args.subscriptions, args.days)
+            print(f'Inserted {args.payments:,} payments and {args.subscriptions:,} subscriptions '
+                  f'in {time.perf_counter() - started:.1f}s')
+
+        print(f'\n{"rebuild":<32} {"seconds":>9} {"payments/s":>12}')
+        engines = ['sql']
+        if importlib.util.find_spec('numpy'):
+            engines.append('numpy')
+        else:
+            print('(numpy not installed, skipping the numpy engine)')
+        for engine in engines:
+            stats = rebuild_rollups(engine)
+            print(f'{engine:<32} {stats["seconds"]:>9.2f} {stats["payments_per_second"]:>12,.0f}')
+
+        end = datetime.utcnow().date()
+        start = end - timedelta(days=29)
+        adhoc, adhoc_ms = timed(lambda: adhoc_summary(start, end), args.samples)
+        rollup, rollup_ms = timed(lambda: analytics_summary(start, end), args.samples)
+        print(f'\n{"30-day summary":<32} {"median ms":>9}')
+        print(f'{"ad-hoc scans":<32} {adhoc_ms:>9.2f}')
+        print(f'{"rollups (analytics_summary)":<32} {rollup_ms:>9.2f}   {adhoc_ms / rollup_ms:.0f}x faster')
+
+        from_rollups = {
+            'revenue': Decimal(rollup['revenue']['total']).quantize(Decimal('0.01')),
+            'mrr': Decimal(rollup['mrr']).quantize(Decimal('0.01')),
+            'past_due': rollup['past_due'],
+            'cancellations': rollup['churn']['cancellations'],
+        }
+        print(f'\nad-hoc:  {adhoc}\nrollups: {from_rollups}')
+        if adhoc != from_rollups:
+            print('MISMATCH between ad-hoc scans and rollups')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+Concurrent checkout throughput: sync Flask views vs. the ASGI app (asgi.py)
+
+    pip install -r requirements-async.txt
+    python benchmarks/bench_async_checkout.py                       # 1000 checkouts, 200 clients
+    python benchmarks/bench_async_checkout.py --concurrency 500 --latency-ms 300
+    python benchmarks/bench_async_checkout.py --sync-threads 64
+
+`--concurrency` clients post checkouts back to back against the fake Stripe
+server (benchmarks/fake_stripe.py). The sync path is served by a fixed number
+of threads (`--sync-threads`, like a threaded WSGI worker), so clients beyond
+that wait for a free thread; the ASGI path serves every client from one event
+loop. Both run in this process against the same throwaway SQLite database.
+Reported per route and mode: req/s, p50/p95/p99 latency (including the wait
+for a free thread) and errors.
+"""
+import argparse
+import asyncio
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_stripe import FakeStripeState, start_in_thread
+
+
+PRICES = {
+    'price_bench_one_time': 2500,
+    'price_bench_one': 1000,
+    'price_bench_two': 2000,
+}
+ROUTES = (
+    ('POST /create-checkout-session', '/create-checkout-session', {}),
+    ('POST /create-subscription-checkout-session', '/create-subscription-checkout-session', {'plan_tier': 'one'}),
+)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(results, wall_seconds):
+    latencies = sorted(r[0] for r in results)
+    return {
+        'requests': len(results),
+        'errors': sum(1 for r in results if r[1] >= 400),
+        'req_per_s': len(results) / wall_seconds if wall_seconds else 0.0,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+
+def form(i, extra):
+    return {'email': f'bench{i}@example.com', 'name': f'Bench User {i}', **extra}
+
+# -------------------------------------------------------------------
+# SYNC (Flask views, fixed thread count)
+# -------------------------------------------------------------------
+
+def run_sync(flask_app, path, extra, requests, users, concurrency, sync_threads):
+    server_threads = threading.BoundedSemaphore(sync_threads)
+    local = threading.local()
+
+    def send(i):
+        if not hasattr(local, 'client'):
+            local.client = flask_app.test_client()
+        started = time.perf_counter()
+        with server_threads:
+            response = local.client.post(path, data=form(i % users + 1, extra))
+        return (time.perf_counter() - started) * 1000, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, range(requests)))
+    return summarize(results, time.perf_counter() - started)
+
+# -------------------------------------------------------------------
+# ASYNC (asgi.app, one event loop)
+# -------------------------------------------------------------------
+
+async def asgi_post(asgi_app, path, fields):
+    """Call the ASGI app directly with a form POST (like the test client); returns the status"""
+    body = urlencode(fields).encode()
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+        'headers': [(b'host', b'bench.local'), (b'content-type', b'application/x-www-form-urlencoded'),
+                    (b'content-length', str(len(body)).encode())],
+        'client': ('127.0.0.1', 0), 'server': ('bench.local', 80),
+    }
+    status = None
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await asgi_app(scope, receive, send)
+    return status
+
+
+async def run_async(asgi_app, path, extra, requests, users, concurrency):
+    pending = iter(range(requests))
+    results = []
+
+    async def client_loop():
+        for i in pending:
+            started = time.perf_counter()
+            status = await asgi_post(asgi_app, path, form(i % users + 1, extra))
+            results.append(((time.perf_counter() - started) * 1000, status))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    return summarize(results, time.perf_counter() - started)
+
+# -------------------------------------------------------------------
+# REPORTING
+# -------------------------------------------------------------------
+
+def print_report(results):
+    print(f'\n{"route":<44} {"mode":<6} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for route, modes in results.items():
+        for mode, row in modes.items():
+            print(f'{route:<44} {mode:<6} {row["req_per_s"]:>8.1f} {row["p50_ms"]:>8.2f} {row["p95_ms"]:>8.2f} '
+                  f'{row["p99_ms"]:>8.2f} {row["errors"]:>7}')
+        if modes['sync']['req_per_s']:
+            print(f'{"":<44} {"":<6} {modes["async"]["req_per_s"] / modes["sync"]["req_per_s"]:>7.1f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000, help='checkouts per route and mode')
+    parser.add_argument('--concurrency', type=int, default=200, help='clients sending checkouts at once')
+    parser.add_argument('--sync-threads', type=int, default=16, help='threads serving the sync path')
+    parser.add_argument('--users', type=int, default=200, help='existing users the checkouts are spread over')
+    parser.add_argument('--latency-ms', type=float, default=150.0, help='fake Stripe API latency')
+    parser.add_argument('--jitter-ms', type=float, default=20.0)
+    parser.add_argument('--stripe-url', help='use a fake Stripe server started separately (serving the bench prices) '
+                                             'instead of one in this process')
+    parser.add_argument('--verbose', action='store_true', help="show the app's own log output")
+    args = parser.parse_args()
+
+    if args.stripe_url:
+        server, base_url = None, args.stripe_url
+    else:
+        server, base_url = start_in_thread(FakeStripeState(PRICES, args.latency_ms, args.jitter_ms))
+    workdir = tempfile.mkdtemp(prefix='bench_async_checkout_')
+
+    # create_app() (run by importing asgi) reads its configuration from the environment
+    os.environ.update({
+        'SECRET_KEY': 'bench',
+        'DATABASE_URL': f'sqlite:///{os.path.join(workdir, "bench.db")}',
+        'STRIPE_SECRET_KEY': 'sk_test_bench',
+        'STRIPE_API_BASE': base_url,
+        'STRIPE_PRICE_ID_ONE_TIME': 'price_bench_one_time',
+        'STRIPE_PRICE_ID_SUBS_ONE': 'price_bench_one',
+        'STRIPE_PRICE_ID_SUBS_TWO': 'price_bench_two',
+        # Neither path should be limited by its Stripe connection pool
+        'STRIPE_POOL_SIZE': str(args.sync_threads),
+        'STRIPE_ASYNC_POOL_SIZE': str(args.concurrency),
+        'LOG_LEVEL': 'INFO' if args.verbose else 'ERROR',
+    })
+    from app import services
+    from asgi import app as asgi_app, flask_app, stripe_async
+    from migrations import upgrade_schema
+    from models import db, User
+
+    with flask_app.app_context():
+        upgrade_schema()
+        now = datetime.utcnow()
+        db.session.execute(User.__table__.insert(), [
+            {'id': i, 'email': f'bench{i}@example.com', 'name': f'Bench User {i}',
+             'stripe_customer_id': f'cus_bench_{i}', 'created_at': now}
+            for i in range(1, args.users + 1)
+        ])
+        db.session.commit()
+    services(flask_app).price_catalog.warm(services(flask_app).settings.price_ids)
+
+    print(f'{args.requests} checkouts per route and mode, {args.concurrency} concurrent clients, '
+          f'{args.sync_threads} sync threads, Stripe latency {args.latency_ms}±{args.jitter_ms}ms')
+    results = {}
+    for route, path, extra in ROUTES:
+        results[route] = {
+            'sync': run_sync(flask_app, path, extra, args.requests, args.users, args.concurrency, args.sync_threads)
+        }
+
+    async def run_all_async():
+        # One event loop for every route: the app's Stripe and database pools belong to it
+        for route, path, extra in ROUTES:
+            results[route]['async'] = await run_async(
+                asgi_app, path, extra, args.requests, args.users, args.concurrency
+            )
+        await stripe_async.close()
+    asyncio.run(run_all_async())
+    if server:
+        server.shutdown()
+    print_report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Warehouse export: ORM row by row vs. the streamed export (export.py)
+
+    python benchmarks/bench_export.py                             # SQLite, 1,000,000 payments
+    python benchmarks/bench_export.py --payments 10000000 --skip-orm
+    python benchmarks/bench_export.py --url postgresql://localhost/bench
+
+Fills the payments table (see bench_analytics.py), then exports it once
+through `Payment.query.all()` and csv.writer, the way the nightly job does
+today, and once per format through export_table. Each run reports rows/sec
+and the peak Python memory it allocated (tracemalloc, measured in a second
+run so tracing doesn't skew the timing).
+
+The target database is dropped and recreated, so never point --url at real data.
+"""
+import argparse
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from bench_analytics import populate
+from export import export_table, pyarrow_available
+from models import db, Payment
+
+
+COLUMNS = [column.name for column in Payment.__table__.columns]
+
+
+def orm_export(out_dir):
+    with open(os.path.join(out_dir, 'payments_orm.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        rows = 0
+        for payment in Payment.query.order_by(Payment.created_at, Payment.id).all():
+            writer.writerow([getattr(payment, name) for name in COLUMNS])
+            rows += 1
+    db.session.remove()
+    return rows
+
+
+def measure(fn):
+    """(rows, seconds, peak MiB)"""
+    started = time.perf_counter()
+    rows = fn()
+    seconds = time.perf_counter() - started
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return rows, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='sqlite:///bench_export.db')
+    parser.add_argument('--payments', type=int, default=1_000_000)
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--skip-orm', action='store_true', help='the ORM baseline holds every row in memory')
+    parser.add_argument('--skip-populate', action='store_true', help='reuse the rows of a previous run')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.url
+    db.init_app(app)
+    out_dir = tempfile.mkdtemp(prefix='bench_export_')
+    try:
+        with app.app_context():
+            if not args.skip_populate:
+                started = time.perf_counter()
+                populate(args.payments, subscriptions=1000, days=730)
+                print(f'Inserted {args.payments:,} payments in {time.perf_counter() - started:.1f}s')
+
+            runs = []
+            if not args.skip_orm:
+                runs.append(('ORM row by row (csv)', lambda: orm_export(out_dir)))
+            formats = ['csv', 'ndjson'] + (['parquet'] if pyarrow_available() else [])
+            for fmt in formats:
+                runs.append((f'streamed ({fmt})', lambda fmt=fmt: export_table(
+                    'payments', out_dir, (fmt,), chunk_size=args.chunk_size)['rows']))
+            runs.append(('streamed (csv + columnar)', lambda: export_table(
+                'payments', out_dir, ('csv', 'columnar'), chunk_size=args.chunk_size)['rows']))
+
+            print(f'\n{"export":<28} {"rows":>11} {"seconds":>8} {"rows/s":>10} {"peak MiB":>9}')
+            for label, fn in runs:
+                rows, seconds, peak = measure(fn)
+                print(f'{label:<28} {rows:>11,} {seconds:>8.2f} {rows / seconds:>10,.0f} {peak:>9.1f}')
+            if not pyarrow_available():
+                print('(pyarrow not installed, Parquet skipped)')
+    finally:
+        shutil.rmtree(out_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Lookup latency of the hot query paths with and without the indexes from models.py
+
+    python benchmarks/bench_indexes.py                       # SQLite, 1,000,000 payments
+    python benchmarks/bench_indexes.py --rows 100000
+    python benchmarks/bench_indexes.py --url postgresql://localhost/bench
+
+The target database is dropped and recreated, so never point --url at real data.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.schema import DropIndex
+
+from models import db
+
+
+QUERIES = {
+    'payments by user (page)': (
+        "SELECT id, amount, created_at FROM payments WHERE user_id = :user_id AND payment_type = 'one_time' "
+        'ORDER BY created_at DESC, id DESC LIMIT 26'
+    ),
+    'payment duplicate check': (
+        "SELECT id FROM payments WHERE user_id = :user_id AND payment_type = 'one_time' "
+        'AND transaction_id = :transaction_id'
+    ),
+    'active subscription check': (
+        "SELECT id FROM subscriptions WHERE user_id = :user_id AND status = 'active'"
+    ),
+    'subscription by stripe id': (
+        'SELECT id FROM subscriptions WHERE stripe_subscription_id = :stripe_subscription_id'
+    ),
+}
+
+# Indexes added for the hot paths (unique constraints stay in both runs)
+BENCH_INDEXES = [
+    'ix_payments_user_type_created',
+    'ix_payments_user_type_transaction',
+    'ix_subscriptions_user_id_status',
+]
+
+
+def populate(engine, rows, users, chunk=50000):
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    now = datetime.utcnow()
+    rng = random.Random(42)
+
+    with engine.begin() as conn:
+        conn.execute(db.metadata.tables['users'].insert(), [
+            {'id': i, 'email': f'user{i}@example.com', 'name': f'User {i}', 'created_at': now}
+            for i in range(1, users + 1)
+        ])
+        conn.execute(db.metadata.tables['subscriptions'].insert(), [
+            {
+                'user_id': i, 'amount': 10, 'status': 'active' if i % 3 else 'cancelled',
+                'plan_tier': 'one', 'stripe_subscription_id': f'sub_{i}', 'stripe_price_id': 'price_one',
+                'start_date': now, 'next_billing_date': now + timedelta(days=30), 'created_at': now,
+            }
+            for i in range(1, users + 1)
+        ])
+
+    payments = db.metadata.tables['payments']
+    for start in range(0, rows, chunk):
+        with engine.begin() as conn:
+            conn.execute(payments.insert(), [
+                {
+                    'user_id': rng.randint(1, users), 'amount': 25,
+                    'payment_type': 'one_time' if n % 4 else 'subscription', 'status': 'completed',
+                    'transaction_id': f'cs_{n}', 'created_at': now - timedelta(minutes=n),
+                }
+                for n in range(start, min(start + chunk, rows))
+            ])
+
+
+def measure(engine, rows, users, samples):
+    rng = random.Random(7)
+    results = {}
+    with engine.connect() as conn:
+        for name, sql in QUERIES.items():
+            timings = []
+            for _ in range(samples):
+                params = {
+                    'user_id': rng.randint(1, users),
+                    'transaction_id': f'cs_{rng.randint(0, rows - 1)}',
+                    'stripe_subscription_id': f'sub_{rng.randint(1, users)}',
+                }
+                started = time.perf_counter()
+                conn.execute(text(sql), params).fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            results[name] = (statistics.median(timings), timings[int(len(timings) * 0.95) - 1])
+    return results
+
+
+def drop_bench_indexes(engine):
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in BENCH_INDEXES:
+                    conn.execute(DropIndex(index))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='sqlite:///bench_indexes.db')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='payments rows')
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--samples', type=int, default=200, help='queries per measurement')
+    args = parser.parse_args()
+
+    engine = create_engine(args.url)
+    print(f'Populating {args.rows:,} payments / {args.users:,} users on {engine.dialect.name}...')
+    started = time.perf_counter()
+    populate(engine, args.rows, args.users)
+    print(f'Populated in {time.perf_counter() - started:.1f}s')
+
+    indexed = measure(engine, args.rows, args.users, args.samples)
+    drop_bench_indexes(engine)
+    unindexed = measure(engine, args.rows, args.users, max(10, args.samples // 10))
+
+    print(f'\n{"query":<28} {"indexed p50/p95 (ms)":>22} {"no index p50/p95 (ms)":>23}')
+    for name in QUERIES:
+        i50, i95 = indexed[name]
+        u50, u95 = unindexed[name]
+        print(f'{name:<28} {i50:>10.3f} / {i95:<9.3f} {u50:>11.3f} / {u95:<9.3f}')
+
+    db.metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    main()
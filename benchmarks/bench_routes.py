@@ -0,0 +1,296 @@
+"""
+Throughput, latency and DB query counts of the checkout, webhook and page routes
+
+    python benchmarks/bench_routes.py                          # 200 requests per route, 8 threads
+    python benchmarks/bench_routes.py --latency-ms 80 --concurrency 16
+    python benchmarks/bench_routes.py --async                  # WEBHOOK_ASYNC=true (queue + workers)
+
+    # Catch regressions before a deploy
+    python benchmarks/bench_routes.py --save baseline.json     # on the known-good revision
+    python benchmarks/bench_routes.py --baseline baseline.json # exits 1 on a regression
+
+Runs the app in-process against a throwaway SQLite database and the fake
+Stripe server (benchmarks/fake_stripe.py), and sends correctly signed webhooks
+for all eight handled event types (benchmarks/webhook_events.py). Reported per
+route: req/s, p50/p95/p99 latency, DB queries and Stripe API calls per request.
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_stripe import FakeStripeState, start_in_thread
+from webhook_events import LIFECYCLE, EventFactory, price_object, sign_payload
+
+
+WEBHOOK_SECRET = 'whsec_bench'
+API_KEY = 'bench_api_key'
+API_HEADERS = {'Authorization': f'Bearer {API_KEY}'}
+PRICES = {
+    'price_bench_one_time': 2500,
+    'price_bench_one': 1000,
+    'price_bench_two': 2000,
+}
+
+
+# -------------------------------------------------------------------
+# MEASUREMENT
+# -------------------------------------------------------------------
+
+class QueryCounter:
+    """Counts SQL statements per thread (one request runs in one thread)"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run_route(app, queries, stripe_state, requests, concurrency):
+    """
+    Send `requests` (callables taking a test client) with `concurrency` threads
+
+    Returns the metrics row for the route.
+    """
+    local = threading.local()
+
+    def send(make_request):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        queries.reset()
+        started = time.perf_counter()
+        response = make_request(local.client)
+        response.get_data()  # streamed responses are rendered here
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        return elapsed_ms, response.status_code, queries.count
+
+    stripe_calls_before = stripe_state.request_count
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, requests))
+    wall_seconds = time.perf_counter() - started
+
+    latencies = sorted(r[0] for r in results)
+    errors = sum(1 for r in results if r[1] >= 400)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'req_per_s': len(results) / wall_seconds if wall_seconds else 0.0,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'queries_per_req': sum(r[2] for r in results) / len(results) if results else 0.0,
+        'stripe_calls_per_req': (stripe_state.request_count - stripe_calls_before) / len(results) if results else 0.0,
+    }
+
+
+# -------------------------------------------------------------------
+# SCENARIO
+# -------------------------------------------------------------------
+
+def seed(db, User, Payment, users, payments_per_user):
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'email': f'bench{i}@example.com', 'name': f'Bench User {i}',
+         'stripe_customer_id': f'cus_bench_{i}', 'created_at': now}
+        for i in range(1, users + 1)
+    ])
+    if payments_per_user:
+        db.session.execute(Payment.__table__.insert(), [
+            {'user_id': i, 'amount': 25, 'payment_type': 'one_time', 'status': 'completed',
+             'transaction_id': f'cs_seed_{i}_{n}', 'created_at': now - timedelta(hours=n)}
+            for i in range(1, users + 1) for n in range(payments_per_user)
+        ])
+    db.session.commit()
+
+
+def post_form(path, data):
+    return lambda client: client.post(path, data=data)
+
+
+def get(path, headers=None):
+    return lambda client: client.get(path, headers=headers)
+
+
+def post_webhook(event):
+    payload = json.dumps(event)
+    headers = {'Content-Type': 'application/json', 'Stripe-Signature': sign_payload(payload, WEBHOOK_SECRET)}
+    return lambda client: client.post('/webhook', data=payload, headers=headers)
+
+
+def build_routes(n, rng):
+    """[(route name, [request, ...]), ...] in the order they must run"""
+    user_ids = list(range(1, n + 1))
+    factory = EventFactory()
+    price = price_object('price_bench_one', PRICES['price_bench_one'])
+    upgrade = price_object('price_bench_two', PRICES['price_bench_two'])
+    lifecycles = [
+        factory.lifecycle(i, f'cus_bench_{i}', f'bench{i}@example.com', price, upgrade)
+        for i in user_ids
+    ]
+
+    routes = [
+        ('GET /payment/one-time', [get('/payment/one-time') for _ in user_ids]),
+        ('GET /payment/subscribe', [get('/payment/subscribe') for _ in user_ids]),
+        ('POST /create-checkout-session', [
+            post_form('/create-checkout-session', {'email': f'bench{i}@example.com', 'name': f'Bench User {i}'})
+            for i in user_ids
+        ]),
+        ('POST /create-subscription-checkout-session', [
+            post_form('/create-subscription-checkout-session',
+                      {'email': f'bench{i}@example.com', 'name': f'Bench User {i}', 'plan_tier': 'one'})
+            for i in user_ids
+        ]),
+    ]
+    # One phase per event type, so each subscriber's events keep their order
+    for event_type in LIFECYCLE:
+        routes.append((f'POST /webhook {event_type}', [post_webhook(events[event_type]) for events in lifecycles]))
+    routes += [
+        ('GET /dashboard', [get(f'/dashboard?email=bench{rng.choice(user_ids)}@example.com') for _ in user_ids]),
+        ('GET /api/users/<id>/payments', [get(f'/api/users/{rng.choice(user_ids)}/payments', API_HEADERS)
+                                         for _ in user_ids]),
+    ]
+    return routes
+
+
+# -------------------------------------------------------------------
+# REPORTING
+# -------------------------------------------------------------------
+
+def print_report(results):
+    print(f'\n{"route":<52} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+          f'{"queries":>8} {"stripe":>7} {"errors":>7}')
+    for route, row in results.items():
+        print(f'{route:<52} {row["req_per_s"]:>8.1f} {row["p50_ms"]:>8.2f} {row["p95_ms"]:>8.2f} '
+              f'{row["p99_ms"]:>8.2f} {row["queries_per_req"]:>8.2f} {row["stripe_calls_per_req"]:>7.2f} '
+              f'{row["errors"]:>7}')
+
+
+def compare(results, baseline, tolerance):
+    """Regressions against a saved run: slower p95, lower req/s, more queries or Stripe calls, new errors"""
+    regressions = []
+    for route, row in results.items():
+        old = baseline.get(route)
+        if not old:
+            continue
+        if row['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{route}: p95 {old["p95_ms"]:.2f}ms -> {row["p95_ms"]:.2f}ms')
+        if row['req_per_s'] < old['req_per_s'] * (1 - tolerance):
+            regressions.append(f'{route}: req/s {old["req_per_s"]:.1f} -> {row["req_per_s"]:.1f}')
+        # Query and Stripe call counts are deterministic, any increase is a regression
+        if row['queries_per_req'] > old['queries_per_req'] + 0.01:
+            regressions.append(f'{route}: queries/req {old["queries_per_req"]:.2f} -> {row["queries_per_req"]:.2f}')
+        if row['stripe_calls_per_req'] > old['stripe_calls_per_req'] + 0.01:
+            regressions.append(f'{route}: Stripe calls/req {old["stripe_calls_per_req"]:.2f} -> '
+                               f'{row["stripe_calls_per_req"]:.2f}')
+        if row['errors'] > old['errors']:
+            regressions.append(f'{route}: errors {old["errors"]} -> {row["errors"]}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route (= number of users)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=30.0, help='fake Stripe API latency')
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--payments-per-user', type=int, default=50, help='seeded payment history for the dashboard')
+    parser.add_argument('--async', dest='webhook_async', action='store_true', help='benchmark WEBHOOK_ASYNC=true')
+    parser.add_argument('--save', metavar='FILE', help='write results as JSON')
+    parser.add_argument('--baseline', metavar='FILE', help='compare with a saved run, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95/req/s change vs. the baseline')
+    parser.add_argument('--verbose', action='store_true', help="show the app's own log output")
+    args = parser.parse_args()
+
+    stripe_state = FakeStripeState(PRICES, args.latency_ms, args.jitter_ms)
+    server, base_url = start_in_thread(stripe_state)
+    workdir = tempfile.mkdtemp(prefix='bench_routes_')
+
+    # create_app() reads its configuration from the environment
+    os.environ.update({
+        'SECRET_KEY': 'bench',
+        'DATABASE_URL': f'sqlite:///{os.path.join(workdir, "bench.db")}',
+        'STRIPE_SECRET_KEY': 'sk_test_bench',
+        'STRIPE_API_BASE': base_url,
+        'STRIPE_WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'API_KEYS': API_KEY,
+        'STRIPE_PRICE_ID_ONE_TIME': 'price_bench_one_time',
+        'STRIPE_PRICE_ID_SUBS_ONE': 'price_bench_one',
+        'STRIPE_PRICE_ID_SUBS_TWO': 'price_bench_two',
+        'WEBHOOK_ASYNC': 'true' if args.webhook_async else 'false',
+        'LOG_LEVEL': 'INFO' if args.verbose else 'ERROR',
+    })
+    from app import create_app, services, start_webhook_workers
+    from event_queue import queue_depth
+    from migrations import upgrade_schema
+    from models import db, User, Payment
+
+    app = create_app()
+    with app.app_context():
+        upgrade_schema()
+        seed(db, User, Payment, args.requests, args.payments_per_user)
+        queries = QueryCounter(db.engine)
+    services(app).price_catalog.warm(services(app).settings.price_ids)
+    if args.webhook_async:
+        start_webhook_workers(app)  # like `python app.py`, before the first request
+
+    print(f'{args.requests} requests per route, concurrency {args.concurrency}, '
+          f'Stripe latency {args.latency_ms}±{args.jitter_ms}ms, '
+          f'webhooks {"async" if args.webhook_async else "inline"}')
+    results = {}
+    log_output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with log_output:
+        for route, requests in build_routes(args.requests, random.Random(42)):
+            results[route] = run_route(app, queries, stripe_state, requests, args.concurrency)
+            if args.webhook_async and route.startswith('POST /webhook'):
+                # Later event types depend on these being applied
+                with app.app_context():
+                    while queue_depth():
+                        time.sleep(0.05)
+    server.shutdown()
+    print_report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nResults saved to {args.save}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s) against {args.baseline}:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print(f'\nNo regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Cold start: import time of wsgi.py (app.py + create_app()) and time to the first served request
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --path /payment/subscribe
+
+Every run starts fresh interpreters, the way an autoscaler starts a new
+instance:
+
+- import: `python -X importtime -c "import wsgi"`, total (importing app.py and
+  building the app) and the heaviest modules app.py pulls in, and whether the
+  Stripe SDK was loaded. Run without STRIPE_SECRET_KEY, so the price catalog
+  warm-up thread doesn't start (its imports would be mixed into the report)
+- first request: `flask run` against a throwaway SQLite database and the fake
+  Stripe server (benchmarks/fake_stripe.py); --path is requested until it
+  answers 200. Reported from process start, plus the latency of that first
+  request itself (a page with prices also waits for the Stripe SDK and the
+  price catalog if they aren't loaded yet)
+
+Medians over --runs.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_stripe import FakeStripeState, start_in_thread
+
+
+PRICES = {'price_bench_one_time': 2500, 'price_bench_one': 1000, 'price_bench_two': 2000}
+
+
+def app_environment(workdir, stripe_base):
+    return dict(
+        os.environ,
+        SECRET_KEY='bench',
+        DATABASE_URL=f'sqlite:///{os.path.join(workdir, "startup.db")}',
+        STRIPE_SECRET_KEY='sk_test_bench',
+        STRIPE_API_BASE=stripe_base,
+        STRIPE_WEBHOOK_SECRET='whsec_bench',
+        STRIPE_PRICE_ID_ONE_TIME='price_bench_one_time',
+        STRIPE_PRICE_ID_SUBS_ONE='price_bench_one',
+        STRIPE_PRICE_ID_SUBS_TWO='price_bench_two',
+        LOG_LEVEL='ERROR',
+        PYTHONDONTWRITEBYTECODE='',
+    )
+
+
+def measure_import(env):
+    """(total ms of wsgi.py, {module: cumulative ms} of app.py's direct imports, Stripe SDK loaded)"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', "import sys, wsgi; print('stripe' in sys.modules)"],
+        cwd=ROOT, env=dict(env, STRIPE_SECRET_KEY=''), capture_output=True, text=True, check=True
+    )
+    total = 0.0
+    direct = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # A module is listed after its own imports: wsgi imports only app, so keep
+        # the depth-2 lines right before `wsgi`
+        if depth == 0 and name.strip() == 'wsgi':
+            total = int(cumulative) / 1000
+            break
+        elif depth == 0:
+            direct = {}
+        elif depth == 2:
+            direct[name.strip()] = int(cumulative) / 1000
+    return total, direct, result.stdout.strip().splitlines()[-1] == 'True'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def measure_first_request(env, path, timeout=60):
+    """(ms from process start to the first 200, ms the first answered request took)"""
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'wsgi', 'run', '--port', str(port), '--no-reload', '--no-debugger'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            sent = time.perf_counter()
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', timeout=timeout) as response:
+                    response.read()
+                    if response.status == 200:
+                        now = time.perf_counter()
+                        return (now - started) * 1000, (now - sent) * 1000
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        raise RuntimeError(f'{path} did not answer within {timeout}s')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--path', default='/', help='first request (e.g. /payment/subscribe needs the price catalog)')
+    parser.add_argument('--top', type=int, default=8, help='heaviest imports to list')
+    args = parser.parse_args()
+
+    server, base_url = start_in_thread(FakeStripeState(PRICES, latency_ms=30, jitter_ms=0))
+    # A measured process is stopped while its warm-up requests may still be in flight
+    server.handle_error = lambda request, client_address: None
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    env = app_environment(workdir, base_url)
+    subprocess.run([sys.executable, '-c', 'import wsgi'], cwd=ROOT, env=env, check=True)  # warm .pyc files
+
+    imports, first = [], []
+    for _ in range(args.runs):
+        imports.append(measure_import(env))
+        first.append(measure_first_request(env, args.path))
+    server.shutdown()
+
+    print(f'{args.runs} run(s), medians\n')
+    print(f'import wsgi                     {statistics.median(total for total, _, _ in imports):>8.0f} ms '
+          f'(Stripe SDK loaded: {"yes" if imports[-1][2] else "no"})')
+    modules = imports[-1][1]
+    for name in sorted(modules, key=modules.get, reverse=True)[:args.top]:
+        print(f'  {name:<29} {statistics.median(run[1].get(name, 0.0) for run in imports):>8.0f} ms')
+    print(f'first 200 on {args.path:<18} {statistics.median(ready for ready, _ in first):>8.0f} ms after process start')
+    print(f'  that request took             {statistics.median(latency for _, latency in first):>8.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
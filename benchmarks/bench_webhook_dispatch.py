@@ -0,0 +1,140 @@
+"""
+Cost of verifying and dispatching one webhook, before the handler runs
+
+    python benchmarks/bench_webhook_dispatch.py
+    python benchmarks/bench_webhook_dispatch.py --events 20000 --secrets 3
+
+Measures, per event, what /webhook does before (or instead of) a handler:
+the old path (body decoded to text, secret read from os.environ,
+stripe.Webhook.construct_event, if/elif chain) against WebhookVerifier on the
+raw bytes plus the HandlerRegistry lookup. Handlers are no-ops, so no database
+is involved. Handled events are the full subscriber lifecycle; ignored events
+are the same payloads under types the app has no handler for (which the old
+path also claimed in the idempotency ledger, not counted here).
+
+With --secrets N the endpoint has N active secrets and events are signed with
+the last one (the worst case while rolling a secret).
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stripe
+
+from webhook_dispatch import HandlerRegistry, WebhookVerifier
+from webhook_events import LIFECYCLE, EventFactory, price_object, sign_payload
+
+
+IGNORED_TYPES = ('charge.succeeded', 'payment_intent.created', 'invoice.finalized', 'customer.source.created')
+
+
+def noop(*args):
+    pass
+
+
+def old_dispatch(event_type, event_data, event_created=None):
+    """The if/elif chain dispatch_event() used"""
+    if event_type == 'checkout.session.completed':
+        noop(event_data)
+    elif event_type == 'customer.subscription.created':
+        noop(event_data, event_created)
+    elif event_type == 'customer.subscription.updated':
+        noop(event_data, event_created)
+    elif event_type == 'customer.subscription.deleted':
+        noop(event_data, event_created)
+    elif event_type == 'invoice.payment_succeeded':
+        noop(event_data, event_created)
+    elif event_type == 'invoice.payment_failed':
+        noop(event_data, event_created)
+    elif event_type == 'customer.updated':
+        noop(event_data)
+    elif event_type == 'payment_method.attached':
+        noop(event_data)
+    elif event_type == 'price.updated':
+        noop(event_data)
+    elif event_type == 'product.updated':
+        noop(event_data)
+
+
+def old_path(payload, sig_header):
+    text = payload.decode('utf-8')
+    secret = os.environ.get('STRIPE_WEBHOOK_SECRET').split(',')[-1]
+    event = stripe.Webhook.construct_event(text, sig_header, secret)
+    old_dispatch(event['type'], event.get('data', {}).get('object', {}), event.get('created'))
+
+
+def new_path(verifier, registry):
+    def run(payload, sig_header):
+        event = verifier.construct_event(payload, sig_header)
+        if registry.handles(event['type']):
+            registry.dispatch(event['type'], event.get('data', {}).get('object', {}), event.get('created'))
+    return run
+
+
+def build_events(count, secret):
+    """(handled, ignored) lists of (payload bytes, Stripe-Signature header)"""
+    factory = EventFactory()
+    price = price_object('price_bench_one')
+    events = []
+    user = 0
+    while len(events) < count:
+        user += 1
+        events.extend(factory.lifecycle(user, f'cus_{user}', f'user{user}@example.com', price).values())
+    handled, ignored = [], []
+    for i, event in enumerate(events[:count]):
+        payload = json.dumps(event).encode()
+        handled.append((payload, sign_payload(payload.decode(), secret)))
+        event = dict(event, type=IGNORED_TYPES[i % len(IGNORED_TYPES)])
+        payload = json.dumps(event).encode()
+        ignored.append((payload, sign_payload(payload.decode(), secret)))
+    return handled, ignored
+
+
+def per_event_us(fn, events, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for payload, sig_header in events:
+            fn(payload, sig_header)
+        timings.append((time.perf_counter() - started) / len(events) * 1e6)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--secrets', type=int, default=1, help='active endpoint secrets')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement (median)')
+    args = parser.parse_args()
+
+    secrets = [f'whsec_bench_{i}' for i in range(args.secrets)]
+    os.environ['STRIPE_WEBHOOK_SECRET'] = ','.join(secrets)
+    verifier = WebhookVerifier(os.environ['STRIPE_WEBHOOK_SECRET'])
+    registry = HandlerRegistry()
+    for event_type in LIFECYCLE + ('price.updated', 'product.updated'):
+        registry.on(event_type, pass_created=event_type.startswith(('customer.subscription.', 'invoice.')))(noop)
+    handled, ignored = build_events(args.events, secrets[-1])
+    size = statistics.mean(len(payload) for payload, _ in handled)
+
+    print(f'{args.events:,} events per run ({size:,.0f} bytes on average), {args.secrets} active secret(s)\n')
+    print(f'{"path":<44} {"handled µs":>11} {"ignored µs":>11}')
+    new = new_path(verifier, registry)
+    rows = [
+        ('stripe.Webhook.construct_event + if/elif', old_path),
+        ('WebhookVerifier + HandlerRegistry', new),
+    ]
+    results = []
+    for label, fn in rows:
+        result = (per_event_us(fn, handled, args.repeat), per_event_us(fn, ignored, args.repeat))
+        results.append(result)
+        print(f'{label:<44} {result[0]:>11.1f} {result[1]:>11.1f}')
+    print(f'{"speedup":<44} {results[0][0] / results[1][0]:>10.1f}x {results[0][1] / results[1][1]:>10.1f}x')
+
+
+if __name__ == '__main__':
+    main()
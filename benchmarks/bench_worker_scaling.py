@@ -0,0 +1,183 @@
+"""
+Webhook events/sec with 1, 2, 4, 8 sharded worker processes
+
+    python benchmarks/bench_worker_scaling.py
+    python benchmarks/bench_worker_scaling.py --processes 1 2 4 8 16 --events 8000 --io-ms 20
+    python benchmarks/bench_worker_scaling.py --cpu-ms 5 --io-ms 0     # handler work that needs the GIL
+
+Queues a month-start burst of invoice.payment_succeeded events for
+--customers subscriptions in a throwaway SQLite database, then drains it with
+WorkerSupervisor (the same code as `flask webhook-worker --processes N`). The
+handler is a local stub: --cpu-ms of pure-Python work (ORM, JSON; this part
+scales with cores only) plus --io-ms of waiting (database round trips, Stripe
+calls). Each run reports events/sec, the speedup over one process, and how
+evenly the ring spread the events.
+
+Every handler call is logged with its start and end time, and the run fails
+if two events of one subscription overlapped or ran out of queue order.
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import insert
+
+from event_batching import ordering_key_for
+from event_queue import WebhookWorkerPool, enable_sqlite_wal
+from models import db, WebhookEvent, WebhookWorker
+from worker_sharding import ShardMembership, WorkerSupervisor, shard_hash
+
+
+def stub_handler(cpu_ms, io_ms, log_dir):
+    """process_event stand-in; appends 'key seq start end' per event to a file per process"""
+    files = {}
+
+    def process_event(event):
+        started = time.monotonic_ns()  # system-wide clock, comparable across processes
+        deadline = time.perf_counter() + cpu_ms / 1000
+        while time.perf_counter() < deadline:
+            pass
+        if io_ms:
+            time.sleep(io_ms / 1000)
+        pid = os.getpid()
+        if pid not in files:
+            files[pid] = open(os.path.join(log_dir, f'{pid}.log'), 'a', buffering=1)
+        files[pid].write(f'{ordering_key_for(event)} {event["seq"]} {started} {time.monotonic_ns()}\n')
+
+    return process_event
+
+
+def queue_events(count, customers):
+    """The burst, inserted as 'held' so no worker starts before the ring is complete"""
+    rows = []
+    now = datetime.utcnow()
+    for seq in range(count):
+        customer = seq % customers
+        event = {
+            'id': f'evt_bench_{seq}', 'type': 'invoice.payment_succeeded', 'seq': seq,
+            'data': {'object': {'subscription': f'sub_bench_{customer}', 'customer': f'cus_bench_{customer}'}},
+        }
+        key = ordering_key_for(event)
+        rows.append({
+            'event_id': event['id'], 'event_type': event['type'], 'payload': json.dumps(event),
+            'ordering_key': key, 'shard_hash': shard_hash(key), 'status': 'held', 'attempts': 0,
+            'next_attempt_at': now, 'created_at': now, 'updated_at': now,
+        })
+    db.session.execute(insert(WebhookEvent), rows)
+    db.session.commit()
+
+
+def check_order(log_dir):
+    """(events handled per process, violations of per-key order)"""
+    per_key = defaultdict(list)
+    per_process = []
+    for path in glob.glob(os.path.join(log_dir, '*.log')):
+        with open(path) as f:
+            lines = [line.split() for line in f]
+        per_process.append(len(lines))
+        for key, seq, started, ended in lines:
+            per_key[key].append((int(started), int(ended), int(seq)))
+    violations = 0
+    for runs in per_key.values():
+        runs.sort()
+        for (_, ended, seq), (started, _, next_seq) in zip(runs, runs[1:]):
+            if started < ended or next_seq < seq:
+                violations += 1
+    return per_process, violations
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError('timed out')
+        time.sleep(0.05)
+
+
+def remaining():
+    count = WebhookEvent.query.filter(WebhookEvent.status.in_(('pending', 'processing'))).count()
+    db.session.rollback()
+    return count
+
+
+def run(app, processes, args, work_dir):
+    log_dir = os.path.join(work_dir, f'log_{processes}')
+    os.makedirs(log_dir)
+    process_event = stub_handler(args.cpu_ms, args.io_ms, log_dir)
+    heartbeat = 0.5
+    supervisor = WorkerSupervisor(lambda slot: WebhookWorkerPool(
+        app, process_event, concurrency=args.threads, poll_interval=0.05,
+        membership=ShardMembership(f'bench-{slot}', heartbeat_seconds=heartbeat)
+    ), processes)
+
+    WebhookEvent.query.delete()
+    WebhookWorker.query.delete()
+    db.session.commit()
+    queue_events(args.events, args.customers)
+    supervisor.start()
+    try:
+        wait_for(lambda: WebhookWorker.query.count() == processes, 30)
+        db.session.rollback()
+        time.sleep(heartbeat * 3)  # every process has seen the full ring
+        WebhookEvent.query.update({'status': 'pending'})
+        db.session.commit()
+        started = time.perf_counter()
+        wait_for(lambda: remaining() == 0, 600)
+        seconds = time.perf_counter() - started
+    finally:
+        supervisor.stop()
+    per_process, violations = check_order(log_dir)
+    return args.events / seconds, per_process, violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--threads', type=int, default=1, help='worker threads per process')
+    parser.add_argument('--events', type=int, default=4000)
+    parser.add_argument('--customers', type=int, default=1000, help='subscriptions the events are spread over')
+    parser.add_argument('--cpu-ms', type=float, default=0.0, help='pure-Python work per event')
+    parser.add_argument('--io-ms', type=float, default=20.0, help='waiting per event (database, Stripe)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_workers_')
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(work_dir, "queue.db")}'
+    db.init_app(app)
+    try:
+        with app.app_context():
+            db.create_all()
+            enable_sqlite_wal(db.engine)
+            print(f'{args.events:,} events over {args.customers:,} subscriptions, {args.cpu_ms:g} ms CPU + '
+                  f'{args.io_ms:g} ms I/O per event, {args.threads} thread(s) per process, {os.cpu_count()} CPU(s)\n')
+            print(f'{"processes":>9} {"events/s":>9} {"speedup":>8} {"efficiency":>10} '
+                  f'{"events/process min-max":>23} {"order violations":>17}')
+            baseline = None
+            failed = False
+            for processes in args.processes:
+                rate, per_process, violations = run(app, processes, args, work_dir)
+                baseline = baseline or rate / processes
+                speedup = rate / baseline
+                spread = f'{min(per_process):,}-{max(per_process):,}' if per_process else '-'
+                print(f'{processes:>9} {rate:>9,.0f} {speedup:>7.2f}x {speedup / processes:>10.0%} '
+                      f'{spread:>23} {violations:>17}')
+                failed = failed or violations > 0 or sum(per_process) != args.events
+            if failed:
+                print('\nFAILED: events ran out of order or were lost/duplicated')
+                sys.exit(1)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
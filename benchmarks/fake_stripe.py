@@ -0,0 +1,246 @@
+"""
+Local stand-in for the parts of the Stripe API this app uses
+
+    python benchmarks/fake_stripe.py --port 12111 --latency-ms 80
+    STRIPE_API_BASE=http://localhost:12111 python app.py
+
+Serves prices, customers, subscriptions, checkout sessions and events with a
+configurable artificial latency (and optional error rate), so checkout and
+webhook paths can be exercised and benchmarked without a network connection.
+Checkout session creation honours Idempotency-Key like the real API.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+
+def _nested(pairs):
+    """Decode Stripe's form encoding (metadata[user_id]=1, line_items[0][price]=...)"""
+    result = {}
+    for key, value in pairs:
+        parts = re.findall(r'[^\[\]]+', key)
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return result
+
+
+class FakeStripeState:
+    """In-memory objects served by the fake API"""
+
+    def __init__(self, prices=None, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.prices = {}
+        self.customers = {}
+        self.subscriptions = {}
+        self.sessions = {}
+        self.events = []
+        self.idempotent_responses = {}
+        self.request_count = 0
+        for price_id, unit_amount in (prices or {}).items():
+            self.add_price(price_id, unit_amount)
+
+    def add_price(self, price_id, unit_amount, currency='cad', metadata=None):
+        self.prices[price_id] = {
+            'id': price_id, 'object': 'price', 'active': True, 'currency': currency,
+            'unit_amount': unit_amount, 'product': f'prod_{price_id}', 'metadata': metadata or {},
+        }
+
+    def customer(self, customer_id):
+        return self.customers.get(customer_id) or {
+            'id': customer_id, 'object': 'customer', 'email': f'{customer_id}@example.com',
+            'name': customer_id, 'invoice_settings': {'default_payment_method': None}, 'metadata': {},
+        }
+
+    def subscription(self, subscription_id):
+        """A stored subscription (None if stored as None, i.e. deleted), or a default active one"""
+        if subscription_id in self.subscriptions:
+            return self.subscriptions[subscription_id]
+        now = int(time.time())
+        return {
+            'id': subscription_id, 'object': 'subscription', 'status': 'active',
+            'customer': f'cus_{subscription_id}', 'current_period_start': now,
+            'current_period_end': now + 30 * 86400, 'metadata': {},
+            'items': {'object': 'list', 'data': []},
+        }
+
+
+_CREATED_FILTERS = {
+    'gt': lambda created, bound: created > bound, 'gte': lambda created, bound: created >= bound,
+    'lt': lambda created, bound: created < bound, 'lte': lambda created, bound: created <= bound,
+}
+
+
+def _list(data, params, url):
+    """One page of a list endpoint: newest first, honouring created[...] filters, starting_after and limit"""
+    created = params.get('created') or {}
+    data = [
+        obj for obj in data
+        if all(test(obj.get('created', 0), int(created[op])) for op, test in _CREATED_FILTERS.items() if op in created)
+    ]
+    data.sort(key=lambda obj: obj.get('created', 0), reverse=True)  # stable, ties keep their order
+    starting_after = params.get('starting_after')
+    if starting_after:
+        ids = [obj['id'] for obj in data]
+        data = data[ids.index(starting_after) + 1:] if starting_after in ids else []
+    limit = int(params.get('limit', 10))
+    return {'object': 'list', 'data': data[:limit], 'has_more': len(data) > limit, 'url': url}
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    state = None  # set by make_server()
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    disable_nagle_algorithm = True  # headers and body are separate writes; don't delay the second
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Request-Id', f'req_{uuid.uuid4().hex[:14]}')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _not_found(self, path):
+        self._send(404, {'error': {'type': 'invalid_request_error', 'code': 'resource_missing',
+                                   'message': f'No such resource: {path}'}})
+
+    def _simulate_network(self):
+        state = self.state
+        with state.lock:
+            state.request_count += 1
+        delay = state.latency_ms + random.uniform(0, state.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+        if state.error_rate and random.random() < state.error_rate:
+            self._send(500, {'error': {'type': 'api_error', 'message': 'Simulated failure'}})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._simulate_network():
+            return
+        url = urlparse(self.path)
+        params = _nested(parse_qsl(url.query))
+        state = self.state
+        path = url.path.rstrip('/')
+
+        match = re.fullmatch(r'/v1/prices/([^/]+)', path)
+        if match:
+            price = state.prices.get(match.group(1))
+            return self._send(200, price) if price else self._not_found(path)
+
+        match = re.fullmatch(r'/v1/customers/([^/]+)', path)
+        if match:
+            return self._send(200, state.customer(match.group(1)))
+
+        match = re.fullmatch(r'/v1/subscriptions/([^/]+)', path)
+        if match:
+            subscription = state.subscription(match.group(1))
+            return self._send(200, subscription) if subscription else self._not_found(path)
+
+        if path == '/v1/subscriptions':
+            return self._send(200, _list([s for s in state.subscriptions.values() if s], params, path))
+
+        match = re.fullmatch(r'/v1/checkout/sessions/([^/]+)', path)
+        if match:
+            session = state.sessions.get(match.group(1))
+            return self._send(200, session) if session else self._not_found(path)
+
+        if path == '/v1/checkout/sessions':
+            return self._send(200, _list(list(state.sessions.values()), params, path))
+
+        if path == '/v1/events':
+            return self._send(200, _list(list(reversed(state.events)), params, path))
+
+        self._not_found(path)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode()
+        if not self._simulate_network():
+            return
+        path = urlparse(self.path).path.rstrip('/')
+        state = self.state
+
+        if path == '/v1/checkout/sessions':
+            key = self.headers.get('Idempotency-Key')
+            with state.lock:
+                if key and key in state.idempotent_responses:
+                    return self._send(200, state.idempotent_responses[key])
+                params = _nested(parse_qsl(body))
+                session_id = f'cs_test_{uuid.uuid4().hex}'
+                session = {
+                    'id': session_id, 'object': 'checkout.session',
+                    'client_secret': f'{session_id}_secret_{uuid.uuid4().hex[:8]}',
+                    'mode': params.get('mode'), 'ui_mode': params.get('ui_mode'),
+                    'customer': params.get('customer'), 'customer_email': params.get('customer_email'),
+                    'metadata': params.get('metadata', {}), 'status': 'open', 'payment_status': 'unpaid',
+                    'subscription': None, 'amount_total': None, 'created': int(time.time()),
+                }
+                state.sessions[session_id] = session
+                if key:
+                    state.idempotent_responses[key] = session
+            return self._send(200, session)
+
+        self._not_found(path)
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Listen backlog for hundreds of simultaneous connections (async benchmark)
+    request_queue_size = 1024
+
+
+def make_server(state, host='127.0.0.1', port=0):
+    """Create (but don't start) a fake Stripe server; port 0 picks a free port"""
+    handler = type('BoundFakeStripeHandler', (FakeStripeHandler,), {'state': state})
+    return FakeStripeServer((host, port), handler)
+
+
+def start_in_thread(state, host='127.0.0.1', port=0):
+    """Start a fake Stripe server in a background thread; returns (server, base_url)"""
+    server = make_server(state, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    parser.add_argument('--price', action='append', default=[], metavar='PRICE_ID=UNIT_AMOUNT',
+                        help='price to serve (repeatable), e.g. --price price_one=1000')
+    args = parser.parse_args()
+
+    prices = {}
+    for spec in args.price:
+        price_id, _, unit_amount = spec.partition('=')
+        prices[price_id] = int(unit_amount or 1000)
+    state = FakeStripeState(prices, args.latency_ms, args.jitter_ms, args.error_rate)
+    server = make_server(state, args.host, args.port)
+    print(f'Fake Stripe listening on http://{args.host}:{args.port} (latency {args.latency_ms}ms)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
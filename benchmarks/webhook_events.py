@@ -0,0 +1,221 @@
+"""
+Signed Stripe webhook events for local testing and benchmarks
+
+    # POST a full lifecycle (all eight handled event types) for 10 users to a running app
+    python benchmarks/webhook_events.py --url http://localhost:5000/webhook --secret whsec_test --users 10
+
+    # Or write the events as JSONL (usable with `flask backfill-events --from-jsonl`)
+    python benchmarks/webhook_events.py --users 1000 --out events.jsonl
+
+Payloads follow the shape of the objects Stripe sends (embedded prices,
+subscription metadata stamped at checkout, invoice lines), and signatures use
+the same scheme as Stripe (`t=<timestamp>,v1=<HMAC-SHA256>`), so they pass
+stripe.Webhook.construct_event.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+
+# Order in which a subscriber's events normally arrive
+LIFECYCLE = (
+    'checkout.session.completed',
+    'customer.subscription.created',
+    'customer.updated',
+    'payment_method.attached',
+    'invoice.payment_succeeded',
+    'customer.subscription.updated',
+    'invoice.payment_failed',
+    'customer.subscription.deleted',
+)
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """Stripe-Signature header value for a raw payload"""
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def price_object(price_id, unit_amount=1000, currency='cad', product=None):
+    return {
+        'id': price_id, 'object': 'price', 'active': True, 'currency': currency,
+        'unit_amount': unit_amount, 'product': product or f'prod_{price_id}',
+        'recurring': {'interval': 'month', 'interval_count': 1}, 'metadata': {},
+    }
+
+
+class EventFactory:
+    """
+    Builds Stripe event envelopes
+
+    Event IDs are unique per factory, and `created` increases by one second per
+    event, so events built in order also sort in order.
+    """
+
+    def __init__(self, api_version='2025-10-29.clover', start=None):
+        self.api_version = api_version
+        self.clock = int(start or time.time())
+        self.prefix = uuid.uuid4().hex[:8]
+        self.sequence = 0
+
+    def event(self, event_type, data_object, previous_attributes=None):
+        self.sequence += 1
+        self.clock += 1
+        data = {'object': data_object}
+        if previous_attributes is not None:
+            data['previous_attributes'] = previous_attributes
+        return {
+            'id': f'evt_{self.prefix}_{self.sequence:08d}', 'object': 'event',
+            'api_version': self.api_version, 'created': self.clock, 'type': event_type,
+            'livemode': False, 'pending_webhooks': 1, 'data': data,
+            'request': {'id': None, 'idempotency_key': None},
+        }
+
+    # ---------------------------------------------------------------
+    # One builder per handled event type
+    # ---------------------------------------------------------------
+
+    def checkout_session_completed(self, user_id, customer_id, amount_cents=2500, mode='payment'):
+        session_id = f'cs_test_{uuid.uuid4().hex}'
+        return self.event('checkout.session.completed', {
+            'id': session_id, 'object': 'checkout.session', 'mode': mode,
+            'customer': customer_id, 'amount_total': amount_cents, 'currency': 'cad',
+            'payment_status': 'paid', 'status': 'complete',
+            'metadata': {'user_id': str(user_id), 'payment_type': 'one_time' if mode == 'payment' else 'subscription'},
+        })
+
+    def subscription(self, subscription_id, customer_id, price, user_id=None, plan_tier=None, status='active'):
+        start = self.clock
+        end = start + 30 * 86400
+        metadata = {}
+        if user_id is not None:
+            metadata['user_id'] = str(user_id)
+        if plan_tier:
+            metadata['plan_tier'] = plan_tier
+        return {
+            'id': subscription_id, 'object': 'subscription', 'customer': customer_id,
+            'status': status, 'current_period_start': start, 'current_period_end': end,
+            'cancel_at_period_end': False, 'metadata': metadata,
+            'items': {'object': 'list', 'data': [{
+                'id': f'si_{uuid.uuid4().hex[:14]}', 'object': 'subscription_item', 'quantity': 1,
+                'price': price, 'current_period_start': start, 'current_period_end': end,
+            }]},
+        }
+
+    def subscription_created(self, *args, **kwargs):
+        return self.event('customer.subscription.created', self.subscription(*args, **kwargs))
+
+    def subscription_updated(self, *args, previous_attributes=None, **kwargs):
+        return self.event('customer.subscription.updated', self.subscription(*args, **kwargs),
+                          previous_attributes or {})
+
+    def subscription_deleted(self, subscription_id, customer_id, price):
+        subscription = self.subscription(subscription_id, customer_id, price, status='canceled')
+        subscription['canceled_at'] = self.clock
+        return self.event('customer.subscription.deleted', subscription)
+
+    def invoice(self, subscription_id, customer_id, price, paid=True):
+        start = self.clock
+        end = start + 30 * 86400
+        return {
+            'id': f'in_{uuid.uuid4().hex[:14]}', 'object': 'invoice', 'customer': customer_id,
+            'subscription': subscription_id,
+            'parent': {'type': 'subscription_details', 'subscription_details': {'subscription': subscription_id}},
+            'status': 'paid' if paid else 'open', 'currency': price['currency'],
+            'amount_due': price['unit_amount'], 'amount_paid': price['unit_amount'] if paid else 0,
+            'billing_reason': 'subscription_cycle',
+            'lines': {'object': 'list', 'data': [{
+                'id': f'il_{uuid.uuid4().hex[:14]}', 'object': 'line_item', 'amount': price['unit_amount'],
+                'period': {'start': start, 'end': end},
+                'pricing': {'price_details': {'price': price['id'], 'product': price['product']}},
+            }]},
+        }
+
+    def invoice_payment_succeeded(self, subscription_id, customer_id, price):
+        return self.event('invoice.payment_succeeded', self.invoice(subscription_id, customer_id, price, True))
+
+    def invoice_payment_failed(self, subscription_id, customer_id, price):
+        return self.event('invoice.payment_failed', self.invoice(subscription_id, customer_id, price, False))
+
+    def customer_updated(self, customer_id, email, name, default_payment_method=None):
+        return self.event('customer.updated', {
+            'id': customer_id, 'object': 'customer', 'email': email, 'name': name,
+            'invoice_settings': {'default_payment_method': default_payment_method}, 'metadata': {},
+        }, {'name': None})
+
+    def payment_method_attached(self, customer_id):
+        return self.event('payment_method.attached', {
+            'id': f'pm_{uuid.uuid4().hex[:14]}', 'object': 'payment_method', 'type': 'card',
+            'customer': customer_id, 'card': {'brand': 'visa', 'last4': '4242', 'exp_month': 12, 'exp_year': 2030},
+        })
+
+    # ---------------------------------------------------------------
+    # Scenarios
+    # ---------------------------------------------------------------
+
+    def lifecycle(self, user_id, customer_id, email, price, upgrade_price=None, plan_tier='one'):
+        """
+        All eight handled event types for one subscriber, in LIFECYCLE order
+
+        Returns {event_type: event}.
+        """
+        subscription_id = f'sub_{uuid.uuid4().hex[:14]}'
+        upgrade_price = upgrade_price or price
+        return {
+            'checkout.session.completed': self.checkout_session_completed(user_id, customer_id),
+            'customer.subscription.created': self.subscription_created(
+                subscription_id, customer_id, price, user_id, plan_tier),
+            'customer.updated': self.customer_updated(customer_id, email, f'Bench User {user_id}'),
+            'payment_method.attached': self.payment_method_attached(customer_id),
+            'invoice.payment_succeeded': self.invoice_payment_succeeded(subscription_id, customer_id, price),
+            'customer.subscription.updated': self.subscription_updated(
+                subscription_id, customer_id, upgrade_price, user_id, plan_tier,
+                previous_attributes={'items': {}}),
+            'invoice.payment_failed': self.invoice_payment_failed(subscription_id, customer_id, upgrade_price),
+            'customer.subscription.deleted': self.subscription_deleted(subscription_id, customer_id, upgrade_price),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--first-user-id', type=int, default=1, help='users must exist in the target database')
+    parser.add_argument('--price-id', default='price_bench_one')
+    parser.add_argument('--url', help='POST each event to this webhook URL')
+    parser.add_argument('--secret', default='whsec_bench', help='webhook signing secret for --url')
+    parser.add_argument('--out', help='write events to this JSONL file')
+    args = parser.parse_args()
+
+    factory = EventFactory()
+    price = price_object(args.price_id)
+    events = []
+    for user_id in range(args.first_user_id, args.first_user_id + args.users):
+        customer_id = f'cus_bench_{user_id}'
+        events.extend(factory.lifecycle(user_id, customer_id, f'bench{user_id}@example.com', price).values())
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+        print(f'Wrote {len(events)} events to {args.out}')
+
+    if args.url:
+        import requests
+        statuses = {}
+        with requests.Session() as http:
+            for event in events:
+                payload = json.dumps(event)
+                response = http.post(args.url, data=payload, headers={
+                    'Content-Type': 'application/json',
+                    'Stripe-Signature': sign_payload(payload, args.secret),
+                })
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        print(f'Posted {len(events)} events: {statuses}')
+
+
+if __name__ == '__main__':
+    main()
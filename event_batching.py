@@ -0,0 +1,90 @@
+"""
+Grouping of queued webhook events into batches
+
+Every queued event gets an ordering key: the Stripe object whose state it
+changes (the subscription for subscription, invoice and subscription-checkout
+events, otherwise the customer or the object itself). Events with the same key
+are always applied in queue order and never by two workers at once.
+
+Within a batch, consecutive snapshot events for the same object (e.g. three
+customer.subscription.updated in a row) are coalesced: each carries the
+object's full state, so only the newest one (by the event's `created` time,
+not its place in the queue) has to be applied.
+"""
+
+
+# Events whose payload is the complete current state of the object, so a later
+# one of the same type for the same object makes an earlier one redundant
+SNAPSHOT_EVENT_TYPES = (
+    'customer.subscription.updated',
+    'customer.updated',
+    'price.updated',
+    'product.updated',
+)
+
+
+def invoice_subscription_id(invoice):
+    """Subscription of an invoice (top-level before API 2025-03-31, parent.subscription_details after)"""
+    if invoice.get('subscription'):
+        return invoice['subscription']
+    details = (invoice.get('parent') or {}).get('subscription_details') or {}
+    return details.get('subscription')
+
+
+def ordering_key_for(event):
+    """Key that serializes events touching the same Stripe object"""
+    event_type = event.get('type', '')
+    obj = (event.get('data') or {}).get('object') or {}
+
+    if event_type.startswith('customer.subscription.'):
+        return obj.get('id')
+    if event_type.startswith('invoice.'):
+        return invoice_subscription_id(obj) or obj.get('customer')
+    if event_type == 'checkout.session.completed':
+        return obj.get('subscription') or obj.get('customer') or obj.get('id')
+    if event_type == 'payment_method.attached':
+        return obj.get('customer') or obj.get('id')
+    return obj.get('id')
+
+
+def coalesce(events):
+    """
+    Split (queue_id, event) pairs into (to_apply, superseded), both in queue order
+
+    Consecutive snapshots of the same type for the same object (same ordering
+    key, nothing else for that key in between) form a run. Stripe doesn't
+    deliver in order, so the run keeps its newest event by `created` and only
+    the events strictly older than that one are superseded; events created in
+    the same second, or without a `created` time, are all applied in queue
+    order. Any other event in between (e.g. customer.subscription.deleted)
+    ends the run, so per-key order is preserved.
+    """
+    runs = []
+    current_run = {}  # ordering key -> list of indexes of the run in progress
+    for index, (_, event) in enumerate(events):
+        key = ordering_key_for(event)
+        if key is None:
+            continue
+        event_type = event.get('type')
+        object_id = ((event.get('data') or {}).get('object') or {}).get('id')
+        run = current_run.get(key)
+        if event_type not in SNAPSHOT_EVENT_TYPES:
+            current_run[key] = None
+            continue
+        if run and run[0] == (event_type, object_id):
+            run[1].append(index)
+            continue
+        current_run[key] = ((event_type, object_id), [index])
+        runs.append(current_run[key][1])
+
+    superseded = set()
+    for run in runs:
+        created = [events[index][1].get('created') for index in run]
+        if len(run) < 2 or None in created:
+            continue
+        newest = max(created)
+        superseded.update(index for index, when in zip(run, created) if when < newest)
+
+    to_apply = [pair for index, pair in enumerate(events) if index not in superseded]
+    dropped = [pair for index, pair in enumerate(events) if index in superseded]
+    return to_apply, dropped
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from models import db, commit, ProcessedEvent
+
+
+# A claimed event that never finished (e.g. the process died mid-handler)
+# can be taken over by a redelivery after this long
+STALE_CLAIM_SECONDS = 600
+
+
+def _insert_or_skip(session, values):
+    """Single INSERT ... ON CONFLICT DO NOTHING on the unique event_id index"""
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        stmt = sqlite.insert(ProcessedEvent).values(**values).on_conflict_do_nothing(
+            index_elements=['event_id']
+        )
+    elif dialect == 'postgresql':
+        stmt = postgresql.insert(ProcessedEvent).values(**values).on_conflict_do_nothing(
+            index_elements=['event_id']
+        )
+    else:
+        # Other databases: rely on the unique constraint
+        try:
+            with session.begin_nested():
+                session.add(ProcessedEvent(**values))
+            return True
+        except IntegrityError:
+            return False
+    return session.execute(stmt).rowcount == 1
+
+
+def claim_event(event_id, event_type, session=None):
+    """
+    Record event_id in the ledger; returns False if it was already accepted
+
+    The caller commits, so the claim can share a transaction with enqueueing the event.
+    `session` defaults to the Flask-SQLAlchemy session (the ASGI app passes its own).
+    """
+    session = session or db.session
+    now = datetime.utcnow()
+    if _insert_or_skip(session, {'event_id': event_id, 'event_type': event_type, 'received_at': now}):
+        return True
+
+    # Duplicate: only take over a claim that was abandoned before it finished
+    taken_over = session.query(ProcessedEvent).filter(
+        ProcessedEvent.event_id == event_id,
+        ProcessedEvent.processed_at.is_(None),
+        ProcessedEvent.received_at < now - timedelta(seconds=STALE_CLAIM_SECONDS)
+    ).update({'received_at': now}, synchronize_session=False)
+    return taken_over == 1
+
+
+def record_event_processed(event_id, duration_ms):
+    """Mark the event as finished and store how long its handler took"""
+    ProcessedEvent.query.filter_by(event_id=event_id).update({
+        'processed_at': datetime.utcnow(),
+        'duration_ms': duration_ms
+    }, synchronize_session=False)
+    commit()
+
+
+def release_event(event_id):
+    """Forget a claim whose processing failed, so Stripe's retry is processed again"""
+    ProcessedEvent.query.filter_by(event_id=event_id).delete(synchronize_session=False)
+    db.session.commit()
@@ -0,0 +1,407 @@
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, text
+from sqlalchemy.exc import OperationalError
+
+from event_batching import coalesce, ordering_key_for
+from event_ledger import record_event_processed
+from metrics import ERRORS, WEBHOOK_BATCH_EVENTS
+from models import db, batched_commits, WebhookEvent
+from worker_sharding import shard_hash
+
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------------------------------------------------------
+# ENQUEUE (called by the /webhook endpoint)
+# -------------------------------------------------------------------
+
+def enqueue_event(event_id, event_type, payload, ordering_key=None, session=None):
+    """Persist a verified Stripe event so it can be acknowledged immediately"""
+    session = session or db.session
+    queued = WebhookEvent(
+        event_id=event_id,
+        event_type=event_type,
+        payload=payload,
+        ordering_key=ordering_key,
+        shard_hash=shard_hash(ordering_key or event_id),
+        status='pending',
+        next_attempt_at=datetime.utcnow()
+    )
+    session.add(queued)
+    session.commit()
+    return queued.id
+
+
+def queue_depth():
+    """Number of events waiting to be processed"""
+    return WebhookEvent.query.filter(
+        WebhookEvent.status.in_(('pending', 'processing'))
+    ).count()
+
+
+def queue_depth_by_status():
+    """{(status,): count} for the /metrics queue depth gauge"""
+    counts = dict(db.session.query(WebhookEvent.status, func.count(WebhookEvent.id)).filter(
+        WebhookEvent.status.in_(('pending', 'processing', 'dead'))
+    ).group_by(WebhookEvent.status).all())
+    return {(status,): counts.get(status, 0) for status in ('pending', 'processing', 'dead')}
+
+
+def requeue_dead_events():
+    """Move every dead-lettered event back to pending"""
+    count = WebhookEvent.query.filter_by(status='dead').update({
+        'status': 'pending',
+        'attempts': 0,
+        'next_attempt_at': datetime.utcnow()
+    }, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def enable_sqlite_wal(engine):
+    """Let the web process append events while workers read and update them"""
+    if engine.dialect.name == 'sqlite':
+        try:
+            with engine.connect() as conn:
+                conn.execute(text('PRAGMA journal_mode=WAL'))
+        except OperationalError as e:
+            # Switching needs a moment without writers; WAL is persistent, so a
+            # later start (or any earlier one) sets it for good
+            logger.warning('Could not enable SQLite WAL mode: %s', e)
+
+
+# -------------------------------------------------------------------
+# WORKER POOL
+# -------------------------------------------------------------------
+
+class WebhookWorkerPool:
+    """
+    Background threads that drain the webhook_events table
+
+    - Workers claim due events with conditional UPDATEs, so several workers
+      (or several processes) never process the same row
+    - Events with the same ordering key (see event_batching.py) are processed
+      in queue order, one worker at a time
+    - With batch_size > 1 a worker claims up to batch_size events, coalesces
+      redundant snapshot events and applies the batch in one transaction
+    - Failed events are retried with exponential backoff and jitter, and
+      moved to the 'dead' state after `max_attempts`
+    - With a `membership` (worker_sharding.ShardMembership) the pool only
+      claims the ordering keys its process owns on the worker ring
+    """
+
+    def __init__(self, app, process_event, concurrency=4, max_attempts=8,
+                 retry_base_seconds=2, retry_max_seconds=3600, poll_interval=1.0,
+                 stale_claim_seconds=600, batch_size=1, batch_window_ms=0, membership=None):
+        # process_event(event) runs the matching handle_* function
+        self.app = app
+        self.process_event = process_event
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.poll_interval = poll_interval
+        self.stale_claim_seconds = stale_claim_seconds
+        self.batch_size = max(1, batch_size)
+        self.batch_window_ms = batch_window_ms
+        self.membership = membership
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    def sharded(self, membership, concurrency=None):
+        """A pool with the same settings that only works on membership's part of the ring"""
+        return WebhookWorkerPool(
+            self.app, self.process_event, concurrency or self.concurrency, self.max_attempts,
+            self.retry_base_seconds, self.retry_max_seconds, self.poll_interval,
+            self.stale_claim_seconds, self.batch_size, self.batch_window_ms, membership
+        )
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            with self.app.app_context():
+                enable_sqlite_wal(db.engine)
+                self._recover_stale_claims()
+                if self.membership:
+                    self.membership.heartbeat()
+            self._stopping.clear()
+            for i in range(self.concurrency):
+                thread = threading.Thread(
+                    target=self._run, name=f'webhook-worker-{i}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            if self.membership:
+                thread = threading.Thread(target=self._heartbeat, name='webhook-worker-heartbeat', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info('Started %s webhook worker(s)', self.concurrency)
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        if self.membership:
+            with self.app.app_context():
+                self.membership.leave()
+
+    def notify(self):
+        """Wake an idle worker (called right after an event is enqueued)"""
+        self._wakeup.set()
+
+    def _recover_stale_claims(self):
+        # Events left in 'processing' by a crashed worker go back to the queue
+        # (recent claims may belong to a worker in another process, so leave those alone)
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_claim_seconds)
+        count = WebhookEvent.query.filter(
+            WebhookEvent.status == 'processing',
+            WebhookEvent.updated_at < cutoff
+        ).update({'status': 'pending'}, synchronize_session=False)
+        db.session.commit()
+        if count:
+            logger.warning('Re-queued %s webhook event(s) left in processing', count)
+
+    def _heartbeat(self):
+        while not self._stopping.wait(self.membership.heartbeat_seconds):
+            try:
+                with self.app.app_context():
+                    if self.membership.heartbeat():
+                        self._wakeup.set()  # keys taken over from another worker may be waiting
+            except Exception:
+                logger.exception('Error sending webhook worker heartbeat')
+                ERRORS.inc(component='webhook_worker')
+
+    def _run(self):
+        while not self._stopping.is_set():
+            with self.app.app_context():
+                processed = self.run_once()
+            if not processed:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    # ---------------------------------------------------------------
+    # Claiming
+    # ---------------------------------------------------------------
+
+    def _due(self):
+        """Filter for events this pool may claim now"""
+        criteria = [WebhookEvent.status == 'pending', WebhookEvent.next_attempt_at <= datetime.utcnow()]
+        if self.membership:
+            criteria.append(self.membership.claim_filter)
+        return criteria
+
+    def _claim(self, limit):
+        """
+        Claim up to `limit` due events in queue order; returns their ids
+
+        An event is only claimed together with every earlier unfinished event
+        of its ordering key, so a key that has an event in processing (another
+        worker) or waiting for a retry is skipped until that event is finished.
+        """
+        # Look a little further ahead, other workers may claim the first candidates
+        candidates = db.session.query(WebhookEvent.id, WebhookEvent.ordering_key).filter(
+            *self._due()
+        ).order_by(WebhookEvent.id).limit(limit + self.concurrency).all()
+        if not candidates:
+            return []
+
+        candidate_ids = {event_pk for event_pk, _ in candidates}
+        keys = {key for _, key in candidates if key is not None}
+        allowed = set()
+        if keys:
+            unfinished = db.session.query(WebhookEvent.id, WebhookEvent.ordering_key).filter(
+                WebhookEvent.ordering_key.in_(keys),
+                WebhookEvent.status.in_(('pending', 'processing')),
+                WebhookEvent.id <= max(candidate_ids)
+            ).order_by(WebhookEvent.id).all()
+            blocked = set()
+            for event_pk, key in unfinished:
+                if key in blocked:
+                    continue
+                if event_pk in candidate_ids:
+                    allowed.add(event_pk)
+                else:
+                    blocked.add(key)
+
+        claimed = []
+        lost_keys = set()
+        for event_pk, key in candidates:
+            if len(claimed) == limit:
+                break
+            if key is not None and (event_pk not in allowed or key in lost_keys):
+                continue
+            count = WebhookEvent.query.filter_by(
+                id=event_pk, status='pending'
+            ).update({'status': 'processing'}, synchronize_session=False)
+            if count:
+                claimed.append(event_pk)
+            elif key is not None:
+                # Another worker got there first; it owns the rest of this key for now
+                lost_keys.add(key)
+        db.session.commit()
+        return claimed
+
+    def _backoff(self, attempts):
+        delay = min(self.retry_max_seconds, self.retry_base_seconds * (2 ** (attempts - 1)))
+        return random.uniform(delay / 2, delay)  # jitter spreads out retries
+
+    # ---------------------------------------------------------------
+    # Processing
+    # ---------------------------------------------------------------
+
+    def run_once(self):
+        """Process one event, or one batch; returns False when nothing was due"""
+        if self.batch_size > 1:
+            return self._run_batch()
+        try:
+            claimed = self._claim(1)
+        except Exception:
+            db.session.rollback()
+            logger.exception('Error claiming event')
+            ERRORS.inc(component='webhook_worker')
+            return False
+
+        if not claimed:
+            return False
+        queued = db.session.get(WebhookEvent, claimed[0])
+        self._process(queued.id, json.loads(queued.payload))
+        return True
+
+    def _process(self, event_pk, event):
+        """Run one claimed event in its own transaction; returns False if it failed"""
+        event_type = event.get('type')
+        try:
+            self.process_event(event)
+            queued = db.session.get(WebhookEvent, event_pk)
+            queued.status = 'done'
+            queued.attempts += 1
+            queued.last_error = None
+            db.session.commit()
+            return True
+        except Exception as e:
+            db.session.rollback()
+            queued = db.session.get(WebhookEvent, event_pk)
+            queued.attempts += 1
+            queued.last_error = str(e)
+            if queued.attempts >= self.max_attempts:
+                queued.status = 'dead'
+                logger.error('Event dead-lettered after %s attempts: %s', queued.attempts, e,
+                             extra={'event_id': queued.event_id, 'event_type': event_type})
+            else:
+                delay = self._backoff(queued.attempts)
+                queued.status = 'pending'
+                queued.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+                logger.warning('Event failed, retrying in %.1fs: %s', delay, e,
+                               extra={'event_id': queued.event_id, 'event_type': event_type})
+            db.session.commit()
+            return False
+
+    def _wait_for_batch_window(self):
+        # Let the oldest due event age batch_window_ms, so events Stripe fires
+        # back-to-back (checkout, subscription, invoice) end up in one batch.
+        # A backlog is already older than that and is claimed right away.
+        if not self.batch_window_ms:
+            return
+        oldest = db.session.query(func.min(WebhookEvent.created_at)).filter(*self._due()).scalar()
+        db.session.rollback()
+        if oldest:
+            age_ms = (datetime.utcnow() - oldest).total_seconds() * 1000
+            if age_ms < self.batch_window_ms:
+                time.sleep((self.batch_window_ms - age_ms) / 1000)
+
+    def _run_batch(self):
+        try:
+            self._wait_for_batch_window()
+            claimed = self._claim(self.batch_size)
+        except Exception:
+            db.session.rollback()
+            logger.exception('Error claiming events')
+            ERRORS.inc(component='webhook_worker')
+            return False
+
+        if not claimed:
+            return False
+
+        rows = db.session.query(WebhookEvent.id, WebhookEvent.payload).filter(
+            WebhookEvent.id.in_(claimed)
+        ).order_by(WebhookEvent.id).all()
+        events = [(event_pk, json.loads(payload)) for event_pk, payload in rows]
+        to_apply, superseded = coalesce(events)
+
+        try:
+            # Handlers only flush inside batched_commits(); everything, including
+            # the ledger and queue updates, is committed once below
+            with batched_commits():
+                for _, event in to_apply:
+                    self.process_event(event)
+                for _, event in superseded:
+                    if event.get('id'):
+                        record_event_processed(event['id'], 0.0)
+            WebhookEvent.query.filter(WebhookEvent.id.in_(claimed)).update({
+                'status': 'done',
+                'attempts': WebhookEvent.attempts + 1,
+                'last_error': None
+            }, synchronize_session=False)
+            db.session.commit()
+            WEBHOOK_BATCH_EVENTS.observe(len(events))
+            logger.debug('Applied %s events in one transaction (%s superseded)', len(events), len(superseded))
+        except Exception as e:
+            db.session.rollback()
+            db.session.close()  # start over with an empty identity map
+            logger.warning('Batch of %s events failed, retrying one by one: %s', len(events), e)
+            ERRORS.inc(component='webhook_worker')
+            self._run_individually(to_apply, superseded)
+        return True
+
+    def _run_individually(self, to_apply, superseded):
+        """Apply each event of a failed batch on its own; a failure holds back later events of its key"""
+        # Superseded events need no handler, the later snapshot carries their state
+        for _, event in superseded:
+            if event.get('id'):
+                record_event_processed(event['id'], 0.0)
+        if superseded:
+            WebhookEvent.query.filter(WebhookEvent.id.in_([event_pk for event_pk, _ in superseded])).update({
+                'status': 'done',
+                'attempts': WebhookEvent.attempts + 1,
+                'last_error': None
+            }, synchronize_session=False)
+            db.session.commit()
+
+        held_keys = set()
+        for event_pk, event in to_apply:
+            key = ordering_key_for(event)
+            if key is not None and key in held_keys:
+                # Back to the queue without using up an attempt; it is claimed
+                # again once the failed event before it is done (or dead)
+                WebhookEvent.query.filter_by(id=event_pk).update({'status': 'pending'}, synchronize_session=False)
+                db.session.commit()
+                continue
+            if not self._process(event_pk, event) and key is not None:
+                held_keys.add(key)
+
+    def drain(self, timeout=None):
+        """Process due events in the calling thread until the queue is empty"""
+        deadline = time.monotonic() + timeout if timeout else None
+        processed = 0
+        with self.app.app_context():
+            while self.run_once():
+                processed += 1
+                if deadline and time.monotonic() > deadline:
+                    break
+        return processed
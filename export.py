@@ -0,0 +1,218 @@
+import csv
+import gzip
+import importlib.util
+import json
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, Numeric, and_, or_, select
+
+from backfill import save_checkpoint
+from models import db, Payment, Subscription
+from read_replicas import read_engine
+
+
+logger = logging.getLogger(__name__)
+
+EXPORT_TABLES = {'payments': Payment.__table__, 'subscriptions': Subscription.__table__}
+FORMATS = ('csv', 'parquet', 'ndjson', 'columnar')
+
+
+# -------------------------------------------------------------------
+# WRITERS (one per output format, fed one chunk of rows at a time)
+# -------------------------------------------------------------------
+
+class CsvWriter:
+    extension = 'csv'
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([column.name for column in columns])
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)  # no float rounding of amounts
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class NdjsonWriter:
+    """Gzipped JSON lines, the columnar fallback when pyarrow isn't installed"""
+    extension = 'ndjson.gz'
+
+    def __init__(self, path, columns):
+        self.file = gzip.open(path, 'wt', compresslevel=6)
+        self.names = [column.name for column in columns]
+
+    def write(self, rows):
+        names = self.names
+        self.file.writelines(json.dumps(dict(zip(names, row)), default=_json_value) + '\n' for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+def _arrow_type(pa, column_type):
+    if isinstance(column_type, Float):
+        return pa.float64()
+    if isinstance(column_type, Numeric):
+        return pa.decimal128(column_type.precision or 38, column_type.scale or 0)
+    if isinstance(column_type, Integer):
+        return pa.int64()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column_type, Date):
+        return pa.date32()
+    if isinstance(column_type, Boolean):
+        return pa.bool_()
+    return pa.string()
+
+
+class ParquetWriter:
+    """Parquet with the table's column types; every chunk becomes one row group"""
+    extension = 'parquet'
+
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([(column.name, _arrow_type(pa, column.type)) for column in columns])
+        self.writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+
+    def write(self, rows):
+        pa = self.pa
+        arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), self.schema)]
+        self.writer.write_batch(pa.record_batch(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def pyarrow_available():
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def writer_classes(formats):
+    """Writer classes for the requested formats ('columnar' is Parquet if pyarrow is installed, else NDJSON)"""
+    classes = []
+    for fmt in formats:
+        if fmt == 'columnar':
+            fmt = 'parquet' if pyarrow_available() else 'ndjson'
+        if fmt == 'parquet' and not pyarrow_available():
+            raise RuntimeError('Parquet export needs pyarrow: pip install -r requirements-analytics.txt')
+        cls = {'csv': CsvWriter, 'parquet': ParquetWriter, 'ndjson': NdjsonWriter}[fmt]
+        if cls not in classes:
+            classes.append(cls)
+    return classes
+
+
+# -------------------------------------------------------------------
+# EXPORT
+# -------------------------------------------------------------------
+
+def load_watermarks(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def export_table(name, out_dir, formats=('csv', 'columnar'), watermark=None, chunk_size=50000, until=None):
+    """
+    Stream one table to files in out_dir, every format written from the same read
+
+    Rows are read in (created_at, id) order over a server-side cursor and
+    handed to the writers `chunk_size` at a time, so memory use doesn't depend
+    on the table size. With `watermark` ({'created_at', 'id'} of the last row
+    exported before) only newer rows are exported; rows created at or after
+    `until` are left for the next run.
+
+    Files are written under a temporary name and renamed once complete. Returns
+    a stats dict; its 'watermark' is the last row exported (the old one if
+    there was nothing new).
+    """
+    table = EXPORT_TABLES[name]
+    until = until or datetime.utcnow()
+    query = select(table).where(table.c.created_at < until).order_by(table.c.created_at, table.c.id)
+    if watermark:
+        after = datetime.fromisoformat(watermark['created_at'])
+        query = query.where(or_(
+            table.c.created_at > after,
+            and_(table.c.created_at == after, table.c.id > watermark['id'])
+        ))
+
+    os.makedirs(out_dir, exist_ok=True)
+    stamp = until.strftime('%Y%m%dT%H%M%S')
+    classes = writer_classes(formats)
+    paths = [os.path.join(out_dir, f'{name}_{stamp}.{cls.extension}') for cls in classes]
+    writers = [cls(path + '.part', table.columns) for cls, path in zip(classes, paths)]
+    created_at_index = list(table.columns).index(table.c.created_at)
+    id_index = list(table.columns).index(table.c.id)
+
+    rows_exported = 0
+    last_row = None
+    started = time.perf_counter()
+    try:
+        # A connection of its own: the session's transaction stays untouched while the cursor is open.
+        # On a read replica if the command chose one; settle_seconds must cover its lag
+        with read_engine(db).connect() as connection:
+            result = connection.execution_options(yield_per=chunk_size).execute(query)
+            for rows in result.partitions():
+                for writer in writers:
+                    writer.write(rows)
+                rows_exported += len(rows)
+                last_row = rows[-1]
+                elapsed = time.perf_counter() - started
+                logger.info('Exporting %s: %s rows, %.0f rows/sec', name, rows_exported,
+                            rows_exported / elapsed if elapsed else 0.0)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    if rows_exported:
+        for path in paths:
+            os.replace(path + '.part', path)
+        watermark = {'created_at': last_row[created_at_index].isoformat(), 'id': last_row[id_index]}
+    else:
+        for path in paths:
+            os.remove(path + '.part')
+        paths = []
+    seconds = time.perf_counter() - started
+    return {
+        'rows': rows_exported, 'seconds': seconds, 'rows_per_second': rows_exported / seconds if seconds else 0.0,
+        'files': paths, 'watermark': watermark,
+    }
+
+
+def export_tables(names, out_dir, formats=('csv', 'columnar'), chunk_size=50000, watermark_path=None,
+                  full=False, settle_seconds=60):
+    """
+    Export several tables incrementally; returns {table name: stats}
+
+    The watermark file remembers the last row exported per table. Rows younger
+    than `settle_seconds` are held back to the next run, since a row whose
+    transaction commits after the export started would otherwise fall behind
+    the watermark and never be exported. `full` ignores the watermarks.
+    """
+    watermarks = load_watermarks(watermark_path)
+    until = datetime.utcnow() - timedelta(seconds=settle_seconds)
+    results = {}
+    for name in names:
+        stats = export_table(name, out_dir, formats, None if full else watermarks.get(name), chunk_size, until)
+        if stats['watermark']:
+            watermarks[name] = dict(stats['watermark'], exported_at=datetime.utcnow().isoformat())
+            save_checkpoint(watermark_path, watermarks)
+        results[name] = stats
+    return results
@@ -0,0 +1,290 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# -------------------------------------------------------------------
+# METRIC TYPES
+# -------------------------------------------------------------------
+# Minimal in-process metrics with Prometheus text exposition (no extra
+# dependency). Every metric keeps one series per label combination; all
+# updates take a per-metric lock, which is far cheaper than the stdout
+# writes they replace.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type_name}']
+
+
+class Counter(_Metric):
+    """Monotonic count (name should end in _total)"""
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._series.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        return self._header() + [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}'
+            for key, value in series
+        ]
+
+
+class Gauge(_Metric):
+    """
+    Current value, either set directly or read from a callback at scrape time
+
+    The callback returns {label values tuple: value}, so one query can fill
+    every series (e.g. queue depth per status).
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def render(self):
+        if self.callback:
+            series = sorted(self.callback().items())
+        else:
+            with self._lock:
+                series = sorted(self._series.items())
+        return self._header() + [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}'
+            for key, value in series
+        ]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (seconds for all timings here)"""
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, also when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        with self._lock:
+            series = sorted((key, dict(value, counts=list(value['counts']))) for key, value in self._series.items())
+        lines = self._header()
+        for key, value in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, value['counts']):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_number(float(bound))}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {value["count"]}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_number(value["sum"])}')
+            lines.append(f'{self.name}_count{labels} {value["count"]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# -------------------------------------------------------------------
+# METRICS
+# -------------------------------------------------------------------
+
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time to handle an HTTP request (until the response starts)',
+    ('method', 'route', 'status')
+))
+WEBHOOK_EVENT_SECONDS = registry.register(Histogram(
+    'webhook_event_duration_seconds', 'Time to process one Stripe event', ('event_type',)
+))
+WEBHOOK_HANDLER_SECONDS = registry.register(Histogram(
+    'webhook_handler_duration_seconds', 'Time spent in a handle_* function', ('handler',)
+))
+STRIPE_CALL_SECONDS = registry.register(Histogram(
+    'stripe_api_call_duration_seconds', 'Outbound Stripe API call latency, including retries',
+    ('endpoint', 'outcome')
+))
+DB_QUERY_SECONDS = registry.register(Histogram(
+    'db_query_duration_seconds', 'SQL statement execution time', ('operation',)
+))
+WEBHOOK_BATCH_EVENTS = registry.register(Histogram(
+    'webhook_batch_events', 'Events applied per webhook worker batch', (),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+))
+WEBHOOK_EVENTS = registry.register(Counter(
+    'webhook_events_total', 'Stripe events received or processed', ('event_type', 'outcome')
+))
+STRIPE_RETRIES = registry.register(Counter(
+    'stripe_api_retries_total', 'Retried outbound Stripe API calls', ('endpoint',)
+))
+SUBSCRIPTION_RECONCILIATIONS = registry.register(Counter(
+    'subscription_reconciliations_total', 'Due subscriptions checked against Stripe by the renewal scheduler',
+    ('outcome',)
+))
+USER_CACHE_LOOKUPS = registry.register(Counter(
+    'user_cache_lookups_total', 'User lookups by email, ID or Stripe customer ID, answered from the cache or not',
+    ('lookup', 'outcome')
+))
+PAGE_CACHE_REQUESTS = registry.register(Counter(
+    'page_cache_requests_total', 'Pricing page requests served from the rendered-page cache, rendered, or bypassing it',
+    ('page', 'outcome')
+))
+DB_READ_ROUTING = registry.register(Counter(
+    'db_read_routing_total', 'Requests and commands whose reads went to a replica, or to the primary to read their own writes '
+    'or because no replica was available',
+    ('target',)
+))
+ERRORS = registry.register(Counter(
+    'errors_total', 'Errors by component', ('component',)
+))
+
+
+def timed(histogram, label):
+    """Decorator: time every call, labelled with the function name (e.g. label='handler')"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**{label: fn.__name__}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# -------------------------------------------------------------------
+# INSTRUMENTATION HOOKS
+# -------------------------------------------------------------------
+
+def instrument_flask(app):
+    """Time every request by its URL rule (not the raw path, to keep the label set small)"""
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                method=request.method, route=route, status=str(response.status_code)
+            )
+            if response.status_code >= 500:
+                ERRORS.inc(component='http')
+        return response
+
+
+_sqlalchemy_instrumented = False
+
+
+def instrument_sqlalchemy():
+    """Time every SQL statement of every engine (primary and replicas alike)"""
+    global _sqlalchemy_instrumented
+    if _sqlalchemy_instrumented:
+        return
+    _sqlalchemy_instrumented = True
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('_metrics_started', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['_metrics_started'].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        DB_QUERY_SECONDS.observe(time.perf_counter() - started, operation=operation)
+
+    @event.listens_for(Engine, 'handle_error')
+    def _error(context):
+        ERRORS.inc(component='db')
+        if context.connection is not None:
+            stack = context.connection.info.get('_metrics_started')
+            if stack:
+                stack.pop()
@@ -0,0 +1,97 @@
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from models import db
+
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------------------------------------------------------
+# SCHEMA UPGRADE
+# -------------------------------------------------------------------
+# db.create_all() only creates missing tables. upgrade_schema() also brings
+# existing tables up to date with models.py by adding missing (nullable)
+# columns and missing indexes. It is idempotent, so it is safe to run on
+# every deploy.
+
+def _column_ddl(column, dialect):
+    ddl = f'{column.name} {column.type.compile(dialect=dialect)}'
+    if not column.nullable:
+        default = column.server_default
+        if default is None:
+            raise ValueError(
+                f'Column {column.table.name}.{column.name} is NOT NULL without a server default; '
+                f'add it manually'
+            )
+        ddl += f' DEFAULT {default.arg} NOT NULL'
+    return ddl
+
+
+def _index_conflicts(index):
+    """Rows that prevent a unique index from being created"""
+    columns = ', '.join(column.name for column in index.columns)
+    where = ''
+    condition = index.dialect_options['sqlite']['where']
+    if condition is None:
+        condition = index.dialect_options['postgresql']['where']
+    if condition is not None:
+        where = f' WHERE {condition}'
+    rows = db.session.execute(text(
+        f'SELECT {columns}, COUNT(*) FROM {index.table.name}{where} '
+        f'GROUP BY {columns} HAVING COUNT(*) > 1'
+    )).fetchall()
+    return rows
+
+
+def upgrade_schema(dry_run=False):
+    """Create missing tables, columns and indexes; returns the list of changes"""
+    engine = db.engine
+    changes = []
+
+    existing_tables = set(inspect(engine).get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            changes.append(f'create table {table.name}')
+    if not dry_run:
+        # The primary only: replicas (read_replicas.py) get the schema by replication
+        db.create_all(bind_key=None)
+
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue  # created above together with its indexes
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {_column_ddl(column, engine.dialect)}'
+            changes.append(ddl)
+            if not dry_run:
+                with engine.begin() as conn:
+                    conn.execute(text(ddl))
+
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+            if dry_run:
+                changes.append(ddl)
+                continue
+            try:
+                with engine.begin() as conn:
+                    conn.execute(CreateIndex(index))
+                changes.append(ddl)
+            except Exception as e:
+                if index.unique:
+                    conflicts = _index_conflicts(index)
+                    logger.error('Cannot create unique index %s, %s conflicting value(s): %s',
+                                 index.name, len(conflicts), conflicts[:10])
+                else:
+                    logger.error('Cannot create index %s: %s', index.name, e)
+
+    return changes
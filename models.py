@@ -1,7 +1,37 @@
 from flask_sqlalchemy import SQLAlchemy
+from contextlib import contextmanager
 from datetime import datetime
+import threading
 
-db = SQLAlchemy()
+from read_replicas import RoutingSession
+
+# RoutingSession sends reads to a replica where a request opted in (see read_replicas.py)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# -------------------------------------------------------------------
+# Transaction helpers for the webhook handlers
+# -------------------------------------------------------------------
+_batch_state = threading.local()
+
+def commit():
+    """Commit the session, or only flush it while a batch is open (see batched_commits)"""
+    if getattr(_batch_state, 'depth', 0):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+@contextmanager
+def batched_commits():
+    """
+    Group several handler calls into one transaction
+
+    Inside the block commit() only flushes; the caller commits (or rolls back) once at the end.
+    """
+    _batch_state.depth = getattr(_batch_state, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _batch_state.depth -= 1
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -9,6 +39,7 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
     name = db.Column(db.String(100), nullable=False)
+    stripe_customer_id = db.Column(db.String(100), nullable=True, index=True)  # Stripe customer ID (cus_...)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -27,7 +58,19 @@ class Payment(db.Model):
     payment_type = db.Column(db.String(50), nullable=False)  # 'one_time' or 'subscription'
     status = db.Column(db.String(50), default='pending')  # 'pending', 'completed', 'failed'
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    transaction_id = db.Column(db.String(100), unique=True, nullable=True)
+    transaction_id = db.Column(db.String(100), unique=True, nullable=True)  # Checkout session (cs_...) or invoice (in_...)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('subscriptions.id'), nullable=True)  # Subscription invoices: the plan tier of the revenue
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=True)  # e.g. `flask reconcile --repair`
+    reconciled_at = db.Column(db.DateTime, nullable=True)  # Last check against Stripe by `flask reconcile` (UTC)
+    
+    __table_args__ = (
+        # Dashboard: a user's payments of one type, newest first (keyset pagination)
+        db.Index('ix_payments_user_type_created', 'user_id', 'payment_type', 'created_at', 'id'),
+        # handle_checkout_completed duplicate check
+        db.Index('ix_payments_user_type_transaction', 'user_id', 'payment_type', 'transaction_id'),
+        # Warehouse export: rows created after the watermark, in order (export.py)
+        db.Index('ix_payments_created_id', 'created_at', 'id'),
+    )
     
     def __repr__(self):
         return f'<Payment {self.id} - ${self.amount}>'
@@ -46,7 +89,110 @@ class Subscription(db.Model):
     next_billing_date = db.Column(db.DateTime, nullable=False)
     cancelled_at = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=True)
+    last_event_at = db.Column(db.DateTime, nullable=True)  # `created` of the newest Stripe event applied (UTC)
+    reconciled_at = db.Column(db.DateTime, nullable=True)  # Last check against Stripe (renewal scheduler or `flask reconcile`, UTC)
+    discrepancy = db.Column(db.Text, nullable=True)  # What differed from Stripe at that check, NULL if nothing
+    
+    __table_args__ = (
+        # Dashboard and the "already has an active subscription" check
+        db.Index('ix_subscriptions_user_id_status', 'user_id', 'status'),
+        # Renewal scheduler: subscriptions of a status due before a date, soonest first
+        db.Index('ix_subscriptions_status_next_billing', 'status', 'next_billing_date'),
+        # At most one active subscription per user (partial index on SQLite/PostgreSQL)
+        db.Index(
+            'uq_subscriptions_one_active_per_user', 'user_id',
+            unique=True,
+            sqlite_where=db.text("status = 'active'"),
+            postgresql_where=db.text("status = 'active'")
+        ),
+        # Warehouse export: rows created after the watermark, in order (export.py)
+        db.Index('ix_subscriptions_created_id', 'created_at', 'id'),
+    )
     
     def __repr__(self):
         return f'<Subscription {self.id} - ${self.amount}/month>'
 
+
+class WebhookEvent(db.Model):
+    """Durable queue of verified Stripe events waiting to be processed by the webhook workers"""
+    __tablename__ = 'webhook_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.String(100), nullable=True)  # Stripe event ID (evt_...)
+    event_type = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # Raw verified event JSON
+    ordering_key = db.Column(db.String(255), nullable=True)  # Subscription/customer the event changes (event_batching.py)
+    shard_hash = db.Column(db.Integer, nullable=True)  # Position of the ordering key on the worker ring (worker_sharding.py)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # 'pending', 'processing', 'done', 'dead'
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        # Workers poll for the oldest due event
+        db.Index('ix_webhook_events_status_next_attempt', 'status', 'next_attempt_at'),
+        # Per-key ordering check when claiming
+        db.Index('ix_webhook_events_ordering_key_status', 'ordering_key', 'status'),
+    )
+    
+    def __repr__(self):
+        return f'<WebhookEvent {self.id} {self.event_type} ({self.status})>'
+
+class WebhookWorker(db.Model):
+    """Live sharded webhook worker processes; each one owns part of the hash ring (worker_sharding.py)"""
+    __tablename__ = 'webhook_workers'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    worker_id = db.Column(db.String(100), unique=True, nullable=False)  # '<hostname>-<slot>'
+    pid = db.Column(db.Integer, nullable=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    heartbeat_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<WebhookWorker {self.worker_id}>'
+
+class ProcessedEvent(db.Model):
+    """Ledger of Stripe events already accepted by /webhook (one row per Stripe event ID)"""
+    __tablename__ = 'processed_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.String(255), unique=True, nullable=False)  # Stripe event ID (evt_...)
+    event_type = db.Column(db.String(100), nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    processed_at = db.Column(db.DateTime, nullable=True)  # NULL until the handler finished
+    duration_ms = db.Column(db.Float, nullable=True)  # Time spent in the handler
+    
+    def __repr__(self):
+        return f'<ProcessedEvent {self.event_id} {self.event_type}>'
+
+class DailyRollup(db.Model):
+    """
+    Per-day revenue and subscription counters (one row per day, payment type and plan tier)
+
+    Kept up to date by the webhook handlers (analytics.py), so analytics never scan payments or subscriptions.
+    Subscription columns ending in _delta are changes on that day; summing them up to a date gives the state then.
+    """
+    __tablename__ = 'daily_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)  # UTC
+    payment_type = db.Column(db.String(50), nullable=False)  # 'one_time' or 'subscription'
+    plan_tier = db.Column(db.String(50), nullable=False, default='', server_default='')  # '' for one-time payments
+    revenue = db.Column(db.Numeric(14, 2), nullable=False, default=0, server_default='0')  # Completed payments
+    payments = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    new_subscriptions = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    cancellations = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Churn
+    mrr_delta = db.Column(db.Numeric(14, 2), nullable=False, default=0, server_default='0')  # active + past_due amounts
+    active_delta = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    past_due_delta = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    __table_args__ = (
+        # One bucket per key, the target of the handlers' INSERT ... ON CONFLICT DO UPDATE
+        db.Index('uq_daily_rollups_bucket', 'day', 'payment_type', 'plan_tier', unique=True),
+    )
+    
+    def __repr__(self):
+        return f'<DailyRollup {self.day} {self.payment_type} {self.plan_tier}>'
@@ -0,0 +1,241 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from metrics import PAGE_CACHE_REQUESTS
+
+
+logger = logging.getLogger(__name__)
+
+
+class PriceCatalog:
+    """
+    In-process cache of Stripe prices shared by the pricing pages and webhook handlers
+
+    - Entries expire after `ttl` seconds; an expired entry is still served while
+      a single background refresh replaces it, so readers never wait on Stripe
+    - At most `max_size` prices are kept (least recently used are evicted first)
+    - `price.updated` / `product.updated` webhooks keep the catalog fresh through
+      `put()` and `invalidate_product()`
+    - `version` goes up whenever a price's info changes or is invalidated, so
+      anything derived from the catalog (see RenderedPageCache) knows it is stale
+    """
+
+    def __init__(self, fetch_price, ttl=3600, max_size=256):
+        # fetch_price(price_id) -> Stripe Price object (or dict)
+        self._fetch_price = fetch_price
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # price_id -> (expires_at, price_info)
+        self._refreshing = set()
+        self._loading = {}  # price_id -> Event set when the fetch in progress ends
+        self._lock = threading.Lock()
+        self.version = 0
+
+    @staticmethod
+    def _to_info(price):
+        """Reduce a Stripe Price to the fields the app actually uses"""
+        unit_amount = price.get('unit_amount') or 0
+        product = price.get('product')
+        if isinstance(product, dict):
+            product = product.get('id')
+        return {
+            'price_id': price.get('id'),
+            'unit_amount': unit_amount,
+            'amount': unit_amount / 100,  # cents -> dollars
+            'currency': (price.get('currency') or '').upper(),
+            'product': product,
+            'active': price.get('active', True),
+            'metadata': dict(price.get('metadata') or {}),
+        }
+
+    def _store(self, price_id, info):
+        with self._lock:
+            previous = self._entries.get(price_id)
+            if previous is None or previous[1] != info:
+                self.version += 1
+            self._entries[price_id] = (time.monotonic() + self.ttl, info)
+            self._entries.move_to_end(price_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _load(self, price_id):
+        # One fetch per price at a time: a page view during the startup warm-up
+        # waits for the warm-up's fetch instead of calling Stripe a second time
+        with self._lock:
+            loading = self._loading.get(price_id)
+            if loading is None:
+                self._loading[price_id] = threading.Event()
+        if loading is not None:
+            loading.wait()
+            with self._lock:
+                entry = self._entries.get(price_id)
+            if entry:
+                return entry[1]
+            return self._load(price_id)  # that fetch failed, try again
+        try:
+            info = self._to_info(self._fetch_price(price_id))
+            self._store(price_id, info)
+            return info
+        finally:
+            with self._lock:
+                self._loading.pop(price_id).set()
+
+    def _refresh_in_background(self, price_id):
+        with self._lock:
+            if price_id in self._refreshing:
+                return
+            self._refreshing.add(price_id)
+
+        def refresh():
+            try:
+                self._load(price_id)
+            except Exception as e:
+                logger.warning('Price catalog refresh failed for %s: %s', price_id, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(price_id)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def get(self, price_id):
+        """
+        Return cached price info for price_id
+
+        Only a price that has never been loaded (or was invalidated) is fetched
+        inline; expired entries are served as-is and refreshed in the background.
+        Returns None if the price cannot be fetched.
+        """
+        if not price_id:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(price_id)
+            if entry:
+                self._entries.move_to_end(price_id)
+
+        if entry:
+            expires_at, info = entry
+            if expires_at <= time.monotonic():
+                self._refresh_in_background(price_id)
+            return info
+
+        try:
+            return self._load(price_id)
+        except Exception as e:
+            logger.error('Could not fetch price %s: %s', price_id, e)
+            return None
+
+    def put(self, price):
+        """Store a Price object received from Stripe (e.g. the body of price.updated)"""
+        price_id = price.get('id')
+        if price_id:
+            self._store(price_id, self._to_info(price))
+
+    def invalidate(self, price_id=None):
+        """Drop one price, or the whole catalog when price_id is None"""
+        with self._lock:
+            if price_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(price_id, None)
+            self.version += 1
+
+    def invalidate_product(self, product_id):
+        """Refresh every cached price that belongs to product_id"""
+        with self._lock:
+            price_ids = [
+                price_id for price_id, (_, info) in self._entries.items()
+                if info['product'] == product_id
+            ]
+        for price_id in price_ids:
+            self._refresh_in_background(price_id)
+        return price_ids
+
+    def warm(self, price_ids):
+        """Load every configured price up front (called at startup)"""
+        loaded = 0
+        for price_id in price_ids:
+            if not price_id:
+                continue
+            try:
+                self._load(price_id)
+                loaded += 1
+            except Exception as e:
+                logger.warning('Could not warm price %s: %s', price_id, e)
+        return loaded
+
+    def warm_in_background(self, price_ids):
+        thread = threading.Thread(target=self.warm, args=(list(price_ids),), daemon=True)
+        thread.start()
+        return thread
+
+
+class PlanTierIndex:
+    """
+    price_id -> plan tier lookup used by the subscription checkout and webhook handlers
+
+    Built once from configuration ({tier: price_id}); prices that are not
+    configured fall back to a `plan_tier` entry in the cached Price metadata.
+    """
+
+    def __init__(self, catalog, tier_prices):
+        self.catalog = catalog
+        self.tier_prices = {tier: price_id for tier, price_id in tier_prices.items() if price_id}
+        self._tiers = {price_id: tier for tier, price_id in self.tier_prices.items()}
+
+    def price_for_tier(self, tier):
+        return self.tier_prices.get(tier)
+
+    def tier_for_price(self, price_id):
+        tier = self._tiers.get(price_id)
+        if tier:
+            return tier
+        info = self.catalog.get(price_id)
+        if info:
+            return info['metadata'].get('plan_tier')
+        return None
+
+
+CachedPage = namedtuple('CachedPage', ['version', 'body', 'etag', 'headers'])
+
+
+class RenderedPageCache:
+    """
+    Rendered pages whose only inputs are settings and price catalog entries
+
+    A page is rendered once per catalog version and then served from memory,
+    with its response headers (ETag, a hash of the body, and `cache_control`)
+    built once too. price.updated / product.updated webhooks, TTL refreshes
+    that return different prices and invalidate() all bump the version, so the
+    next request renders the page again.
+    """
+
+    def __init__(self, cache_control='no-cache'):
+        self.cache_control = cache_control
+        self._pages = {}  # name -> CachedPage
+        self._lock = threading.Lock()
+
+    def get(self, name, version, render):
+        """
+        The page rendered for catalog `version`, rendering it with render() if needed
+
+        Read `version` before the prices the page shows: a change in between
+        then only causes one extra render, never a stale page.
+        """
+        with self._lock:
+            page = self._pages.get(name)
+        if page and page.version == version:
+            PAGE_CACHE_REQUESTS.inc(page=name, outcome='hit')
+            return page
+        body = render().encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        page = CachedPage(version, body, etag, (('ETag', f'"{etag}"'), ('Cache-Control', self.cache_control)))
+        with self._lock:
+            current = self._pages.get(name)
+            if current is None or current.version <= version:
+                self._pages[name] = page
+        PAGE_CACHE_REQUESTS.inc(page=name, outcome='render')
+        return page
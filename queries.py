@@ -0,0 +1,102 @@
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, func, or_
+
+from models import db, Payment
+
+
+# -------------------------------------------------------------------
+# KEYSET PAGINATION
+# -------------------------------------------------------------------
+# Pages are ordered newest first by (created_at, id). A cursor encodes the
+# last row of the previous page, so every page is a single index range scan
+# no matter how deep the user pages (no OFFSET).
+
+PAGE_SIZE = 25
+
+
+def encode_cursor(created_at, row_id):
+    raw = f'{created_at.isoformat()}|{row_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns (created_at, id), or None for a missing or malformed cursor"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def before_cursor(query, created_column, id_column, cursor):
+    """Restrict query to rows older than the cursor position"""
+    position = decode_cursor(cursor)
+    if not position:
+        return query
+    created_at, row_id = position
+    return query.filter(or_(
+        created_column < created_at,
+        and_(created_column == created_at, id_column < row_id)
+    ))
+
+
+class PaymentPage:
+    """
+    One page of a user's payments, fetched lazily
+
+    Iterating streams rows from the database in small chunks (yield_per),
+    so the page can be rendered with stream_template without materializing
+    it. `next_cursor` is known once iteration has finished.
+    """
+
+    def __init__(self, user_id, payment_type='one_time', cursor=None, limit=PAGE_SIZE):
+        self.limit = limit
+        self.cursor = cursor
+        self.next_cursor = None
+        query = Payment.query.filter(
+            Payment.user_id == user_id,
+            Payment.payment_type == payment_type
+        )
+        query = before_cursor(query, Payment.created_at, Payment.id, cursor)
+        # One extra row tells us whether an older page exists
+        self._query = query.order_by(
+            Payment.created_at.desc(), Payment.id.desc()
+        ).limit(limit + 1)
+
+    def __iter__(self):
+        count = 0
+        last = None
+        for payment in self._query.yield_per(100):
+            if count == self.limit:
+                self.next_cursor = encode_cursor(last.created_at, last.id)
+                break
+            count += 1
+            last = payment
+            yield payment
+
+
+# -------------------------------------------------------------------
+# AGGREGATES
+# -------------------------------------------------------------------
+
+def payment_totals(user_id, payment_type='one_time'):
+    """Lifetime spend, number of payments and last payment date over completed payments, computed in SQL"""
+    count, total, last_payment_at = db.session.query(
+        func.count(Payment.id),
+        func.coalesce(func.sum(Payment.amount), 0),
+        func.max(Payment.created_at)
+    ).filter(
+        Payment.user_id == user_id,
+        Payment.payment_type == payment_type,
+        Payment.status == 'completed'
+    ).one()
+    return {
+        'count': count,
+        'total': total,
+        'last_payment_at': last_payment_at,
+    }
@@ -0,0 +1,187 @@
+import functools
+import itertools
+import logging
+import sqlite3
+import time
+
+from flask import current_app, g, has_app_context, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy.exc import OperationalError
+
+from metrics import DB_READ_ROUTING
+
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------------------------------------------------------
+# READ REPLICAS (Flask-SQLAlchemy binds replica_0, replica_1, ...)
+# -------------------------------------------------------------------
+# DATABASE_REPLICA_URLS lists read-only copies of DATABASE_URL. They are
+# configured as extra binds, and RoutingSession sends the SELECTs of an app
+# context that called read_from_replica() to one of them. Everything else
+# stays on the primary: writes, SELECT ... FOR UPDATE, reads after this
+# session wrote anything, and every app context that didn't opt in (webhook
+# handlers and workers, checkout, CLI commands that write). A replica that
+# can't be reached is skipped for REPLICA_RETRY_SECONDS; the read that found
+# it down is run again on the primary.
+
+REPLICA_BIND_PREFIX = 'replica_'
+STICKY_SESSION_KEY = '_db_primary_until'
+REPLICA_RETRY_SECONDS = 30
+
+_rotation = itertools.count()
+
+
+def replica_binds(urls):
+    """SQLALCHEMY_BINDS entries for the replica URLs"""
+    return {f'{REPLICA_BIND_PREFIX}{i}': url for i, url in enumerate(urls)}
+
+
+def replica_keys():
+    binds = current_app.config.get('SQLALCHEMY_BINDS') or {}
+    return sorted(key for key in binds if key.startswith(REPLICA_BIND_PREFIX))
+
+
+def _down_until():
+    # bind key -> time.monotonic() until which the replica is skipped, per app
+    return current_app.extensions.setdefault('replicas_down_until', {})
+
+
+def mark_replica_down(key):
+    """Skip the replica for REPLICA_RETRY_SECONDS"""
+    _down_until()[key] = time.monotonic() + REPLICA_RETRY_SECONDS
+
+
+def available_replica_keys():
+    """The replicas not marked down"""
+    down_until = _down_until()
+    now = time.monotonic()
+    return [key for key in replica_keys() if down_until.get(key, 0) <= now]
+
+
+class RoutingSession(Session):
+    """db.session: SELECTs go to the app context's replica, if it chose one"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        self.info['replica'] = None
+        if bind is None:
+            if self._flushing or getattr(clause, 'is_dml', False):
+                # Reads later in this app context must see the write
+                self.info['wrote'] = True
+            elif (clause is not None and clause.is_select and not self.info.get('wrote')
+                    and getattr(clause, '_for_update_arg', None) is None and has_app_context()):
+                key = g.get('_db_read_bind')
+                if key:
+                    self.info['replica'] = key
+                    return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def execute(self, statement, *args, **kwargs):
+        try:
+            return super().execute(statement, *args, **kwargs)
+        except OperationalError as e:
+            key = self.info.get('replica')
+            if not key:
+                raise
+            # Only reads go to a replica, so nothing is lost by starting over on the primary
+            logger.warning('Read replica %s failed, reading from the primary for %ss: %s',
+                           key, REPLICA_RETRY_SECONDS, e.orig)
+            mark_replica_down(key)
+            g.pop('_db_read_bind', None)
+            DB_READ_ROUTING.inc(target='primary_failover')
+            self.rollback()
+            return super().execute(statement, *args, **kwargs)
+
+
+def _sticky():
+    """True while this client should read its own writes from the primary (see stick_to_primary)"""
+    if not has_request_context() or current_app.config['SESSION_COOKIE_NAME'] not in request.cookies:
+        return False
+    return session.get(STICKY_SESSION_KEY, 0) > time.time()
+
+
+def read_from_replica():
+    """
+    Send the SELECTs of the current app context (request or CLI command) to a replica
+
+    Replicas are taken in turn, skipping those marked down. No-op without
+    replicas, and for clients that are sticky to the primary. Returns the
+    bind key, or None for the primary.
+    """
+    if not replica_keys():
+        return None
+    if _sticky():
+        DB_READ_ROUTING.inc(target='primary_sticky')
+        return None
+    keys = available_replica_keys()
+    if not keys:
+        DB_READ_ROUTING.inc(target='primary_failover')
+        return None
+    key = keys[next(_rotation) % len(keys)]
+    g._db_read_bind = key
+    DB_READ_ROUTING.inc(target='replica')
+    return key
+
+
+def replica_reads(view):
+    """View decorator: read_from_replica() for the whole request, including a streamed response"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        read_from_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def stick_to_primary(seconds=None):
+    """
+    Read this client's next requests from the primary for a while
+
+    Called where a user is about to look at data just written on the primary
+    (checkout, the success pages redirecting to /dashboard), so replica lag
+    can't hide it. Stored in the Flask session cookie, for
+    REPLICA_STICKY_SECONDS by default.
+    """
+    if not replica_keys():
+        return
+    g.pop('_db_read_bind', None)
+    if has_request_context():
+        seconds = current_app.config.get('REPLICA_STICKY_SECONDS', 10) if seconds is None else seconds
+        session[STICKY_SESSION_KEY] = time.time() + seconds
+
+
+def read_engine(db):
+    """Engine of the current app context's replica (the primary if none was chosen), for Core reads"""
+    key = g.get('_db_read_bind') if has_app_context() else None
+    return db.engines[key] if key else db.engine
+
+
+# -------------------------------------------------------------------
+# LOCAL TESTING (flask replica-sync)
+# -------------------------------------------------------------------
+
+def sync_sqlite_replicas(db):
+    """
+    Copy a SQLite primary into every SQLite replica file (online backup)
+
+    Stands in for replication when testing with two SQLite files: replicas
+    show the primary as of the last sync, i.e. with replication lag.
+    Returns the replica files written.
+    """
+    primary = db.engine.url
+    if primary.get_backend_name() != 'sqlite':
+        raise RuntimeError('replica-sync copies SQLite files; other databases replicate on their own')
+    written = []
+    for key in replica_keys():
+        replica = db.engines[key].url
+        if replica.get_backend_name() != 'sqlite':
+            continue
+        source = sqlite3.connect(primary.database)
+        target = sqlite3.connect(replica.database)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        written.append(replica.database)
+    return written
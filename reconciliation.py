@@ -0,0 +1,304 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from decimal import Decimal
+from itertools import islice
+
+from sqlalchemy import or_
+
+from backfill import save_checkpoint
+from models import db, Payment, Subscription
+from renewal_scheduler import subscription_differences
+from stripe_client import stripe
+
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------------------------------------------------------
+# SOURCES (one per Stripe object type and the local table it maps to)
+# -------------------------------------------------------------------
+
+class SubscriptionSource:
+    """Stripe subscriptions <-> subscriptions table (joined on stripe_subscription_id)"""
+    name = 'subscriptions'
+    model = Subscription
+    key = 'stripe_subscription_id'
+    list_params = {'status': 'all'}  # canceled subscriptions are listed too
+
+    def __init__(self, list_objects, retrieve_object, snapshot):
+        self.list_objects = list_objects
+        self.retrieve_object = retrieve_object
+        self.snapshot = snapshot
+
+    def relevant(self, remote):
+        return True
+
+    def expects_local(self, remote):
+        # The webhook handlers record every subscription, cancelled ones included
+        return True
+
+    def differences(self, local, remote):
+        return subscription_differences(local, self.snapshot(remote))
+
+    def mark(self, local, problems, checked_at):
+        # Shares the renewal scheduler's flag, so `flask subscription-discrepancies` lists both
+        local.reconciled_at = checked_at
+        local.discrepancy = '; '.join(problems) or None
+
+    def local_filter(self):
+        return (Subscription.stripe_subscription_id.isnot(None),)
+
+
+class CheckoutSessionSource:
+    """One-time Checkout Sessions <-> payments table (joined on transaction_id)"""
+    name = 'checkout_sessions'
+    model = Payment
+    key = 'transaction_id'
+    list_params = {}
+
+    def __init__(self, list_objects, retrieve_object):
+        self.list_objects = list_objects
+        self.retrieve_object = retrieve_object
+
+    def relevant(self, remote):
+        # Subscription checkouts are covered by their subscription
+        return remote.get('mode') == 'payment' and (remote.get('metadata') or {}).get('payment_type') == 'one_time'
+
+    def expects_local(self, remote):
+        return remote.get('status') == 'complete' and remote.get('payment_status') == 'paid'
+
+    def differences(self, local, remote):
+        if not self.expects_local(remote):
+            return [f'not paid in Stripe: status {remote.get("status")}, payment_status {remote.get("payment_status")}']
+        problems = []
+        amount = (Decimal(remote.get('amount_total') or 0) / 100).quantize(Decimal('0.01'))
+        if Decimal(local.amount) != amount:
+            problems.append(f'amount: local {local.amount}, Stripe {amount}')
+        user_id = (remote.get('metadata') or {}).get('user_id')
+        if user_id and int(user_id) != local.user_id:
+            problems.append(f'user: local {local.user_id}, Stripe {user_id}')
+        return problems
+
+    def mark(self, local, problems, checked_at):
+        local.reconciled_at = checked_at
+
+    def local_filter(self):
+        return Payment.payment_type == 'one_time', Payment.transaction_id.like('cs_%')
+
+
+# -------------------------------------------------------------------
+# CHECKPOINTS
+# -------------------------------------------------------------------
+
+def load_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# -------------------------------------------------------------------
+# RECONCILIATION
+# -------------------------------------------------------------------
+
+class Reconciler:
+    """
+    Compares Stripe objects with the local tables and reports what differs
+
+    For each source, objects created in [since, until] are streamed from the
+    Stripe list API newest first, `page_size` at a time. Each page is joined
+    to its local rows with one indexed IN query (a hash join on the Stripe ID),
+    compared and stamped with reconciled_at, then committed; only one page is
+    held in memory. After the Stripe side is done, local rows that no page
+    matched are read by id (keyset) and looked up individually, which tells
+    rows missing in Stripe from ones created outside the window.
+
+    Differences are written to `report` (a file object, one JSON line each).
+    With `repair(source_name, stripe_object)` set, missing and mismatching
+    rows are rebuilt from the Stripe object; rows missing in Stripe are only
+    reported.
+
+    Progress is checkpointed after every page: an interrupted run resumes at
+    the page it stopped on, and the next run only covers objects created since
+    the last completed one (minus `overlap_seconds` for objects that show up
+    in the list API late).
+    """
+
+    def __init__(self, sources, report, repair=None, page_size=100, checkpoint_path=None, overlap_seconds=300):
+        self.sources = sources
+        self.report = report
+        self.repair = repair
+        self.page_size = page_size
+        self.checkpoint_path = checkpoint_path
+        self.overlap_seconds = overlap_seconds
+        self.checkpoint = load_checkpoint(checkpoint_path)
+
+    def _save(self):
+        self.report.flush()  # the report never lags behind the checkpoint
+        save_checkpoint(self.checkpoint_path, self.checkpoint)
+
+    def run(self, since=None, until=None):
+        """Reconcile every source; returns {source name: summary dict}"""
+        return {source.name: self.run_source(source, since, until) for source in self.sources}
+
+    def run_source(self, source, since=None, until=None):
+        state = self.checkpoint.get(source.name, {})
+        if not state.get('phase'):
+            # A new run: pick up where the last completed one ended
+            if since is None:
+                since = state['completed_until'] - self.overlap_seconds if 'completed_until' in state else 0
+            until = until or int(time.time())
+            state = {
+                'phase': 'stripe', 'since': since, 'until': until, 'upper': until, 'last_local_id': 0,
+                'started_at': datetime.utcnow().isoformat(),
+                'stats': {'seen': 0, 'in_sync': 0, 'missing_locally': 0, 'missing_in_stripe': 0,
+                          'mismatch': 0, 'repaired': 0},
+            }
+            self.checkpoint[source.name] = state
+        else:
+            logger.info('Resuming %s reconciliation (%s phase)', source.name, state['phase'])
+        stats = state['stats']
+        started = time.perf_counter()
+
+        if state['phase'] == 'stripe':
+            params = {**source.list_params, 'limit': self.page_size,
+                      'created': {'gte': state['since'], 'lte': state['upper']}}
+            for page in _chunks(source.list_objects(params).auto_paging_iter(), self.page_size):
+                self._join_page(source, page, stats)
+                # Newest first: everything created after the page's oldest object is done
+                # (objects created in that same second are compared again on resume, harmless)
+                state['upper'] = min(remote.get('created', state['upper']) for remote in page)
+                self._save()
+                self._log_progress(source, stats, started)
+            state['phase'] = 'local'
+            self._save()
+
+        self._check_unmatched(source, state, stats)
+
+        self.checkpoint[source.name] = {'completed_until': state['until'], 'last_run': stats}
+        self._save()
+        stats = dict(stats)
+        stats['seconds'] = time.perf_counter() - started
+        stats['records_per_second'] = stats['seen'] / stats['seconds'] if stats['seconds'] else 0.0
+        return stats
+
+    def _log_progress(self, source, stats, started):
+        elapsed = time.perf_counter() - started
+        logger.info('Reconciling %s: %s checked, %s mismatched, %s missing locally, %.1f records/sec',
+                    source.name, stats['seen'], stats['mismatch'], stats['missing_locally'],
+                    stats['seen'] / elapsed if elapsed else 0.0)
+
+    def _join_page(self, source, page, stats):
+        """Compare one page of Stripe objects with their local rows (one query, one commit)"""
+        page = [remote for remote in page if source.relevant(remote)]
+        if not page:
+            return
+        key = getattr(source.model, source.key)
+        local_rows = {
+            getattr(row, source.key): row
+            for row in source.model.query.filter(key.in_([remote['id'] for remote in page]))
+        }
+        checked_at = datetime.utcnow()
+        diffs = []
+        for remote in page:
+            stats['seen'] += 1
+            local = local_rows.get(remote['id'])
+            if local is None:
+                if source.expects_local(remote):
+                    diffs.append((remote, self._diff(source, remote, 'missing_locally', [], None)))
+                else:
+                    stats['in_sync'] += 1
+                continue
+            problems = source.differences(local, remote)
+            source.mark(local, problems, checked_at)
+            if problems:
+                diffs.append((remote, self._diff(source, remote, 'mismatch', problems, local.id)))
+            else:
+                stats['in_sync'] += 1
+        db.session.commit()
+
+        for remote, diff in diffs:
+            stats[diff['issue']] += 1
+            if self.repair:
+                self._repair(source, remote, diff, stats)
+            self._write(diff)
+
+    def _check_unmatched(self, source, state, stats):
+        """Look up local rows in the window that no Stripe page matched"""
+        started_at = datetime.fromisoformat(state['started_at'])
+        since = datetime.utcfromtimestamp(state['since'])
+        while True:
+            rows = source.model.query.filter(
+                source.model.id > state['last_local_id'],
+                *source.local_filter(),
+                source.model.created_at >= since,
+                source.model.created_at < started_at,
+                or_(source.model.reconciled_at.is_(None), source.model.reconciled_at < started_at)
+            ).order_by(source.model.id).limit(self.page_size).all()
+            if not rows:
+                return
+            for local in rows:
+                stripe_id = getattr(local, source.key)
+                try:
+                    remote = source.retrieve_object(stripe_id)
+                except stripe.InvalidRequestError as e:
+                    if e.code != 'resource_missing':
+                        raise
+                    remote = None
+                stats['seen'] += 1
+                if remote is None:
+                    source.mark(local, ['missing in Stripe'], datetime.utcnow())
+                    stats['missing_in_stripe'] += 1
+                    self._write(self._diff(source, {'id': stripe_id}, 'missing_in_stripe', [], local.id))
+                    continue
+                # Created outside the window (local and Stripe clocks differ): compare it here
+                problems = source.differences(local, remote)
+                source.mark(local, problems, datetime.utcnow())
+                if not problems:
+                    stats['in_sync'] += 1
+                    continue
+                stats['mismatch'] += 1
+                diff = self._diff(source, remote, 'mismatch', problems, local.id)
+                if self.repair:
+                    db.session.commit()
+                    self._repair(source, remote, diff, stats)
+                self._write(diff)
+            state['last_local_id'] = rows[-1].id
+            db.session.commit()
+            self._save()
+
+    @staticmethod
+    def _diff(source, remote, issue, problems, local_id):
+        return {'source': source.name, 'stripe_id': remote['id'], 'local_id': local_id,
+                'issue': issue, 'problems': problems, 'repaired': False}
+
+    def _repair(self, source, remote, diff, stats):
+        """Rebuild a row from its Stripe object, then check that it matches"""
+        try:
+            self.repair(source.name, remote)
+            db.session.commit()
+            local = source.model.query.filter(getattr(source.model, source.key) == remote['id']).first()
+            if local is not None and not source.differences(local, remote):
+                source.mark(local, [], datetime.utcnow())
+                db.session.commit()
+                diff['repaired'] = True
+                stats['repaired'] += 1
+        except Exception as e:
+            db.session.rollback()
+            diff['repair_error'] = str(e)
+            logger.warning('Could not repair %s %s: %s', source.name, remote['id'], e)
+
+    def _write(self, diff):
+        self.report.write(json.dumps(diff) + '\n')
@@ -0,0 +1,290 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import or_
+
+from metrics import ERRORS, SUBSCRIPTION_RECONCILIATIONS
+from models import db, Subscription
+from stripe_client import stripe
+
+
+logger = logging.getLogger(__name__)
+
+# Statuses Stripe moves on at the end of a billing period (renewed, past_due or cancelled)
+DUE_STATUSES = ('active', 'trialing', 'past_due')
+
+# Local status names that differ from Stripe's
+_STATUS_ALIASES = {'canceled': 'cancelled'}
+
+
+def subscription_differences(subscription, remote):
+    """
+    Differences between a local Subscription and `remote`, the Stripe side as
+    {'status', 'next_billing_date', 'stripe_price_id'}, as readable strings
+    """
+    problems = []
+    if _STATUS_ALIASES.get(subscription.status, subscription.status) != _STATUS_ALIASES.get(
+        remote['status'], remote['status']
+    ):
+        problems.append(f'status: local {subscription.status}, Stripe {remote["status"]}')
+    if remote['next_billing_date'] and abs(
+        (remote['next_billing_date'] - subscription.next_billing_date).total_seconds()
+    ) > 60:
+        problems.append(
+            f'next_billing_date: local {subscription.next_billing_date:%Y-%m-%d %H:%M}, '
+            f'Stripe {remote["next_billing_date"]:%Y-%m-%d %H:%M}'
+        )
+    if remote['stripe_price_id'] and remote['stripe_price_id'] != subscription.stripe_price_id:
+        problems.append(f'price: local {subscription.stripe_price_id}, Stripe {remote["stripe_price_id"]}')
+    return problems
+
+
+def _unix_time(value):
+    """Unix time of a naive UTC datetime (how every date column is stored)"""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+class RateLimiter:
+    """Token bucket: on average `rate` calls per second, bursts of up to `burst`"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token; returns how many seconds to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class RenewalScheduler:
+    """
+    Reconciles subscriptions with Stripe once their billing date has passed
+
+    Webhooks normally move a subscription into its next period (or to past_due
+    or cancelled); when one is missed the row would stay stale. So:
+
+    - Subscriptions due within `lookahead_seconds` are read in next_billing_date
+      order through the (status, next_billing_date) index, never the whole table
+    - They wait in a min-heap keyed by when they are due (billing date plus
+      `grace_seconds` for Stripe's own renewal and its webhooks); the thread
+      sleeps until the earliest one is due or the next window is read
+    - Due subscriptions are fetched from Stripe in batches of `batch_size`, at
+      most `calls_per_second`, and any difference in status, billing date or
+      price is stored in Subscription.discrepancy (flagged, not changed)
+    - A subscription that is still due after a check is checked again after `recheck_seconds`
+
+    `snapshot(stripe_subscription)` returns the Stripe side as
+    {'status', 'next_billing_date', 'stripe_price_id'}, in the same form the
+    webhook handlers store.
+    """
+
+    def __init__(self, app, fetch_subscription, snapshot, grace_seconds=3600, recheck_seconds=21600,
+                 error_retry_seconds=300, lookahead_seconds=3600, batch_size=50, calls_per_second=5,
+                 max_scheduled=10000):
+        self.app = app
+        self.fetch_subscription = fetch_subscription
+        self.snapshot = snapshot
+        self.grace_seconds = grace_seconds
+        self.recheck_seconds = recheck_seconds
+        self.error_retry_seconds = error_retry_seconds
+        self.lookahead_seconds = lookahead_seconds
+        self.batch_size = batch_size
+        self.max_scheduled = max_scheduled
+        self.rate_limiter = RateLimiter(calls_per_second, burst=max(1, int(calls_per_second)))
+        self._heap = []        # (due_at, subscription id), earliest first
+        self._scheduled = {}   # subscription id -> due_at of its live heap entry
+        self._horizon = 0.0    # everything due before this has been read into the heap
+        self._next_refill = 0.0
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    # ---------------------------------------------------------------
+    # Lifecycle
+    # ---------------------------------------------------------------
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='renewal-scheduler', daemon=True)
+        self._thread.start()
+        logger.info('Started renewal scheduler')
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            with self.app.app_context():
+                try:
+                    delay = self.run_once()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('Renewal scheduler run failed')
+                    ERRORS.inc(component='renewal_scheduler')
+                    delay = self.error_retry_seconds
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    # ---------------------------------------------------------------
+    # Scheduling
+    # ---------------------------------------------------------------
+
+    def _due_at(self, next_billing_date, reconciled_at):
+        """When a subscription needs a check (Unix time)"""
+        due_at = _unix_time(next_billing_date) + self.grace_seconds
+        if reconciled_at is not None:
+            checked_at = _unix_time(reconciled_at)
+            if checked_at >= due_at:
+                # Already checked in this period: check again later
+                due_at = checked_at + self.recheck_seconds
+        return due_at
+
+    def _schedule(self, subscription_id, due_at):
+        if due_at > self._horizon:
+            return  # read again by the refill that covers it
+        self._scheduled[subscription_id] = due_at
+        heapq.heappush(self._heap, (due_at, subscription_id))  # an older entry is skipped when popped
+
+    def _refill(self, now):
+        """Read the subscriptions due before now + lookahead_seconds into the heap"""
+        horizon = now + self.lookahead_seconds
+        # Both columns are naive UTC, so they compare directly in SQL
+        latest_billing_date = datetime.utcfromtimestamp(horizon - self.grace_seconds)
+        # Rows checked recently can't be due again within the window
+        recheck_cutoff = datetime.utcfromtimestamp(horizon - self.recheck_seconds)
+        rows = db.session.query(
+            Subscription.id, Subscription.next_billing_date, Subscription.reconciled_at
+        ).filter(
+            Subscription.status.in_(DUE_STATUSES),
+            Subscription.next_billing_date <= latest_billing_date,
+            or_(
+                Subscription.reconciled_at.is_(None),
+                Subscription.reconciled_at < Subscription.next_billing_date,
+                Subscription.reconciled_at <= recheck_cutoff
+            )
+        ).order_by(Subscription.next_billing_date).limit(self.max_scheduled).all()
+        db.session.commit()  # end the read transaction
+
+        if len(rows) == self.max_scheduled:
+            # More than max_scheduled in the window: cover it up to the last row read,
+            # the rest is read once these are done
+            horizon = min(horizon, _unix_time(rows[-1].next_billing_date) + self.grace_seconds)
+        self._horizon = horizon
+        for subscription_id, next_billing_date, reconciled_at in rows:
+            if subscription_id not in self._scheduled:
+                self._schedule(subscription_id, self._due_at(next_billing_date, reconciled_at))
+        # Read the next window halfway through this one (or at the end of a cut-short one)
+        self._next_refill = now + self.lookahead_seconds / 2
+        if horizon > now:
+            self._next_refill = min(self._next_refill, horizon)
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            due_at, subscription_id = heapq.heappop(self._heap)
+            if self._scheduled.get(subscription_id) != due_at:
+                continue  # superseded by a later _schedule()
+            del self._scheduled[subscription_id]
+            due.append(subscription_id)
+        return due
+
+    def run_once(self):
+        """Check one batch of due subscriptions; returns seconds until there is more to do"""
+        now = time.time()
+        if now >= self._next_refill or not self._heap:
+            self._refill(now)
+        due = self._pop_due(now)
+        if due:
+            self.reconcile(due)
+            return 0.0
+        next_due = self._heap[0][0] if self._heap else self._next_refill
+        return max(0.0, min(next_due, self._next_refill) - time.time())
+
+    def run_due(self):
+        """Check every subscription that is due now, then return (`flask renewal-scheduler --once`)"""
+        while True:
+            self._refill(time.time())
+            due = self._pop_due(time.time())
+            if not due:
+                return
+            while due:
+                self.reconcile(due)
+                due = self._pop_due(time.time())
+
+    # ---------------------------------------------------------------
+    # Reconciliation
+    # ---------------------------------------------------------------
+
+    def compare(self, subscription, stripe_subscription):
+        """Differences between a local row and its Stripe subscription, as readable strings"""
+        if stripe_subscription is None:
+            return ['missing in Stripe']
+        return subscription_differences(subscription, self.snapshot(stripe_subscription))
+
+    def reconcile(self, subscription_ids):
+        """Check the given subscriptions against Stripe and store what differs (one commit)"""
+        subscriptions = Subscription.query.filter(Subscription.id.in_(subscription_ids)).all()
+        for subscription in subscriptions:
+            if subscription.status not in DUE_STATUSES:
+                continue  # cancelled by a webhook since it was scheduled
+            due_at = self._due_at(subscription.next_billing_date, subscription.reconciled_at)
+            if due_at > time.time():
+                self._schedule(subscription.id, due_at)  # renewed by a webhook since it was scheduled
+                continue
+            if not subscription.stripe_subscription_id:
+                self._flag(subscription, ['no Stripe subscription ID'], 'missing')
+                continue
+
+            wait = self.rate_limiter.reserve()
+            if wait and self._stopping.wait(wait):
+                break
+            try:
+                stripe_subscription = self.fetch_subscription(subscription.stripe_subscription_id)
+            except stripe.InvalidRequestError as e:
+                if e.code != 'resource_missing':
+                    self._retry_later(subscription, e)
+                    continue
+                stripe_subscription = None
+            except stripe.StripeError as e:
+                self._retry_later(subscription, e)
+                continue
+
+            problems = self.compare(subscription, stripe_subscription)
+            self._flag(subscription, problems,
+                       'missing' if stripe_subscription is None else 'discrepancy' if problems else 'in_sync')
+        db.session.commit()
+
+    def _flag(self, subscription, problems, outcome):
+        subscription.reconciled_at = datetime.utcnow()
+        subscription.discrepancy = '; '.join(problems) or None
+        SUBSCRIPTION_RECONCILIATIONS.inc(outcome=outcome)
+        if problems:
+            logger.warning('Subscription %s differs from Stripe: %s', subscription.stripe_subscription_id,
+                           subscription.discrepancy, extra={'subscription_id': subscription.stripe_subscription_id})
+        self._schedule(subscription.id, self._due_at(subscription.next_billing_date, subscription.reconciled_at))
+
+    def _retry_later(self, subscription, error):
+        logger.warning('Could not fetch subscription %s from Stripe: %s', subscription.stripe_subscription_id, error)
+        SUBSCRIPTION_RECONCILIATIONS.inc(outcome='error')
+        self._schedule(subscription.id, time.time() + self.error_retry_seconds)
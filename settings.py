@@ -0,0 +1,173 @@
+import logging
+import os
+from collections import namedtuple
+
+from dotenv import load_dotenv
+
+
+# -------------------------------------------------------------------
+# SETTINGS
+# -------------------------------------------------------------------
+# Every environment variable the app reads, parsed into its type and checked
+# once at startup (create_app), instead of os.environ.get in each request.
+# Malformed values stop the app with one error listing all of them; empty
+# values count as unset.
+
+class ConfigError(ValueError):
+    """One or more settings are malformed"""
+
+
+def _text(value):
+    return value
+
+
+def _boolean(value):
+    lowered = value.strip().lower()
+    if lowered in ('true', '1', 'yes', 'on'):
+        return True
+    if lowered in ('false', '0', 'no', 'off'):
+        return False
+    raise ValueError('expected true or false')
+
+
+def _number(cast, minimum, description):
+    def parse(value):
+        try:
+            number = cast(value)
+        except ValueError:
+            raise ValueError(f'expected {description}')
+        if number < minimum:
+            raise ValueError(f'expected {description}')
+        return number
+    return parse
+
+
+def _choice(*choices):
+    def parse(value):
+        if value.lower() not in choices:
+            raise ValueError(f'expected one of {", ".join(choices)}')
+        return value.lower()
+    return parse
+
+
+def _text_list(value):
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def _log_level(value):
+    if not isinstance(logging.getLevelName(value.upper()), int):
+        raise ValueError('expected a logging level (DEBUG, INFO, WARNING, ERROR)')
+    return value.upper()
+
+
+_positive_int = _number(int, 1, 'a positive integer')
+_count = _number(int, 0, 'an integer >= 0')
+_positive_float = _number(float, 0.000001, 'a positive number')
+_duration = _number(float, 0, 'a number >= 0')
+
+_FIELDS = (
+    # attribute, environment variable, parser, default
+    ('secret_key', 'SECRET_KEY', _text, None),
+    ('database_url', 'DATABASE_URL', _text, 'sqlite:///payment_prototype.db'),
+    # Read-only copies of DATABASE_URL, comma-separated (see read_replicas.py)
+    ('database_replica_urls', 'DATABASE_REPLICA_URLS', _text_list, ()),
+    ('replica_sticky_seconds', 'REPLICA_STICKY_SECONDS', _duration, 10.0),
+
+    # JSON API (api.py): bearer tokens of the callers allowed to read it, comma-separated
+    ('api_keys', 'API_KEYS', _text_list, ()),
+
+    # Stripe
+    ('stripe_secret_key', 'STRIPE_SECRET_KEY', _text, None),
+    ('stripe_publishable_key', 'STRIPE_PUBLISHABLE_KEY', _text, ''),
+    ('stripe_webhook_secret', 'STRIPE_WEBHOOK_SECRET', _text, ''),
+    ('stripe_api_base', 'STRIPE_API_BASE', _text, None),
+    ('stripe_timeout_seconds', 'STRIPE_TIMEOUT_SECONDS', _positive_float, 10.0),
+    ('stripe_max_retries', 'STRIPE_MAX_RETRIES', _count, 2),
+    ('stripe_pool_size', 'STRIPE_POOL_SIZE', _positive_int, 20),
+    ('price_id_one_time', 'STRIPE_PRICE_ID_ONE_TIME', _text, None),
+    ('price_id_subs_one', 'STRIPE_PRICE_ID_SUBS_ONE', _text, None),
+    ('price_id_subs_two', 'STRIPE_PRICE_ID_SUBS_TWO', _text, None),
+
+    # In-process caches
+    ('price_catalog_ttl', 'PRICE_CATALOG_TTL', _positive_int, 3600),
+    ('price_catalog_max_size', 'PRICE_CATALOG_MAX_SIZE', _positive_int, 256),
+    ('user_cache_ttl', 'USER_CACHE_TTL', _positive_float, 300.0),
+    ('user_cache_size', 'USER_CACHE_SIZE', _positive_int, 10000),
+    ('customer_cache_size', 'CUSTOMER_CACHE_SIZE', _positive_int, 10000),
+    ('pricing_page_max_age', 'PRICING_PAGE_MAX_AGE', _count, 60),
+
+    # Webhook processing
+    ('webhook_async', 'WEBHOOK_ASYNC', _boolean, False),
+    ('webhook_workers_in_process', 'WEBHOOK_WORKERS_IN_PROCESS', _boolean, True),
+    ('webhook_workers', 'WEBHOOK_WORKERS', _positive_int, 4),
+    ('webhook_max_attempts', 'WEBHOOK_MAX_ATTEMPTS', _positive_int, 8),
+    ('webhook_retry_base_seconds', 'WEBHOOK_RETRY_BASE_SECONDS', _positive_float, 2.0),
+    ('webhook_batch_size', 'WEBHOOK_BATCH_SIZE', _positive_int, 1),
+    ('webhook_batch_window_ms', 'WEBHOOK_BATCH_WINDOW_MS', _duration, 50.0),
+    ('webhook_processes', 'WEBHOOK_PROCESSES', _count, 0),
+    ('webhook_heartbeat_seconds', 'WEBHOOK_HEARTBEAT_SECONDS', _positive_float, 5.0),
+
+    # Renewal scheduler
+    ('renewal_scheduler', 'RENEWAL_SCHEDULER', _boolean, False),
+    ('renewal_grace_seconds', 'RENEWAL_GRACE_SECONDS', _count, 3600),
+    ('renewal_recheck_seconds', 'RENEWAL_RECHECK_SECONDS', _positive_int, 21600),
+    ('renewal_batch_size', 'RENEWAL_BATCH_SIZE', _positive_int, 50),
+    ('renewal_stripe_calls_per_second', 'RENEWAL_STRIPE_CALLS_PER_SECOND', _positive_float, 5.0),
+
+    # ASGI mode (asgi.py)
+    ('async_database_url', 'ASYNC_DATABASE_URL', _text, None),
+    ('stripe_async_pool_size', 'STRIPE_ASYNC_POOL_SIZE', _positive_int, 200),
+    ('async_db_pool_size', 'ASYNC_DB_POOL_SIZE', _positive_int, 10),
+    ('async_db_max_overflow', 'ASYNC_DB_MAX_OVERFLOW', _count, 20),
+
+    # Logging
+    ('log_level', 'LOG_LEVEL', _log_level, 'INFO'),
+    ('log_format', 'LOG_FORMAT', _choice('json', 'text'), 'json'),
+)
+
+
+class Settings(namedtuple('Settings', [field[0] for field in _FIELDS])):
+    """Immutable, parsed settings; settings._replace(...) for a variant"""
+    __slots__ = ()
+
+    @property
+    def price_ids(self):
+        """Price IDs referenced by the checkout pages"""
+        return [price_id for price_id in (self.price_id_one_time, self.price_id_subs_one, self.price_id_subs_two)
+                if price_id]
+
+    @property
+    def plan_tier_prices(self):
+        return {'one': self.price_id_subs_one, 'two': self.price_id_subs_two}
+
+    def warnings(self):
+        """Settings the app runs without, but not usefully"""
+        missing = [name for attribute, name, _, _ in _FIELDS
+                   if attribute in ('secret_key', 'stripe_secret_key', 'stripe_webhook_secret')
+                   and not getattr(self, attribute)]
+        return [f'{name} is not set' for name in missing]
+
+
+def load_settings(environ=None):
+    """
+    Parse the settings from `environ` (default: os.environ, after loading .env)
+
+    Raises ConfigError naming every malformed variable.
+    """
+    if environ is None:
+        load_dotenv()
+        environ = os.environ
+    values = {}
+    errors = []
+    for attribute, name, parse, default in _FIELDS:
+        raw = environ.get(name)
+        if raw is None or raw.strip() == '':
+            values[attribute] = default
+            continue
+        try:
+            values[attribute] = parse(raw.strip())
+        except ValueError as e:
+            errors.append(f'{name}={raw!r}: {e}')
+    if errors:
+        raise ConfigError('Invalid settings:\n  ' + '\n  '.join(errors))
+    return Settings(**values)
@@ -0,0 +1,256 @@
+import asyncio
+import importlib
+import random
+import ssl
+import threading
+import time
+import uuid
+
+from metrics import ERRORS, STRIPE_CALL_SECONDS, STRIPE_RETRIES
+
+
+STRIPE_API_VERSION = '2025-10-29.clover'
+
+
+class _LazyStripe:
+    """
+    The stripe package, imported on first attribute access
+
+    Importing the SDK takes about a second (it loads every resource module),
+    more than the rest of the app together. Modules use `from stripe_client
+    import stripe` and write stripe.X as usual; the import then happens on the
+    first Stripe call (or in the price catalog warm-up thread), not at startup.
+    """
+
+    _module = None
+
+    def __getattr__(self, name):
+        if _LazyStripe._module is None:
+            _LazyStripe._module = importlib.import_module('stripe')
+        return getattr(_LazyStripe._module, name)
+
+
+stripe = _LazyStripe()
+
+
+class StripeGateway:
+    """
+    Single entry point for every outbound Stripe API call
+
+    - One pooled, persistent HTTP session (keep-alive, no TLS setup per call)
+    - Per-call timeout
+    - Bounded retries with full jitter on 429, 5xx and connection errors
+      (every retry of a checkout session create sends the same idempotency
+      key, so the retries can't produce a second session; a resubmitted form
+      is only covered if the caller passes a key derived from it and from
+      the request parameters, see app.checkout_idempotency_key)
+    - Per-endpoint call counters and latency, see stats() (also exported on /metrics)
+
+    `api_base` points the client at another server (e.g. stripe-mock or the
+    fake Stripe server in benchmarks/) for local testing.
+    """
+
+    def __init__(self, api_key, api_version=None, api_base=None, timeout=10,
+                 max_retries=2, retry_base_seconds=0.5, retry_max_seconds=8, pool_size=20):
+        self.api_key = api_key
+        self.api_version = api_version
+        self.api_base = api_base
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.pool_size = pool_size
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    # ---------------------------------------------------------------
+    # Client setup
+    # ---------------------------------------------------------------
+
+    @property
+    def client(self):
+        """stripe.StripeClient, created on first use"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._build_client()
+        return self._client
+
+    def _build_client(self):
+        # Imported here with the SDK, not at startup (see _LazyStripe)
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        options = {
+            'http_client': stripe.RequestsClient(timeout=self.timeout, session=session),
+            'max_network_retries': 0,  # retries are handled in _call()
+        }
+        if self.api_version:
+            options['stripe_version'] = self.api_version
+        if self.api_base:
+            options['base_addresses'] = {'api': self.api_base}
+        return stripe.StripeClient(self.api_key or '', **options)
+
+    # ---------------------------------------------------------------
+    # Retries and stats
+    # ---------------------------------------------------------------
+
+    @staticmethod
+    def _is_retryable(error):
+        if isinstance(error, (stripe.RateLimitError, stripe.APIConnectionError)):
+            return True
+        status = getattr(error, 'http_status', None)
+        return status is not None and (status == 429 or status >= 500)
+
+    def _record(self, endpoint, elapsed_ms, retries, failed):
+        with self._stats_lock:
+            stats = self._stats.setdefault(endpoint, {
+                'calls': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0, 'max_ms': 0.0
+            })
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            if failed:
+                stats['errors'] += 1
+        STRIPE_CALL_SECONDS.observe(elapsed_ms / 1000, endpoint=endpoint, outcome='error' if failed else 'ok')
+        if retries:
+            STRIPE_RETRIES.inc(retries, endpoint=endpoint)
+        if failed:
+            ERRORS.inc(component='stripe')
+
+    def stats(self):
+        """Snapshot of {endpoint: {calls, errors, retries, total_ms, max_ms, avg_ms}}"""
+        with self._stats_lock:
+            snapshot = {endpoint: dict(values) for endpoint, values in self._stats.items()}
+        for values in snapshot.values():
+            values['avg_ms'] = values['total_ms'] / values['calls'] if values['calls'] else 0.0
+        return snapshot
+
+    def _retry_delay(self, attempt):
+        """Seconds to wait before retry number `attempt` (exponential, full jitter)"""
+        delay = min(self.retry_max_seconds, self.retry_base_seconds * (2 ** (attempt - 1)))
+        return random.uniform(0, delay)
+
+    def _call(self, endpoint, fn, *args, **kwargs):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                result = fn(*args, **kwargs)
+                self._record(endpoint, (time.perf_counter() - started) * 1000, attempt, False)
+                return result
+            except stripe.StripeError as e:
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    self._record(endpoint, (time.perf_counter() - started) * 1000, attempt, True)
+                    raise
+                attempt += 1
+                time.sleep(self._retry_delay(attempt))
+
+    # ---------------------------------------------------------------
+    # API calls used by the app
+    # ---------------------------------------------------------------
+
+    def retrieve_price(self, price_id):
+        return self._call('prices.retrieve', self.client.prices.retrieve, price_id)
+
+    def retrieve_customer(self, customer_id):
+        return self._call('customers.retrieve', self.client.customers.retrieve, customer_id)
+
+    def retrieve_subscription(self, subscription_id):
+        return self._call('subscriptions.retrieve', self.client.subscriptions.retrieve, subscription_id)
+
+    def list_subscriptions(self, params):
+        return self._call('subscriptions.list', self.client.subscriptions.list, params)
+
+    def create_checkout_session(self, params, idempotency_key=None):
+        # The same key is sent on every retry of this call; the default one
+        # is new per call, so it doesn't dedupe separate requests
+        options = {'idempotency_key': idempotency_key or f'checkout-{uuid.uuid4()}'}
+        return self._call('checkout.sessions.create', self.client.checkout.sessions.create, params, options)
+
+    def retrieve_checkout_session(self, session_id):
+        return self._call('checkout.sessions.retrieve', self.client.checkout.sessions.retrieve, session_id)
+
+    def list_checkout_sessions(self, params):
+        return self._call('checkout.sessions.list', self.client.checkout.sessions.list, params)
+
+    def list_events(self, params):
+        return self._call('events.list', self.client.events.list, params)
+
+
+class AsyncStripeGateway(StripeGateway):
+    """
+    StripeGateway for asyncio code (see asgi.py): the same timeouts, retries and
+    stats, but every call is awaited over one aiohttp connection pool, so a
+    request waiting on Stripe doesn't hold a thread. Needs aiohttp.
+
+    The client is created on first use, inside the running event loop.
+    """
+
+    def _build_client(self):
+        import aiohttp
+
+        http_client = stripe.AIOHTTPClient(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        # stripe.AIOHTTPClient doesn't expose pool limits (aiohttp defaults to 100
+        # connections), so give it a session sized for pool_size in-flight calls
+        http_client._cached_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=self.pool_size,
+            ssl=ssl.create_default_context(cafile=stripe.ca_bundle_path)
+        ))
+        self._http_client = http_client
+        options = {
+            'http_client': http_client,
+            'max_network_retries': 0,  # retries are handled in _call()
+        }
+        if self.api_version:
+            options['stripe_version'] = self.api_version
+        if self.api_base:
+            options['base_addresses'] = {'api': self.api_base}
+        return stripe.StripeClient(self.api_key or '', **options)
+
+    async def _call(self, endpoint, fn, *args, **kwargs):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                result = await fn(*args, **kwargs)
+                self._record(endpoint, (time.perf_counter() - started) * 1000, attempt, False)
+                return result
+            except stripe.StripeError as e:
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    self._record(endpoint, (time.perf_counter() - started) * 1000, attempt, True)
+                    raise
+                attempt += 1
+                await asyncio.sleep(self._retry_delay(attempt))
+
+    async def close(self):
+        """Close the pooled connections (at ASGI shutdown)"""
+        if self._client is not None:
+            await self._http_client.close_async()
+
+    # ---------------------------------------------------------------
+    # API calls used by the ASGI app
+    # ---------------------------------------------------------------
+
+    async def retrieve_price(self, price_id):
+        return await self._call('prices.retrieve', self.client.prices.retrieve_async, price_id)
+
+    async def retrieve_customer(self, customer_id):
+        return await self._call('customers.retrieve', self.client.customers.retrieve_async, customer_id)
+
+    async def create_checkout_session(self, params, idempotency_key=None):
+        options = {'idempotency_key': idempotency_key or f'checkout-{uuid.uuid4()}'}
+        return await self._call('checkout.sessions.create', self.client.checkout.sessions.create_async,
+                                params, options)
+
+    async def retrieve_checkout_session(self, session_id):
+        return await self._call('checkout.sessions.retrieve', self.client.checkout.sessions.retrieve_async,
+                                session_id)
@@ -0,0 +1,120 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+
+# -------------------------------------------------------------------
+# NON-BLOCKING, STRUCTURED LOGGING
+# -------------------------------------------------------------------
+# Request and worker threads only put records on an in-memory queue; a
+# single listener thread formats them and writes to stdout. Records carry
+# the current log context (e.g. the Stripe event being processed) plus any
+# `extra={...}` fields, and are written as one JSON object per line
+# (LOG_FORMAT=text for plain lines during development).
+
+_context = contextvars.ContextVar('log_context', default={})
+
+# Attributes every LogRecord has; anything else was passed with extra={...}
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+# Third-party loggers that log every request at INFO
+_QUIET_LOGGERS = ('stripe', 'urllib3')
+
+_listener = None
+
+
+@contextmanager
+def log_context(**fields):
+    """Add fields (e.g. event_id, event_type) to every record logged inside the block"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update({
+            key: value for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_')
+        })
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = {
+            key: value for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_')
+        }
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+class _ContextQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Runs in the logging thread: capture the context and merge the message
+        # arguments now (they may change later); formatting happens in the listener
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def configure_logging(level='INFO', fmt='json', stream=None):
+    """Route all logging through a queue to one writer thread (idempotent)"""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(TextFormatter() if fmt == 'text' else JsonFormatter())
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [_ContextQueueHandler(records)]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    for name in _QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = QueueListener(records, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(stop_logging)  # flush what is still queued on exit
+    os.register_at_fork(after_in_child=_restart_listener)
+
+
+def _restart_listener():
+    # The writer thread doesn't survive fork(); a forked worker process
+    # (flask webhook-worker --processes) starts its own on the same queue
+    global _listener
+    if _listener is not None:
+        _listener = QueueListener(_listener.queue, *_listener.handlers, respect_handler_level=False)
+        _listener.start()
+
+
+def stop_logging():
+    """Write out the queued records and stop the writer thread"""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
@@ -0,0 +1,96 @@
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+
+from app import create_app
+from migrations import upgrade_schema
+from models import db, User
+from settings import load_settings
+
+
+WEBHOOK_SECRET = 'whsec_test'
+API_KEY = 'api_key_test'
+API_HEADERS = {'Authorization': f'Bearer {API_KEY}'}
+PRICE_ID = 'price_one'
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """create_app() on a throwaway SQLite database; keyword arguments are extra environment variables"""
+    def make(**environ):
+        environ = {
+            'SECRET_KEY': 'test',
+            'DATABASE_URL': f'sqlite:///{tmp_path / "test.db"}',
+            'STRIPE_WEBHOOK_SECRET': WEBHOOK_SECRET,
+            'API_KEYS': API_KEY,
+            # Nothing listens here: a test that reaches Stripe fails fast instead of going online
+            'STRIPE_API_BASE': 'http://127.0.0.1:9',
+            'STRIPE_MAX_RETRIES': '0',
+            'STRIPE_PRICE_ID_SUBS_ONE': PRICE_ID,
+            'LOG_FORMAT': 'text',
+            **environ
+        }
+        app = create_app(load_settings(environ))
+        app.config['TESTING'] = True
+        with app.app_context():
+            upgrade_schema()
+        return app
+    return make
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def customer(app):
+    """A user with a Stripe customer ID, as left by checkout.session.completed"""
+    with app.app_context():
+        user = User(email='ada@example.com', name='Ada', stripe_customer_id='cus_1')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+# -------------------------------------------------------------------
+# Stripe events
+# -------------------------------------------------------------------
+
+def stripe_event(event_id, event_type, created, data_object):
+    return {'id': event_id, 'object': 'event', 'type': event_type, 'created': created,
+            'data': {'object': data_object}}
+
+
+def subscription_object(subscription_id='sub_1', customer='cus_1', status='active', period_end=2000000000,
+                        price_id=PRICE_ID):
+    price = {'id': price_id, 'object': 'price', 'unit_amount': 1000, 'currency': 'cad',
+             'recurring': {'interval': 'month'}, 'product': 'prod_1'}
+    return {
+        'id': subscription_id, 'object': 'subscription', 'customer': customer, 'status': status,
+        'metadata': {},
+        'items': {'data': [{'price': price, 'current_period_start': period_end - 2592000,
+                            'current_period_end': period_end}]},
+    }
+
+
+def signature_header(payload, secret=WEBHOOK_SECRET, timestamp=None):
+    """Stripe-Signature header for a raw body (bytes), as Stripe computes it"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f'{timestamp}.'.encode() + payload, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def post_event(client, event):
+    """POST a correctly signed event to /webhook"""
+    payload = json.dumps(event).encode()
+    return client.post('/webhook', data=payload, content_type='application/json',
+                       headers={'Stripe-Signature': signature_header(payload)})
@@ -0,0 +1,44 @@
+from datetime import datetime
+
+import pytest
+
+from analytics import analytics_summary, rebuild_rollups
+from models import Payment
+
+from conftest import post_event, stripe_event, subscription_object
+
+
+def invoice_paid(event_id, invoice_id, amount_paid, created):
+    invoice = {'id': invoice_id, 'object': 'invoice', 'subscription': 'sub_1', 'amount_paid': amount_paid,
+               'lines': {'data': [{'period': {'end': 2000000000}}]}}
+    return stripe_event(event_id, 'invoice.payment_succeeded', created, invoice)
+
+
+def tier_revenue(app):
+    today = datetime.utcnow().date()
+    with app.app_context():
+        summary = analytics_summary(today, today)
+    return summary['revenue']['total'], summary['by_plan_tier']['one']['revenue']
+
+
+@pytest.fixture
+def subscribed(client, customer):
+    post_event(client, stripe_event('evt_1', 'customer.subscription.created', 100, subscription_object()))
+
+
+@pytest.mark.parametrize('engine', ['sql', 'numpy'])
+def test_invoice_revenue_counts_toward_its_plan_tier(app, client, subscribed, engine):
+    if engine == 'numpy':
+        pytest.importorskip('numpy')
+    assert post_event(client, invoice_paid('evt_2', 'in_1', 1000, 200)).status_code == 200
+    # Redelivered under another event ID, and an older invoice arriving after the watermark moved on
+    post_event(client, invoice_paid('evt_3', 'in_1', 1000, 300))
+    post_event(client, invoice_paid('evt_4', 'in_2', 2500, 150))
+    assert tier_revenue(app) == ('35.00', '35.00')
+
+    with app.app_context():
+        assert [(p.transaction_id, str(p.amount), p.payment_type) for p in Payment.query.order_by(Payment.id)] == [
+            ('in_1', '10.00', 'subscription'), ('in_2', '25.00', 'subscription')
+        ]
+        rebuild_rollups(engine)
+    assert tier_revenue(app) == ('35.00', '35.00')
@@ -0,0 +1,45 @@
+from decimal import Decimal
+
+import pytest
+
+from app import repair_from_stripe
+from models import db, Payment
+
+from conftest import API_HEADERS
+
+
+@pytest.fixture
+def payment(app, customer):
+    with app.app_context():
+        db.session.add(Payment(user_id=customer, amount=Decimal('25.00'), payment_type='one_time',
+                               status='pending', transaction_id='cs_1'))
+        db.session.commit()
+
+
+@pytest.mark.parametrize('headers', [{}, {'Authorization': 'Bearer wrong'}, {'Authorization': 'Basic dXNlcjpwdw=='}])
+def test_api_needs_a_key(client, customer, headers):
+    for path in (f'/api/users/{customer}/payments', f'/api/users/{customer}/subscriptions', '/api/analytics'):
+        response = client.get(path, headers=headers)
+        assert response.status_code == 401
+        assert response.headers['WWW-Authenticate'] == 'Bearer'
+
+
+def test_api_is_closed_without_keys(make_app, customer):
+    client = make_app(API_KEYS='').test_client()
+    assert client.get(f'/api/users/{customer}/payments', headers=API_HEADERS).status_code == 401
+
+
+def test_payments_etag_changes_after_a_repair(app, client, customer, payment):
+    path = f'/api/users/{customer}/payments'
+    first = client.get(path, headers=API_HEADERS)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert client.get(path, headers={**API_HEADERS, 'If-None-Match': etag}).status_code == 304
+
+    with app.app_context():
+        repair_from_stripe('checkout_sessions', {'id': 'cs_1', 'payment_status': 'paid', 'amount_total': 3000})
+
+    repaired = client.get(path, headers={**API_HEADERS, 'If-None-Match': etag})
+    assert repaired.status_code == 200
+    assert repaired.headers['ETag'] != etag
+    assert [(row['amount'], row['status']) for row in repaired.json['data']] == [('30.00', 'completed')]
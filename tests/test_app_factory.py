@@ -0,0 +1,22 @@
+from app import services, settings
+
+
+def test_each_app_keeps_its_own_services(make_app):
+    first = make_app(PRICING_PAGE_MAX_AGE='60')
+    second = make_app(PRICING_PAGE_MAX_AGE='5')
+
+    assert services(first) is not services(second)
+    assert services(first).settings.pricing_page_max_age == 60
+    with first.app_context():
+        assert settings.pricing_page_max_age == 60
+    with second.app_context():
+        assert settings.pricing_page_max_age == 5
+
+
+def test_pages_use_the_app_that_serves_them(make_app):
+    first = make_app(PRICING_PAGE_MAX_AGE='60')
+    make_app(PRICING_PAGE_MAX_AGE='5')
+
+    response = first.test_client().get('/payment/subscribe')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'public, max-age=60'
@@ -0,0 +1,67 @@
+import asyncio
+import importlib
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from migrations import upgrade_schema
+from read_replicas import STICKY_SESSION_KEY
+
+
+@pytest.fixture
+def asgi(monkeypatch, tmp_path):
+    """asgi.py, imported with replicas configured (it builds its app from the environment)"""
+    for name in ('asgiref', 'aiohttp', 'aiosqlite'):
+        pytest.importorskip(name)
+    environ = {
+        'SECRET_KEY': 'test',
+        'DATABASE_URL': f'sqlite:///{tmp_path / "test.db"}',
+        'DATABASE_REPLICA_URLS': f'sqlite:///{tmp_path / "replica.db"}',
+        'STRIPE_SECRET_KEY': 'sk_test',
+        'STRIPE_PRICE_ID_ONE_TIME': 'price_once',
+        'STRIPE_API_BASE': 'http://127.0.0.1:9',
+        'STRIPE_MAX_RETRIES': '0',
+        'LOG_FORMAT': 'text',
+    }
+    for name, value in environ.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.delitem(sys.modules, 'asgi', raising=False)
+    module = importlib.import_module('asgi')
+    with module.flask_app.app_context():
+        upgrade_schema()
+
+    async def create_checkout_session(params, idempotency_key=None):
+        return SimpleNamespace(client_secret='cs_secret')
+    monkeypatch.setattr(module.stripe_async, 'create_checkout_session', create_checkout_session)
+    yield module
+    asyncio.run(module.async_engine.dispose())
+
+
+def post(asgi, path, body):
+    scope = {'type': 'http', 'method': 'POST', 'path': path, 'scheme': 'http',
+             'headers': [(b'host', b'localhost'), (b'content-type', b'application/x-www-form-urlencoded')]}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    return sent[0]['status'], sent[0]['headers']
+
+
+def test_async_checkout_keeps_the_client_on_the_primary(asgi):
+    status, headers = post(asgi, '/create-checkout-session', b'email=ada%40example.com&name=Ada&checkout_nonce=abc123')
+    assert status == 200
+
+    cookies = [value.decode() for name, value in headers if name == b'set-cookie']
+    assert len(cookies) == 1
+    name, _, value = cookies[0].partition(';')[0].partition('=')
+    assert name == asgi.flask_app.config['SESSION_COOKIE_NAME']
+    session = asgi.flask_app.session_interface.get_signing_serializer(asgi.flask_app).loads(value)
+    assert session[STICKY_SESSION_KEY] > time.time()
@@ -0,0 +1,57 @@
+from backfill import load_checkpoint, run_backfill
+
+from conftest import stripe_event
+
+
+HANDLED_TYPES = {'invoice.paid'}
+
+
+def events():
+    return [stripe_event(f'evt_{i}', 'invoice.paid', 1000 + i // 2, {'id': f'in_{i}'}) for i in range(6)]
+
+
+class FlakyHandler:
+    """process_event stand-in that raises for `failing` event IDs until healed"""
+
+    def __init__(self, *failing):
+        self.failing = set(failing)
+        self.applied = []
+
+    def __call__(self, event):
+        if event['id'] in self.failing:
+            raise RuntimeError('handler failed')
+        self.applied.append(event['id'])
+
+
+def test_failed_event_is_retried_by_the_next_run(app, tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    handler = FlakyHandler('evt_1')
+
+    with app.app_context():
+        stats = run_backfill(events(), handler, HANDLED_TYPES, batch_size=3, checkpoint_path=checkpoint_path)
+    assert (stats['applied'], stats['failed'], stats['failed_ids']) == (5, 1, ['evt_1'])
+    # evt_0 also ran in the rolled back batch transaction
+    assert sorted(set(handler.applied)) == ['evt_0', 'evt_2', 'evt_3', 'evt_4', 'evt_5']
+    assert load_checkpoint(checkpoint_path)['failed'] == {'evt_1': 1000}
+
+    handler.failing.clear()
+    handler.applied.clear()
+    with app.app_context():
+        stats = run_backfill(events(), handler, HANDLED_TYPES, batch_size=3, checkpoint_path=checkpoint_path)
+    assert (stats['seen'], stats['applied'], stats['failed']) == (1, 1, 0)
+    assert handler.applied == ['evt_1']
+
+    checkpoint = load_checkpoint(checkpoint_path)
+    assert checkpoint['failed'] == {}
+    assert (checkpoint['last_created'], checkpoint['processed']) == (1002, 6)
+
+
+def test_interrupted_run_resumes_after_the_last_batch(app, tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    handler = FlakyHandler()
+
+    with app.app_context():
+        run_backfill(events()[:4], handler, HANDLED_TYPES, batch_size=2, checkpoint_path=checkpoint_path)
+        stats = run_backfill(events(), handler, HANDLED_TYPES, batch_size=2, checkpoint_path=checkpoint_path)
+    assert (stats['seen'], stats['applied']) == (2, 2)
+    assert handler.applied == [f'evt_{i}' for i in range(6)]
@@ -0,0 +1,34 @@
+import pytest
+
+from app import checkout_customer_params, checkout_idempotency_key
+from models import User
+
+
+NONCE = '0f1e2d3c4b5a69788796a5b4c3d2e1f0'
+
+
+def checkout_params(user, price_id='price_one'):
+    return dict(ui_mode='embedded', **checkout_customer_params(user), line_items=[{'price': price_id, 'quantity': 1}],
+                mode='payment', metadata={'user_id': user.id, 'payment_type': 'one_time'})
+
+
+def test_same_form_submission_gets_the_same_key():
+    user = User(id=7, email='ada@example.com', name='Ada')
+    assert checkout_idempotency_key(checkout_params(user), NONCE) == checkout_idempotency_key(checkout_params(user), NONCE)
+    assert checkout_idempotency_key(checkout_params(user), NONCE) != checkout_idempotency_key(
+        checkout_params(user, 'price_two'), NONCE)
+    other = User(id=8, email='grace@example.com', name='Grace')
+    assert checkout_idempotency_key(checkout_params(user), NONCE) != checkout_idempotency_key(checkout_params(other), NONCE)
+
+
+def test_resubmit_after_the_customer_was_linked_gets_another_key():
+    # Stripe answers idempotency_error if a key comes back with other parameters
+    user = User(id=7, email='ada@example.com', name='Ada')
+    before = checkout_idempotency_key(checkout_params(user), NONCE)
+    user.stripe_customer_id = 'cus_1'
+    assert checkout_idempotency_key(checkout_params(user), NONCE) != before
+
+
+@pytest.mark.parametrize('nonce', [None, '', 'a' * 65, 'not-a-nonce', 'nonce\nwith newline'])
+def test_unusable_nonce_leaves_the_key_to_the_gateway(nonce):
+    assert checkout_idempotency_key({'mode': 'payment'}, nonce) is None
@@ -0,0 +1,18 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from models import db, Payment
+
+
+def test_totals_are_labelled_as_completed_payments_only(app, client, customer):
+    with app.app_context():
+        for transaction_id, status, amount in (('cs_1', 'completed', '25.00'), ('cs_2', 'pending', '40.00')):
+            db.session.add(Payment(user_id=customer, amount=Decimal(amount), payment_type='one_time', status=status,
+                                   transaction_id=transaction_id, created_at=datetime.utcnow() - timedelta(hours=1)))
+        db.session.commit()
+
+    page = client.get('/dashboard?email=ada@example.com').get_data(as_text=True)
+    # The list shows both payments, the totals only the completed one
+    assert 'status-completed' in page and 'status-pending' in page
+    assert '$25.00 <span style="color: #666;">(completed payments only)</span>' in page
+    assert '<strong>Completed Payments:</strong> 1' in page
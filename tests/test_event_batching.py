@@ -0,0 +1,65 @@
+from event_batching import coalesce
+
+
+def _event(event_id, event_type, created, object_id='sub_1', **fields):
+    return {'id': event_id, 'type': event_type, 'created': created,
+            'data': {'object': dict(id=object_id, **fields)}}
+
+
+def _ids(pairs):
+    return [event['id'] for _, event in pairs]
+
+
+def test_in_order_snapshots_keep_the_last():
+    events = list(enumerate([
+        _event('evt_1', 'customer.subscription.updated', 100, status='trialing'),
+        _event('evt_2', 'customer.subscription.updated', 200, status='past_due'),
+        _event('evt_3', 'customer.subscription.updated', 300, status='active'),
+    ]))
+    to_apply, superseded = coalesce(events)
+    assert _ids(to_apply) == ['evt_3']
+    assert _ids(superseded) == ['evt_1', 'evt_2']
+
+
+def test_out_of_order_snapshots_keep_the_newest_by_created():
+    events = list(enumerate([
+        _event('evt_1', 'customer.subscription.created', 100, status='active'),
+        _event('evt_2', 'customer.subscription.updated', 300, status='past_due'),
+        _event('evt_3', 'customer.subscription.updated', 200, status='active'),
+    ]))
+    to_apply, superseded = coalesce(events)
+    assert _ids(to_apply) == ['evt_1', 'evt_2']
+    assert _ids(superseded) == ['evt_3']
+
+
+def test_same_second_snapshots_are_all_applied():
+    events = list(enumerate([
+        _event('evt_1', 'customer.subscription.updated', 100, status='trialing'),
+        _event('evt_2', 'customer.subscription.updated', 200, status='past_due'),
+        _event('evt_3', 'customer.subscription.updated', 200, status='active'),
+    ]))
+    to_apply, superseded = coalesce(events)
+    assert _ids(to_apply) == ['evt_2', 'evt_3']
+    assert _ids(superseded) == ['evt_1']
+
+
+def test_other_events_for_the_key_end_the_run():
+    events = list(enumerate([
+        _event('evt_1', 'customer.subscription.updated', 100, status='active'),
+        _event('evt_2', 'customer.subscription.deleted', 150, status='canceled'),
+        _event('evt_3', 'customer.subscription.updated', 200, status='canceled'),
+    ]))
+    to_apply, superseded = coalesce(events)
+    assert _ids(to_apply) == ['evt_1', 'evt_2', 'evt_3']
+    assert superseded == []
+
+
+def test_other_objects_are_independent():
+    events = list(enumerate([
+        _event('evt_1', 'customer.subscription.updated', 100, object_id='sub_1'),
+        _event('evt_2', 'customer.subscription.updated', 100, object_id='sub_2'),
+        _event('evt_3', 'customer.subscription.updated', 200, object_id='sub_1'),
+    ]))
+    to_apply, superseded = coalesce(events)
+    assert _ids(to_apply) == ['evt_2', 'evt_3']
+    assert _ids(superseded) == ['evt_1']
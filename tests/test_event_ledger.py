@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+from app import process_event
+from event_ledger import STALE_CLAIM_SECONDS, claim_event, record_event_processed
+from event_queue import WebhookWorkerPool
+from models import db, Payment, ProcessedEvent, WebhookEvent
+
+from conftest import post_event, stripe_event, subscription_object
+
+
+def _checkout_completed(event_id, user_id):
+    return stripe_event(event_id, 'checkout.session.completed', 100, {
+        'id': 'cs_1', 'object': 'checkout.session', 'customer': 'cus_1', 'amount_total': 2500,
+        'metadata': {'user_id': str(user_id), 'payment_type': 'one_time'},
+    })
+
+
+def test_redelivered_event_is_applied_once(app, client, customer):
+    event = _checkout_completed('evt_1', customer)
+    assert post_event(client, event).json == {'status': 'success'}
+    assert post_event(client, event).json == {'status': 'duplicate'}
+    with app.app_context():
+        assert Payment.query.count() == 1
+        ledger = ProcessedEvent.query.filter_by(event_id='evt_1').one()
+        assert ledger.processed_at is not None
+
+
+def test_redelivered_event_is_queued_once(make_app, customer):
+    client = make_app(WEBHOOK_ASYNC='true', WEBHOOK_WORKERS_IN_PROCESS='false').test_client()
+    event = _checkout_completed('evt_1', customer)
+    assert post_event(client, event).json == {'status': 'queued'}
+    assert post_event(client, event).json == {'status': 'duplicate'}
+    with client.application.app_context():
+        assert WebhookEvent.query.count() == 1
+
+
+def test_failed_event_is_processed_again_on_redelivery(app, client, customer):
+    post_event(client, stripe_event('evt_1', 'customer.subscription.created', 100, subscription_object()))
+    # A price that is neither embedded nor retrievable: the handler fails and Stripe will retry
+    failing = stripe_event('evt_2', 'customer.subscription.updated', 200, subscription_object(price_id='price_gone'))
+    del failing['data']['object']['items']['data'][0]['price']['unit_amount']
+    assert post_event(client, failing).status_code == 500
+    with app.app_context():
+        assert ProcessedEvent.query.filter_by(event_id='evt_2').count() == 0
+
+    retried = stripe_event('evt_2', 'customer.subscription.updated', 200, subscription_object(status='past_due'))
+    assert post_event(client, retried).json == {'status': 'success'}
+    assert post_event(client, retried).json == {'status': 'duplicate'}
+
+
+def test_abandoned_claim_is_taken_over(app):
+    with app.app_context():
+        assert claim_event('evt_1', 'checkout.session.completed')
+        db.session.commit()
+        assert not claim_event('evt_1', 'checkout.session.completed')
+
+        ProcessedEvent.query.filter_by(event_id='evt_1').update(
+            {'received_at': datetime.utcnow() - timedelta(seconds=STALE_CLAIM_SECONDS + 1)})
+        assert claim_event('evt_1', 'checkout.session.completed')
+
+        record_event_processed('evt_1', 1.0)
+        ProcessedEvent.query.filter_by(event_id='evt_1').update(
+            {'received_at': datetime.utcnow() - timedelta(seconds=STALE_CLAIM_SECONDS + 1)})
+        assert not claim_event('evt_1', 'checkout.session.completed')
+
+
+def test_superseded_events_are_recorded_as_processed(make_app, customer):
+    app = make_app(WEBHOOK_ASYNC='true', WEBHOOK_WORKERS_IN_PROCESS='false')
+    client = app.test_client()
+    events = [
+        stripe_event('evt_1', 'customer.subscription.created', 100, subscription_object()),
+        stripe_event('evt_2', 'customer.subscription.updated', 200, subscription_object(status='past_due')),
+        stripe_event('evt_3', 'customer.subscription.updated', 300, subscription_object(status='active')),
+    ]
+    for event in events:
+        post_event(client, event)
+    WebhookWorkerPool(app, process_event, batch_size=10).drain()
+
+    with app.app_context():
+        processed = dict(db.session.query(ProcessedEvent.event_id, ProcessedEvent.processed_at))
+        assert sorted(processed) == ['evt_1', 'evt_2', 'evt_3']
+        assert all(processed.values())
+    assert post_event(client, events[1]).json == {'status': 'duplicate'}
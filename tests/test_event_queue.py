@@ -0,0 +1,115 @@
+import json
+from datetime import datetime, timedelta
+
+from event_queue import WebhookWorkerPool, enqueue_event, requeue_dead_events
+from models import db, WebhookEvent
+
+from conftest import stripe_event
+
+
+class FlakyHandler:
+    """process_event stand-in that raises for each event ID the number of times given in `failures`"""
+
+    def __init__(self, **failures):
+        self.failures = failures
+        self.applied = []
+
+    def __call__(self, event):
+        if self.failures.get(event['id'], 0):
+            self.failures[event['id']] -= 1
+            raise RuntimeError(f'{event["id"]} failed')
+        self.applied.append(event['id'])
+
+
+def enqueue(app, event_id, subscription_id='sub_1', status='pending'):
+    event = stripe_event(event_id, 'customer.subscription.updated', 100, {'id': subscription_id})
+    with app.app_context():
+        event_pk = enqueue_event(event_id, event['type'], json.dumps(event), ordering_key=subscription_id)
+        if status != 'pending':
+            db.session.get(WebhookEvent, event_pk).status = status
+            db.session.commit()
+    return event_pk
+
+
+def queued(app, event_pk):
+    with app.app_context():
+        row = db.session.get(WebhookEvent, event_pk)
+        return row.status, row.attempts, row.next_attempt_at, row.last_error
+
+
+def make_due(app):
+    with app.app_context():
+        WebhookEvent.query.update({'next_attempt_at': datetime.utcnow()})
+        db.session.commit()
+
+
+def run_once(app, workers):
+    with app.app_context():
+        return workers.run_once()
+
+
+def test_events_of_a_key_are_not_claimed_while_an_earlier_one_is_processing(app):
+    enqueue(app, 'evt_1', 'sub_1', status='processing')  # another worker has it
+    blocked = enqueue(app, 'evt_2', 'sub_1')
+    free = enqueue(app, 'evt_3', 'sub_2')
+    workers = WebhookWorkerPool(app, FlakyHandler())
+
+    with app.app_context():
+        assert workers._claim(10) == [free]
+    assert queued(app, blocked)[0] == 'pending'
+
+
+def test_failed_event_is_retried_with_backoff(app):
+    event_pk = enqueue(app, 'evt_1')
+    handler = FlakyHandler(evt_1=2)
+    workers = WebhookWorkerPool(app, handler, retry_base_seconds=60)
+
+    for attempts, delay in ((1, 60), (2, 120)):
+        before = datetime.utcnow()
+        assert run_once(app, workers)
+        status, attempt_count, next_attempt_at, last_error = queued(app, event_pk)
+        assert (status, attempt_count, last_error) == ('pending', attempts, 'evt_1 failed')
+        # Exponential delay with jitter: between half and all of base * 2**(attempts - 1)
+        assert before + timedelta(seconds=delay / 2) <= next_attempt_at <= datetime.utcnow() + timedelta(seconds=delay)
+        assert not run_once(app, workers)  # not due yet
+        make_due(app)
+
+    assert run_once(app, workers)
+    assert queued(app, event_pk)[:2] == ('done', 3)
+    assert handler.applied == ['evt_1']
+
+
+def test_event_is_dead_lettered_after_max_attempts(app):
+    event_pk = enqueue(app, 'evt_1')
+    workers = WebhookWorkerPool(app, FlakyHandler(evt_1=99), max_attempts=3)
+
+    for _ in range(3):
+        make_due(app)
+        assert run_once(app, workers)
+    assert queued(app, event_pk)[:2] == ('dead', 3)
+    make_due(app)
+    assert not run_once(app, workers)
+
+    with app.app_context():
+        assert requeue_dead_events() == 1
+    assert queued(app, event_pk)[:2] == ('pending', 0)
+
+
+def test_failed_batch_is_applied_event_by_event(app):
+    failing = enqueue(app, 'evt_1', 'sub_1')
+    held_back = enqueue(app, 'evt_2', 'sub_1')
+    other_key = enqueue(app, 'evt_3', 'sub_2')
+    handler = FlakyHandler(evt_1=2)  # fails the batch, then on its own
+    workers = WebhookWorkerPool(app, handler, batch_size=10)
+
+    assert run_once(app, workers)
+    assert queued(app, failing)[:2] == ('pending', 1)
+    # Later events of the failed key wait for it, without using up an attempt
+    assert queued(app, held_back)[:2] == ('pending', 0)
+    assert queued(app, other_key)[:2] == ('done', 1)
+    assert handler.applied == ['evt_3']
+
+    make_due(app)
+    assert run_once(app, workers)
+    assert [queued(app, event_pk)[0] for event_pk in (failing, held_back)] == ['done', 'done']
+    assert handler.applied == ['evt_3', 'evt_1', 'evt_2']
@@ -0,0 +1,45 @@
+import csv
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from export import export_tables, load_watermarks
+from models import db, Payment
+
+
+def add_payment(app, user_id, transaction_id, created_at):
+    with app.app_context():
+        payment = Payment(user_id=user_id, amount=Decimal('25.00'), payment_type='one_time', status='completed',
+                          transaction_id=transaction_id, created_at=created_at)
+        db.session.add(payment)
+        db.session.commit()
+        return payment.id
+
+
+def export(app, tmp_path, **kwargs):
+    with app.app_context():
+        stats = export_tables(['payments'], str(tmp_path / 'exports'), formats=('csv',),
+                              watermark_path=str(tmp_path / 'watermark.json'), **kwargs)['payments']
+    exported = []
+    for path in stats['files']:
+        with open(path, newline='') as f:
+            exported += [row['transaction_id'] for row in csv.DictReader(f)]
+    return exported
+
+
+def test_each_run_exports_the_rows_created_since_the_last_one(app, customer, tmp_path):
+    an_hour_ago = datetime.utcnow() - timedelta(hours=1)
+    add_payment(app, customer, 'cs_1', an_hour_ago)
+    add_payment(app, customer, 'cs_2', an_hour_ago + timedelta(minutes=1))
+    add_payment(app, customer, 'cs_new', datetime.utcnow())  # younger than settle_seconds: left for a later run
+    assert export(app, tmp_path) == ['cs_1', 'cs_2']
+    last_id = load_watermarks(str(tmp_path / 'watermark.json'))['payments']['id']
+
+    # Same created_at as the watermark row but a higher id, and a later one
+    add_payment(app, customer, 'cs_3', an_hour_ago + timedelta(minutes=1))
+    add_payment(app, customer, 'cs_4', an_hour_ago + timedelta(minutes=2))
+    assert export(app, tmp_path) == ['cs_3', 'cs_4']
+    assert load_watermarks(str(tmp_path / 'watermark.json'))['payments']['id'] > last_id
+
+    assert export(app, tmp_path) == []
+    assert export(app, tmp_path, full=True) == ['cs_1', 'cs_2', 'cs_3', 'cs_4']
+    assert export(app, tmp_path, settle_seconds=0) == ['cs_new']
@@ -0,0 +1,141 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import price_catalog
+from price_catalog import PriceCatalog
+
+
+class FakeStripe:
+    """fetch_price stand-in: counts calls, and blocks while `gate` is cleared"""
+
+    def __init__(self):
+        self.amounts = {}
+        self.calls = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def fetch_price(self, price_id):
+        self.calls.append(price_id)
+        self.gate.wait(5)
+        return {'id': price_id, 'unit_amount': self.amounts.get(price_id, 1000), 'currency': 'cad',
+                'product': 'prod_1'}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Monotonic clock of the catalog, moved forward by hand"""
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(price_catalog, 'time', SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+
+@pytest.fixture
+def stripe():
+    return FakeStripe()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_expired_price_is_served_while_refreshed_in_the_background(stripe, clock):
+    catalog = PriceCatalog(stripe.fetch_price, ttl=60)
+    assert catalog.get('price_1')['amount'] == 10.0
+    version = catalog.version
+
+    clock.value += 30
+    assert catalog.get('price_1')['amount'] == 10.0
+    assert stripe.calls == ['price_1']
+
+    clock.value += 31
+    stripe.amounts['price_1'] = 1500
+    stripe.gate.clear()
+    # Expired: the old price comes back right away, one refresh runs for both readers
+    assert catalog.get('price_1')['amount'] == 10.0
+    assert catalog.get('price_1')['amount'] == 10.0
+    stripe.gate.set()
+    wait_until(lambda: catalog.get('price_1')['amount'] == 15.0)
+    assert stripe.calls == ['price_1', 'price_1']
+    assert catalog.version == version + 1
+
+
+def test_least_recently_used_price_is_evicted(stripe, clock):
+    catalog = PriceCatalog(stripe.fetch_price, max_size=2)
+    catalog.get('price_1')
+    catalog.get('price_2')
+    catalog.get('price_1')
+    catalog.get('price_3')  # evicts price_2, the least recently used
+
+    catalog.get('price_1')
+    catalog.get('price_3')
+    assert stripe.calls == ['price_1', 'price_2', 'price_3']
+    catalog.get('price_2')
+    assert stripe.calls == ['price_1', 'price_2', 'price_3', 'price_2']
+
+
+def test_version_changes_with_the_prices(stripe, clock):
+    catalog = PriceCatalog(stripe.fetch_price)
+    catalog.get('price_1')
+    version = catalog.version
+
+    catalog.put(stripe.fetch_price('price_1'))
+    assert catalog.version == version  # same price, derived pages stay valid
+
+    stripe.amounts['price_1'] = 2000
+    catalog.put(stripe.fetch_price('price_1'))
+    assert catalog.version == version + 1
+    assert catalog.get('price_1')['amount'] == 20.0
+
+    catalog.invalidate('price_1')
+    assert catalog.version == version + 2
+    catalog.invalidate()
+    assert catalog.version == version + 3
+
+
+def test_concurrent_first_reads_fetch_once(stripe, clock):
+    catalog = PriceCatalog(stripe.fetch_price)
+    stripe.gate.clear()
+    results = []
+    readers = [threading.Thread(target=lambda: results.append(catalog.get('price_1'))) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    wait_until(lambda: stripe.calls)
+    stripe.gate.set()
+    for reader in readers:
+        reader.join(5)
+
+    assert stripe.calls == ['price_1']
+    assert [info['amount'] for info in results] == [10.0] * 4
+
+
+# -------------------------------------------------------------------
+# Rendered pricing pages
+# -------------------------------------------------------------------
+
+def test_unchanged_pricing_page_is_revalidated_with_its_etag(client):
+    first = client.get('/payment/subscribe')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    revalidated = client.get('/payment/subscribe', headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert revalidated.headers['ETag'] == etag
+    assert client.get('/payment/subscribe', headers={'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_page_with_a_flashed_message_is_not_cached(client):
+    with client.session_transaction() as session:
+        session['_flashes'] = [('error', 'Card declined')]
+    flashed = client.get('/payment/subscribe')
+    assert b'Card declined' in flashed.data
+    assert 'ETag' not in flashed.headers
+
+    cached = client.get('/payment/subscribe')
+    assert b'Card declined' not in cached.data
+    assert 'ETag' in cached.headers
@@ -0,0 +1,56 @@
+from decimal import Decimal
+
+import pytest
+
+from models import db, Payment
+from read_replicas import sync_sqlite_replicas
+
+from conftest import API_HEADERS
+
+
+def add_payment(app, user_id, transaction_id):
+    with app.app_context():
+        db.session.add(Payment(user_id=user_id, amount=Decimal('25.00'), payment_type='one_time',
+                               status='completed', transaction_id=transaction_id))
+        db.session.commit()
+
+
+def payment_ids(client, user_id):
+    response = client.get(f'/api/users/{user_id}/payments', headers=API_HEADERS)
+    assert response.status_code == 200
+    return [row['id'] for row in response.json['data']]
+
+
+@pytest.fixture
+def replica_app(make_app, tmp_path):
+    return make_app(DATABASE_REPLICA_URLS=f'sqlite:///{tmp_path / "replica.db"}')
+
+
+def test_reads_go_to_the_replica_until_the_client_sticks_to_the_primary(replica_app, customer):
+    add_payment(replica_app, customer, 'cs_1')
+    with replica_app.app_context():
+        sync_sqlite_replicas(db)
+    add_payment(replica_app, customer, 'cs_2')
+
+    client = replica_app.test_client()
+    # The replica lags: it hasn't seen the second payment
+    assert len(payment_ids(client, customer)) == 1
+
+    # /payment/success makes this client read its own writes from the primary
+    client.get('/payment/success')
+    assert len(payment_ids(client, customer)) == 2
+
+    # Other clients keep reading from the replica
+    assert len(payment_ids(replica_app.test_client(), customer)) == 1
+
+
+def test_reads_fail_over_to_the_primary_when_the_replica_is_down(make_app, tmp_path, customer):
+    app = make_app(DATABASE_REPLICA_URLS=f'sqlite:///{tmp_path / "missing" / "replica.db"}')
+    add_payment(app, customer, 'cs_1')
+    client = app.test_client()
+
+    assert len(payment_ids(client, customer)) == 1
+    assert list(app.extensions['replicas_down_until']) == ['replica_0']
+
+    # Later requests skip the replica without trying it again
+    assert len(payment_ids(client, customer)) == 1
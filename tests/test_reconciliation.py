@@ -0,0 +1,99 @@
+import io
+from datetime import datetime, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+from analytics import analytics_summary, rebuild_rollups
+from app import repair_from_stripe
+from models import db, Payment
+from reconciliation import CheckoutSessionSource, Reconciler, load_checkpoint
+
+
+NOW = 1700000000
+
+
+def checkout_session(number, amount_total=2500):
+    return {'id': f'cs_{number}', 'object': 'checkout.session', 'created': NOW - number * 60, 'mode': 'payment',
+            'status': 'complete', 'payment_status': 'paid', 'amount_total': amount_total,
+            'metadata': {'payment_type': 'one_time'}}
+
+
+class FakeStripeList:
+    """list_objects stand-in: the sessions matching params['created'], newest first; can fail after N objects"""
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.calls = []
+        self.fail_after = None
+
+    def __call__(self, params):
+        self.calls.append(params['created'])
+        matching = sorted((s for s in self.sessions
+                           if params['created']['gte'] <= s['created'] <= params['created']['lte']),
+                          key=lambda s: -s['created'])
+        return SimpleNamespace(auto_paging_iter=lambda: self._iterate(matching))
+
+    def _iterate(self, sessions):
+        for count, session in enumerate(sessions):
+            if count == self.fail_after:
+                raise ConnectionError('network down')
+            yield session
+
+
+def add_payments(app, user_id, sessions, amount=Decimal('25.00')):
+    with app.app_context():
+        for session in sessions:
+            db.session.add(Payment(user_id=user_id, amount=amount, payment_type='one_time', status='completed',
+                                   transaction_id=session['id'], created_at=datetime.utcnow() - timedelta(hours=1)))
+        db.session.commit()
+
+
+def reconciler(stripe_list, checkpoint_path, repair=None):
+    source = CheckoutSessionSource(stripe_list, retrieve_object=lambda stripe_id: pytest.fail('not listed'))
+    return Reconciler([source], io.StringIO(), repair=repair, page_size=2, checkpoint_path=checkpoint_path)
+
+
+def test_interrupted_run_resumes_at_its_last_page(app, customer, tmp_path):
+    sessions = [checkout_session(number) for number in range(1, 6)]
+    add_payments(app, customer, sessions)
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    stripe_list = FakeStripeList(sessions)
+    stripe_list.fail_after = 3
+
+    with app.app_context():
+        with pytest.raises(ConnectionError):
+            reconciler(stripe_list, checkpoint_path).run(since=0, until=NOW)
+    state = load_checkpoint(checkpoint_path)['checkout_sessions']
+    # The first page (cs_1, cs_2) is done
+    assert (state['phase'], state['upper'], state['stats']['seen']) == ('stripe', sessions[1]['created'], 2)
+
+    stripe_list.fail_after = None
+    with app.app_context():
+        stats = reconciler(stripe_list, checkpoint_path).run()['checkout_sessions']
+        assert Payment.query.filter(Payment.reconciled_at.is_(None)).count() == 0
+    assert stripe_list.calls[-1] == {'gte': 0, 'lte': sessions[1]['created']}
+    assert (stats['seen'], stats['in_sync'], stats['mismatch']) == (6, 6, 0)  # cs_2 is compared again
+    assert load_checkpoint(checkpoint_path)['checkout_sessions']['completed_until'] == NOW
+
+
+def test_repaired_amount_keeps_the_rollups_consistent(app, customer, tmp_path):
+    sessions = [checkout_session(1, amount_total=3000), checkout_session(2)]
+    add_payments(app, customer, sessions)
+    with app.app_context():
+        rebuild_rollups()
+
+    with app.app_context():
+        stats = reconciler(FakeStripeList(sessions), str(tmp_path / 'checkpoint.json'),
+                           repair=repair_from_stripe).run(since=0, until=NOW)['checkout_sessions']
+        assert (stats['mismatch'], stats['repaired']) == (1, 1)
+        assert [str(p.amount) for p in Payment.query.order_by(Payment.transaction_id)] == ['30.00', '25.00']
+
+        today = datetime.utcnow().date()
+        incremental = analytics_summary(today - timedelta(days=1), today)['revenue']
+        rebuild_rollups()
+        rebuilt = analytics_summary(today - timedelta(days=1), today)['revenue']
+    # The amount changed, the payment count didn't
+    assert (incremental['total'], incremental['payments']) == ('55.00', 2)
+    assert incremental == rebuilt
@@ -0,0 +1,43 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import services
+from models import db, Subscription
+
+from conftest import post_event, stripe_event, subscription_object
+
+
+@pytest.fixture
+def local_time_zone():
+    """Run the server west of UTC, where local and UTC datetimes differ by hours"""
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = 'America/Toronto'
+    time.tzset()
+    yield
+    if previous is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = previous
+    time.tzset()
+
+
+def test_subscription_checked_before_its_billing_date_is_due_again(make_app, customer, local_time_zone):
+    app = make_app(RENEWAL_GRACE_SECONDS='0')
+    billed_at = int(time.time()) - 2 * 3600
+    event = stripe_event('evt_1', 'customer.subscription.created', billed_at - 86400,
+                         subscription_object(period_end=billed_at))
+    assert post_event(app.test_client(), event).status_code == 200
+
+    scheduler = services(app).renewal_scheduler
+    with app.app_context():
+        subscription = Subscription.query.filter_by(stripe_subscription_id='sub_1').one()
+        assert subscription.next_billing_date == datetime.utcfromtimestamp(billed_at)
+        # Last checked in the previous period, an hour before the billing date
+        subscription.reconciled_at = datetime.utcfromtimestamp(billed_at) - timedelta(hours=1)
+        db.session.commit()
+
+        scheduler._refill(time.time())
+        assert scheduler._scheduled == {subscription.id: billed_at}
@@ -0,0 +1,37 @@
+from models import Subscription
+
+from conftest import post_event, stripe_event, subscription_object
+
+
+OLD = dict(subscription_id='sub_old', period_end=1900000000)
+NEW = dict(subscription_id='sub_new', period_end=1950000000)
+
+
+def _statuses(app):
+    with app.app_context():
+        return dict(Subscription.query.with_entities(Subscription.stripe_subscription_id, Subscription.status))
+
+
+def test_replacement_created_before_the_old_one_is_deleted(app, client, customer):
+    events = [
+        stripe_event('evt_1', 'customer.subscription.created', 100, subscription_object(**OLD)),
+        stripe_event('evt_2', 'customer.subscription.created', 200, subscription_object(**NEW)),
+        stripe_event('evt_3', 'customer.subscription.deleted', 201, subscription_object(status='canceled', **OLD)),
+    ]
+    assert post_event(client, events[0]).status_code == 200
+    assert post_event(client, events[1]).status_code == 200
+    assert _statuses(app) == {'sub_old': 'expired', 'sub_new': 'active'}
+
+    assert post_event(client, events[2]).status_code == 200
+    assert _statuses(app) == {'sub_old': 'cancelled', 'sub_new': 'active'}
+
+
+def test_late_events_of_the_replaced_subscription_keep_the_newer_one_active(app, client, customer):
+    events = [
+        stripe_event('evt_1', 'customer.subscription.created', 200, subscription_object(**NEW)),
+        stripe_event('evt_2', 'customer.subscription.created', 100, subscription_object(**OLD)),
+        stripe_event('evt_3', 'customer.subscription.updated', 150, subscription_object(**OLD)),
+    ]
+    for event in events:
+        assert post_event(client, event).status_code == 200
+    assert _statuses(app) == {'sub_old': 'expired', 'sub_new': 'active'}
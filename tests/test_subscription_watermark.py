@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import pytest
+
+from app import process_event
+from event_queue import WebhookWorkerPool
+from models import Subscription
+
+from conftest import post_event, stripe_event, subscription_object
+
+
+# created, then two updates delivered newest first
+OUT_OF_ORDER = [
+    stripe_event('evt_1', 'customer.subscription.created', 100, subscription_object(status='active')),
+    stripe_event('evt_2', 'customer.subscription.updated', 300, subscription_object(status='past_due')),
+    stripe_event('evt_3', 'customer.subscription.updated', 200, subscription_object(status='active')),
+]
+
+
+def _subscription(app):
+    with app.app_context():
+        subscription = Subscription.query.filter_by(stripe_subscription_id='sub_1').one()
+        return subscription.status, subscription.last_event_at
+
+
+def test_older_update_is_skipped_inline(app, client, customer):
+    for event in OUT_OF_ORDER:
+        assert post_event(client, event).status_code == 200
+    assert _subscription(app) == ('past_due', datetime.utcfromtimestamp(300))
+
+
+@pytest.mark.parametrize('batch_size', [1, 10])
+def test_older_update_is_skipped_by_the_workers(make_app, customer, batch_size):
+    app = make_app(WEBHOOK_ASYNC='true', WEBHOOK_WORKERS_IN_PROCESS='false')
+    client = app.test_client()
+    for event in OUT_OF_ORDER:
+        assert post_event(client, event).json['status'] == 'queued'
+
+    workers = WebhookWorkerPool(app, process_event, batch_size=batch_size)
+    workers.drain()
+    assert _subscription(app) == ('past_due', datetime.utcfromtimestamp(300))
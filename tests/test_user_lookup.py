@@ -0,0 +1,41 @@
+import logging
+
+from app import checkout_customer_params, services
+from models import db, User
+
+from conftest import post_event, stripe_event
+
+
+def test_checkout_sees_a_customer_linked_by_another_process(app):
+    user_directory = services(app).user_directory
+    with app.app_context():
+        record = user_directory.get_or_create('grace@example.com', 'Grace')
+        assert checkout_customer_params(record) == {'customer_email': 'grace@example.com'}
+
+        # e.g. `flask webhook-worker` handling checkout.session.completed, with its own cache
+        User.query.filter_by(id=record.id).update({'stripe_customer_id': 'cus_2'})
+        db.session.commit()
+        assert user_directory.cached('grace@example.com').stripe_customer_id is None
+
+        record = user_directory.get_or_create('grace@example.com', 'Grace')
+        assert checkout_customer_params(record) == {'customer': 'cus_2'}
+        assert user_directory.cached('grace@example.com').stripe_customer_id == 'cus_2'
+
+
+def test_cached_user_with_a_customer_needs_no_query(app, customer):
+    user_directory = services(app).user_directory
+    with app.app_context():
+        assert user_directory.get_or_create('ada@example.com', 'Ada').stripe_customer_id == 'cus_1'
+        User.query.filter_by(id=customer).update({'name': 'Ada Lovelace'})
+        db.session.commit()
+        assert user_directory.get_or_create('ada@example.com', 'Ada').name == 'Ada'
+
+
+def test_customer_name_change_is_stored_and_logged(app, client, customer, caplog):
+    event = stripe_event('evt_1', 'customer.updated', 100, {'id': 'cus_1', 'object': 'customer',
+                                                            'email': 'ada@example.com', 'name': 'Ada Lovelace'})
+    with caplog.at_level(logging.INFO, logger='app'):
+        assert post_event(client, event).status_code == 200
+    assert f'Updated name for user {customer}: Ada -> Ada Lovelace' in caplog.messages
+    with app.app_context():
+        assert db.session.get(User, customer).name == 'Ada Lovelace'
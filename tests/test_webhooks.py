@@ -0,0 +1,62 @@
+import json
+import time
+
+import pytest
+
+from models import ProcessedEvent
+from stripe_client import stripe
+from webhook_dispatch import WebhookVerifier
+
+from conftest import WEBHOOK_SECRET, signature_header, stripe_event
+
+
+# Formatted the way Stripe sends it: re-serializing it would change the bytes
+PAYLOAD = '{\n  "id": "evt_1",\n  "type": "customer.updated",\n  "data": {"object": {"name": "Zoë"}}\n}'.encode()
+
+
+def post_raw(client, payload, header):
+    return client.post('/webhook', data=payload, content_type='application/json',
+                       headers={'Stripe-Signature': header} if header else {})
+
+
+def test_signature_matches_stripes_own_check():
+    header = signature_header(PAYLOAD)
+    assert stripe.WebhookSignature.verify_header(PAYLOAD.decode(), header, WEBHOOK_SECRET, tolerance=300)
+    assert WebhookVerifier(WEBHOOK_SECRET).construct_event(PAYLOAD, header)['data']['object']['name'] == 'Zoë'
+
+
+def test_signature_covers_the_raw_bytes():
+    header = signature_header(PAYLOAD)
+    reserialized = json.dumps(json.loads(PAYLOAD)).encode()
+    with pytest.raises(stripe.SignatureVerificationError):
+        WebhookVerifier(WEBHOOK_SECRET).verify(reserialized, header)
+
+
+def test_any_active_secret_is_accepted_while_rolling(make_app):
+    client = make_app(STRIPE_WEBHOOK_SECRET='whsec_old, whsec_new').test_client()
+    event = json.dumps(stripe_event('evt_1', 'price.created', 100, {'id': 'price_1'})).encode()
+    for secret in ('whsec_old', 'whsec_new'):
+        assert post_raw(client, event, signature_header(event, secret)).status_code == 200
+    assert post_raw(client, event, signature_header(event, 'whsec_retired')).status_code == 400
+
+
+@pytest.mark.parametrize('header', [
+    None,
+    't=abc,v1=0123',
+    signature_header(PAYLOAD, 'whsec_wrong'),
+    signature_header(PAYLOAD, timestamp=int(time.time()) - 600),  # replayed after the tolerance
+])
+def test_bad_signature_is_rejected(app, client, header):
+    response = post_raw(client, PAYLOAD, header)
+    assert response.status_code == 400
+    assert response.json == {'error': 'Webhook verification failed'}
+    with app.app_context():
+        assert ProcessedEvent.query.count() == 0
+
+
+def test_event_without_a_handler_is_acknowledged_and_not_recorded(app, client):
+    event = json.dumps(stripe_event('evt_1', 'charge.refund.updated', 100, {'id': 're_1'})).encode()
+    response = post_raw(client, event, signature_header(event))
+    assert (response.status_code, response.json) == (200, {'status': 'ignored'})
+    with app.app_context():
+        assert ProcessedEvent.query.count() == 0
@@ -0,0 +1,56 @@
+from worker_sharding import BUCKET_WIDTH, BUCKETS, RING_SIZE, HashRing, shard_hash
+
+
+WORKERS = ['host-0', 'host-1', 'host-2', 'host-3']
+
+
+def owners(ring):
+    return [ring.owner(bucket * BUCKET_WIDTH) for bucket in range(BUCKETS)]
+
+
+def test_shard_hash_is_stable():
+    # The same in every process and on every host (hash() is salted per process)
+    assert shard_hash('sub_1') == 1941209925
+    assert shard_hash('cus_1') == 725656469
+    assert shard_hash(None) is None
+    assert all(0 <= shard_hash(f'sub_{i}') < RING_SIZE for i in range(1000))
+
+
+def test_every_bucket_has_one_owner_and_load_is_spread():
+    ring = HashRing(WORKERS)
+    assert sorted(bucket for worker in WORKERS for bucket in ring.buckets(worker)) == list(range(BUCKETS))
+    for worker in WORKERS:
+        assert BUCKETS / 8 < len(ring.buckets(worker)) < BUCKETS / 2
+
+
+def test_a_subscription_always_lands_on_the_same_worker():
+    rings = [HashRing(WORKERS), HashRing(reversed(WORKERS)), HashRing(WORKERS + ['host-0'])]
+    for key in ('sub_1', 'sub_2', 'cus_1'):
+        hash_value = shard_hash(key)
+        owner = rings[0].owner(hash_value)
+        assert {ring.owner(hash_value) for ring in rings} == {owner}
+        assert hash_value // BUCKET_WIDTH in rings[0].buckets(owner)
+        # Anywhere in its bucket
+        bucket_start = hash_value - hash_value % BUCKET_WIDTH
+        assert rings[0].owner(bucket_start + BUCKET_WIDTH - 1) == owner
+
+
+def test_removing_a_worker_only_moves_its_buckets():
+    before = owners(HashRing(WORKERS))
+    after = owners(HashRing(WORKERS[:-1]))
+    moved = [(old, new) for old, new in zip(before, after) if old != new]
+    assert moved
+    assert {old for old, _ in moved} == {'host-3'}
+    assert len(moved) == before.count('host-3')
+
+
+def test_adding_a_worker_only_takes_buckets_over():
+    before = owners(HashRing(WORKERS))
+    after = owners(HashRing(WORKERS + ['host-4']))
+    moved = [(old, new) for old, new in zip(before, after) if old != new]
+    assert {new for _, new in moved} == {'host-4'}
+    assert len(moved) == after.count('host-4')
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing([]).owner(shard_hash('sub_1')) is None
@@ -0,0 +1,271 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from metrics import USER_CACHE_LOOKUPS
+from models import db, commit, User
+
+
+logger = logging.getLogger(__name__)
+
+
+class CustomerDirectory:
+    """
+    Resolves a Stripe customer ID to the local User
+
+    1. LRU cache of customer_id -> user_id (primary-key lookup only)
+    2. Indexed lookup on users.stripe_customer_id
+    3. Stripe API (Customer.retrieve + email match) only on a miss; the
+       customer ID is then stored on the user so the next lookup stays local
+    """
+
+    def __init__(self, fetch_customer, max_size=10000, users=None):
+        # fetch_customer(customer_id) -> Stripe Customer object (or dict)
+        self._fetch_customer = fetch_customer
+        # UserDirectory whose cached users are kept in step with link()
+        self.users = users
+        self.max_size = max_size
+        self._user_ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.api_lookups = 0
+
+    def _cache_get(self, customer_id):
+        with self._lock:
+            user_id = self._user_ids.get(customer_id)
+            if user_id is not None:
+                self._user_ids.move_to_end(customer_id)
+            return user_id
+
+    def remember(self, customer_id, user_id):
+        with self._lock:
+            self._user_ids[customer_id] = user_id
+            self._user_ids.move_to_end(customer_id)
+            while len(self._user_ids) > self.max_size:
+                self._user_ids.popitem(last=False)
+
+    def forget(self, customer_id):
+        with self._lock:
+            self._user_ids.pop(customer_id, None)
+
+    def link(self, user, customer_id):
+        """
+        Store customer_id on user (first one wins, so a re-created customer can't steal the link)
+
+        `user` is a User or a cached UserRecord; the conditional UPDATE also
+        keeps two concurrent links from overwriting each other.
+        """
+        if not customer_id:
+            return
+        if not user.stripe_customer_id:
+            linked = User.query.filter(User.id == user.id, User.stripe_customer_id.is_(None)).update(
+                {'stripe_customer_id': customer_id}
+            )
+            commit()
+            if self.users:
+                if linked:
+                    self.users.update(user.id, stripe_customer_id=customer_id)
+                else:
+                    self.users.forget(user.id)
+        self.remember(customer_id, user.id)
+
+    def find_local(self, customer_id):
+        """Cache or database only, never calls Stripe"""
+        if not customer_id:
+            return None
+
+        user_id = self._cache_get(customer_id)
+        if user_id is not None:
+            user = db.session.get(User, user_id)
+            if user:
+                self.hits += 1
+                USER_CACHE_LOOKUPS.inc(lookup='customer', outcome='hit')
+                return user
+            self.forget(customer_id)
+
+        self.misses += 1
+        USER_CACHE_LOOKUPS.inc(lookup='customer', outcome='miss')
+        user = User.query.filter_by(stripe_customer_id=customer_id).first()
+        if user:
+            self.remember(customer_id, user.id)
+        return user
+
+    def user_for_customer(self, customer_id):
+        """Local lookup first, Stripe API fallback; returns None if no user matches"""
+        user = self.find_local(customer_id)
+        if user or not customer_id:
+            return user
+
+        self.api_lookups += 1
+        customer = self._fetch_customer(customer_id)
+        email = customer.get('email')
+        if not email:
+            logger.warning('No email found for customer %s', customer_id)
+            return None
+
+        user = self.users.by_email(email) if self.users else User.query.filter_by(email=email).first()
+        if not user:
+            logger.warning('User not found for email %s', email)
+            return None
+
+        self.link(user, customer_id)
+        return db.session.get(User, user.id)
+
+
+# Read-only snapshot of a user, safe to share between requests and threads
+UserRecord = namedtuple('UserRecord', 'id email name stripe_customer_id created_at')
+
+
+def user_record(user):
+    return UserRecord(user.id, user.email, user.name, user.stripe_customer_id, user.created_at)
+
+
+def insert_user_statement(dialect, email, name):
+    """INSERT ... ON CONFLICT DO NOTHING on the unique email, or None if the database has no such statement"""
+    if dialect not in ('sqlite', 'postgresql'):
+        return None
+    insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+    return insert(User).values(email=email, name=name, created_at=datetime.utcnow()).on_conflict_do_nothing(
+        index_elements=['email']
+    )
+
+
+def _insert_user(email, name):
+    """Create the user unless the email exists; True if this call created it"""
+    stmt = insert_user_statement(db.session.get_bind().dialect.name, email, name)
+    if stmt is not None:
+        return db.session.execute(stmt).rowcount == 1
+    # Other databases: rely on the unique constraint
+    try:
+        with db.session.begin_nested():
+            db.session.add(User(email=email, name=name))
+        return True
+    except IntegrityError:
+        return False
+
+
+class UserDirectory:
+    """
+    Resolves users by email or ID for the checkout, success and dashboard flows
+
+    - UserRecord snapshots are cached for `ttl` seconds, keyed by email (with an
+      ID -> email index); at most `max_size` users, least recently used evicted first
+    - get_or_create() inserts with ON CONFLICT DO NOTHING, so two first checkouts
+      for the same email can't both create the user (or fail on the unique index),
+      and re-reads cached users without a Stripe customer ID
+    - Code that changes a user calls update() or forget(); other processes (e.g.
+      `flask webhook-worker`) don't share the cache, so their changes show after the TTL
+    - Lookups are counted in user_cache_lookups_total by kind and outcome
+    """
+
+    def __init__(self, ttl=300, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # email -> (expires_at, UserRecord)
+        self._emails = {}  # user id -> email
+        self._lock = threading.Lock()
+
+    def _get(self, email):
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                return None
+            expires_at, record = entry
+            if expires_at <= time.monotonic():
+                del self._entries[email]
+                self._emails.pop(record.id, None)
+                return None
+            self._entries.move_to_end(email)
+            return record
+
+    def remember(self, user):
+        """Cache a User (or UserRecord); returns the UserRecord"""
+        record = user if isinstance(user, UserRecord) else user_record(user)
+        with self._lock:
+            self._entries[record.email] = (time.monotonic() + self.ttl, record)
+            self._entries.move_to_end(record.email)
+            self._emails[record.id] = record.email
+            while len(self._entries) > self.max_size:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._emails.pop(evicted.id, None)
+        return record
+
+    def forget(self, user_id):
+        with self._lock:
+            email = self._emails.pop(user_id, None)
+            if email is not None:
+                self._entries.pop(email, None)
+
+    def update(self, user_id, **fields):
+        """Change fields of a cached user in place (no-op if it isn't cached)"""
+        with self._lock:
+            email = self._emails.get(user_id)
+            entry = self._entries.get(email) if email is not None else None
+            if entry:
+                self._entries[email] = (entry[0], entry[1]._replace(**fields))
+
+    def cached(self, email):
+        """Cached UserRecord for email, or None on a miss (never queries the database)"""
+        record = self._get(email)
+        USER_CACHE_LOOKUPS.inc(lookup='email', outcome='hit' if record else 'miss')
+        return record
+
+    def by_email(self, email):
+        """UserRecord for email, or None"""
+        if not email:
+            return None
+        record = self.cached(email)
+        if record:
+            return record
+        user = User.query.filter_by(email=email).first()
+        return self.remember(user) if user else None
+
+    def by_id(self, user_id):
+        """UserRecord for user_id, or None"""
+        with self._lock:
+            email = self._emails.get(user_id)
+        record = self._get(email) if email is not None else None
+        if record:
+            USER_CACHE_LOOKUPS.inc(lookup='id', outcome='hit')
+            return record
+        USER_CACHE_LOOKUPS.inc(lookup='id', outcome='miss')
+        user = db.session.get(User, user_id)
+        return self.remember(user) if user else None
+
+    def get_or_create(self, email, name):
+        """
+        UserRecord for email, creating the user (with name) if there is none
+
+        Used by checkout, which passes customer_email (so Stripe creates a new
+        customer) for users without a Stripe customer ID. Such a user is read
+        from the database even when cached: another process (e.g. `flask
+        webhook-worker`) may have stored the customer ID since.
+        """
+        record = self._get(email)
+        if record and record.stripe_customer_id:
+            USER_CACHE_LOOKUPS.inc(lookup='email', outcome='hit')
+            return record
+        USER_CACHE_LOOKUPS.inc(lookup='email', outcome='miss')
+        user = User.query.filter_by(email=email).first()
+        if user is None:
+            if _insert_user(email, name):
+                logger.info('Created user %s', email)
+            commit()
+            user = User.query.filter_by(email=email).one()
+        return self.remember(user)
+
+    def hit_ratios(self):
+        """{(lookup,): share of lookups answered from the cache} for the hit ratio gauge"""
+        ratios = {}
+        for lookup in ('email', 'id', 'customer'):
+            hits = USER_CACHE_LOOKUPS.value(lookup=lookup, outcome='hit')
+            total = hits + USER_CACHE_LOOKUPS.value(lookup=lookup, outcome='miss')
+            if total:
+                ratios[(lookup,)] = hits / total
+        return ratios
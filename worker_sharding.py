@@ -0,0 +1,229 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from models import db, WebhookEvent, WebhookWorker
+from structured_logging import stop_logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------------------------------------------------------
+# CONSISTENT HASHING
+# -------------------------------------------------------------------
+# Every queued event gets a shard_hash, a stable 31-bit hash of its ordering
+# key (the Stripe subscription or customer ID, see event_batching.py). The
+# hash space is cut into BUCKETS fixed buckets, and each bucket belongs to the
+# worker process whose point on the ring follows it. Every process has
+# `replicas` points, so all events of one customer go to one process, the
+# buckets spread evenly, and adding or removing a process only moves the
+# buckets next to its points (about 1/N of them). Claiming by bucket keeps the
+# queue filter a single IN list however many points the ring has.
+
+RING_SIZE = 2 ** 31  # fits a signed 32-bit INTEGER column
+BUCKETS = 1024
+BUCKET_WIDTH = RING_SIZE // BUCKETS
+
+
+def shard_hash(key):
+    """Position of an ordering key on the ring (the same in every process, unlike hash())"""
+    if key is None:
+        return None
+    digest = hashlib.blake2b(key.encode(), digest_size=4).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+
+class HashRing:
+    """Worker IDs placed on the ring at `replicas` points each"""
+
+    def __init__(self, members, replicas=64):
+        self.members = tuple(sorted(set(members)))
+        self.replicas = replicas
+        points = sorted((shard_hash(f'{member}#{i}'), member) for member in self.members for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, hash_value):
+        """Worker owning a shard_hash: the one owning its bucket"""
+        if not self._hashes:
+            return None
+        start = hash_value - hash_value % BUCKET_WIDTH
+        # The first point at or after the bucket, wrapping around
+        index = bisect.bisect_left(self._hashes, start)
+        return self._owners[index % len(self._owners)]
+
+    def buckets(self, member):
+        """Buckets (shard_hash // BUCKET_WIDTH) owned by member"""
+        return [bucket for bucket in range(BUCKETS) if self.owner(bucket * BUCKET_WIDTH) == member]
+
+
+# -------------------------------------------------------------------
+# MEMBERSHIP (webhook_workers table)
+# -------------------------------------------------------------------
+
+def default_worker_id(slot=None):
+    return f'{socket.gethostname()}-{os.getpid() if slot is None else slot}'
+
+
+class ShardMembership:
+    """
+    One worker process's place on the ring
+
+    heartbeat() records the worker in the webhook_workers table and rebuilds
+    the ring from every worker seen within `expire_seconds`, on every host, so
+    workers rebalance on their own when one is added, stops (leave()) or dies
+    (its heartbeat expires). Views of the ring may differ for a heartbeat
+    interval; that can delay a key or let two workers consider it, but the
+    conditional claim in WebhookWorkerPool still lets only one of them process
+    it, in order.
+    """
+
+    def __init__(self, worker_id=None, heartbeat_seconds=5, expire_seconds=None, replicas=64):
+        self.worker_id = worker_id or default_worker_id()
+        self.heartbeat_seconds = heartbeat_seconds
+        self.expire_seconds = expire_seconds or heartbeat_seconds * 3
+        self.replicas = replicas
+        self._set_ring(HashRing([self.worker_id], replicas))
+
+    def _set_ring(self, ring):
+        self.ring = ring
+        self.buckets = ring.buckets(self.worker_id)
+        # Events queued before the shard_hash column existed can go to any worker
+        self.claim_filter = or_(
+            WebhookEvent.shard_hash.is_(None), (WebhookEvent.shard_hash // BUCKET_WIDTH).in_(self.buckets)
+        )
+
+    def _touch(self, now):
+        values = {'worker_id': self.worker_id, 'pid': os.getpid(), 'started_at': now, 'heartbeat_at': now}
+        dialect = db.session.get_bind().dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+            stmt = insert(WebhookWorker).values(**values)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['worker_id'], set_={'pid': values['pid'], 'heartbeat_at': now}
+            ))
+            return
+        # Other databases: update, insert if there was nothing to update
+        updated = WebhookWorker.query.filter_by(worker_id=self.worker_id).update(
+            {'pid': values['pid'], 'heartbeat_at': now}, synchronize_session=False
+        )
+        if not updated:
+            try:
+                with db.session.begin_nested():
+                    db.session.add(WebhookWorker(**values))
+            except IntegrityError:
+                pass  # another process with our worker ID; the next heartbeat updates it
+
+    def heartbeat(self):
+        """Record this worker as alive and pick up ring changes; returns True if the ring changed"""
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.expire_seconds)
+        self._touch(now)
+        WebhookWorker.query.filter(WebhookWorker.heartbeat_at < cutoff).delete(synchronize_session=False)
+        members = [worker_id for worker_id, in db.session.query(WebhookWorker.worker_id).all()]
+        db.session.commit()
+
+        members = set(members) | {self.worker_id}
+        if tuple(sorted(members)) == self.ring.members:
+            return False
+        self._set_ring(HashRing(members, self.replicas))
+        logger.info('Webhook worker ring changed: %s worker(s), %s owns %s of %s buckets',
+                    len(members), self.worker_id, len(self.buckets), BUCKETS)
+        return True
+
+    def leave(self):
+        """Remove this worker, so the others take over its keys at their next heartbeat"""
+        WebhookWorker.query.filter_by(worker_id=self.worker_id).delete(synchronize_session=False)
+        db.session.commit()
+
+
+# -------------------------------------------------------------------
+# PROCESS SUPERVISOR (flask webhook-worker --processes N)
+# -------------------------------------------------------------------
+
+def _run_worker_process(make_pool, slot):
+    """Body of one forked worker process: its own connection pool, then the pool's threads until SIGTERM"""
+    pool = make_pool(slot)
+    with pool.app.app_context():
+        # Connections inherited from the parent stay with the parent
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    pool.start()
+    try:
+        while True:
+            time.sleep(1)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        pool.stop()
+        stop_logging()
+
+
+class WorkerSupervisor:
+    """
+    Forks `processes` worker processes and restarts any that exit
+
+    make_pool(slot) builds the WebhookWorkerPool of one process (in the child,
+    after the fork). Slots are stable, so a restarted process takes back its
+    worker ID and place on the ring. Needs fork(), i.e. Linux or macOS.
+    """
+
+    def __init__(self, make_pool, processes):
+        self.make_pool = make_pool
+        self.processes = processes
+        self._context = multiprocessing.get_context('fork')
+        self._children = {}
+
+    def _spawn(self, slot):
+        child = self._context.Process(target=_run_worker_process, args=(self.make_pool, slot),
+                                      name=f'webhook-worker-process-{slot}')
+        child.start()
+        self._children[slot] = child
+
+    def start(self):
+        for slot in range(self.processes):
+            self._spawn(slot)
+        logger.info('Started %s webhook worker process(es)', self.processes)
+
+    def check(self):
+        """Restart worker processes that exited"""
+        for slot, child in list(self._children.items()):
+            if not child.is_alive():
+                logger.warning('Webhook worker process %s exited with code %s, restarting', slot, child.exitcode)
+                self._spawn(slot)
+
+    def stop(self, timeout=15):
+        for child in self._children.values():
+            if child.is_alive():
+                child.terminate()  # SIGTERM: finish the current event, leave the ring
+        for child in self._children.values():
+            child.join(timeout)
+            if child.is_alive():
+                child.kill()
+        self._children = {}
+
+    def run(self):
+        """Supervise until interrupted (Ctrl-C or SIGTERM)"""
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+                self.check()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.stop()
@@ -0,0 +1,10 @@
+"""
+WSGI entry point: the app built once, at import
+
+    gunicorn wsgi:app
+    flask --app wsgi run
+"""
+from app import create_app
+
+
+app = create_app()